@@ -1,33 +1,334 @@
 # app.py
 import os
 import json
+import base64
+import logging
 import datetime
 import shutil
+import time
+import random
+import math
+import hashlib
+import hmac
+import threading
+import uuid
+import zipfile
+import tempfile
+import atexit
+import fcntl
+import queue
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from functools import wraps
 from flask import (
-    Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+    Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, Response,
+    make_response, stream_with_context, g, has_request_context
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError
 
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
-from sqlglot import parse, exp
+import importlib
+from collections import OrderedDict
 
 # ---------- Configuration ----------
+logger = logging.getLogger("sdm")
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DATA_ROOT = os.path.join(BASE_DIR, "userdata")     # per-user data will go here
+DATA_ROOT = os.environ.get("SDM_DATA_ROOT", os.path.join(BASE_DIR, "userdata"))  # per-user data will go here
 os.makedirs(DATA_ROOT, exist_ok=True)
+BLOB_ROOT = os.path.join(DATA_ROOT, "blobs")          # content-addressed version artifacts
+
+# LLM call tuning (per-table utility docs run through a bounded worker pool)
+UTILITY_CONCURRENCY = int(os.environ.get("SDM_UTILITY_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.environ.get("SDM_LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BACKOFF = float(os.environ.get("SDM_LLM_RETRY_BACKOFF", "1.0"))  # seconds, doubled per attempt
+LLM_MODEL = os.environ.get("SDM_LLM_MODEL", "gpt-4o-mini")
+
+# LLM backend: "openai" (live), "record" (live, every exchange appended to the
+# fixtures file) or "replay" (answered from the fixtures file, no network)
+LLM_BACKEND = os.environ.get("SDM_LLM_BACKEND", "openai")
+LLM_FIXTURES_PATH = os.environ.get("SDM_LLM_FIXTURES", os.path.join(DATA_ROOT, "llm_fixtures.jsonl"))
+LLM_REPLAY_LATENCY_MS = float(os.environ.get("SDM_LLM_REPLAY_LATENCY_MS", "-1"))  # < 0: as recorded
+LLM_REPLAY_JITTER_MS = float(os.environ.get("SDM_LLM_REPLAY_JITTER_MS", "0"))    # added uniformly per call
+LLM_REPLAY_FALLBACK = os.environ.get("SDM_LLM_REPLAY_FALLBACK", "1") == "1"      # unseen input: reuse a same-prompt fixture
+
+# Process-wide LLM rate limits (0 = unlimited); output tokens are reserved up front
+LLM_REQUESTS_PER_MIN = float(os.environ.get("SDM_LLM_RPM", "60"))
+LLM_TOKENS_PER_MIN = float(os.environ.get("SDM_LLM_TPM", "150000"))
+LLM_RESERVED_OUTPUT_TOKENS = int(os.environ.get("SDM_LLM_RESERVED_OUTPUT_TOKENS", "1500"))
+BATCH_MAX_ITEMS = int(os.environ.get("SDM_BATCH_MAX_ITEMS", "100"))
+
+# On-disk LLM response cache (content-addressed, LRU-evicted)
+LLM_CACHE_PATH = os.path.join(DATA_ROOT, "llm_cache.db")
+LLM_CACHE_MAX_BYTES = int(os.environ.get("SDM_LLM_CACHE_MAX_MB", "64")) * 1024 * 1024
+LLM_CACHE_TTL = int(os.environ.get("SDM_LLM_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+
+# Schema context sent with edit requests: whole schema while it fits the budget,
+# otherwise the tables the instruction touches + FK neighbours, the rest summarized
+LLM_CONTEXT_MAX_TOKENS = int(os.environ.get("SDM_LLM_CONTEXT_MAX_TOKENS", "4000"))
+LLM_CONTEXT_HOPS = int(os.environ.get("SDM_LLM_CONTEXT_HOPS", "1"))
+
+# Parsed schema models memoized by content hash
+SCHEMA_MODEL_CACHE_SIZE = int(os.environ.get("SDM_SCHEMA_MODEL_CACHE_SIZE", "64"))
+MERMAID_CACHE_SIZE = int(os.environ.get("SDM_MERMAID_CACHE_SIZE", "256"))
+
+# Schema lint thresholds
+LINT_WIDE_TABLE_COLUMNS = int(os.environ.get("SDM_LINT_WIDE_TABLE_COLUMNS", "30"))
+LINT_HIGH_FANOUT = int(os.environ.get("SDM_LINT_HIGH_FANOUT", "3"))              # FKs pointing at a table
+LINT_WITHOUT_ROWID_MAX_COLUMNS = int(os.environ.get("SDM_LINT_WITHOUT_ROWID_MAX_COLUMNS", "4"))
+
+# Pooled connections to per-version SQLite DBs
+SQLITE_POOL_SIZE = int(os.environ.get("SDM_SQLITE_POOL_SIZE", "4"))          # connections per db_file
+SQLITE_POOL_MAX_DBS = int(os.environ.get("SDM_SQLITE_POOL_MAX_DBS", "64"))   # db_files with a live pool (LRU)
+SQLITE_POOL_WAIT = float(os.environ.get("SDM_SQLITE_POOL_WAIT", "30"))       # seconds to wait for a free connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": os.environ.get("SDM_SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": int(os.environ.get("SDM_SQLITE_CACHE_SIZE", "-8000")),     # negative = KiB
+    "mmap_size": int(os.environ.get("SDM_SQLITE_MMAP_SIZE", str(64 * 1024 * 1024))),
+    "foreign_keys": "ON",
+}
+
+# Console result sets: page size for /run_query and a hard cap on any page / stream
+QUERY_PAGE_SIZE = int(os.environ.get("SDM_QUERY_PAGE_SIZE", "500"))
+QUERY_MAX_PAGE_SIZE = int(os.environ.get("SDM_QUERY_MAX_PAGE_SIZE", "5000"))
+QUERY_STREAM_MAX_ROWS = int(os.environ.get("SDM_QUERY_STREAM_MAX_ROWS", "1000000"))
+QUERY_STREAM_POLL_SECONDS = float(os.environ.get("SDM_QUERY_STREAM_POLL_SECONDS", "0.02"))  # spool file polling
+
+# Console query governor: per-query budgets (0 = unlimited) and concurrency caps
+QUERY_TIMEOUT = float(os.environ.get("SDM_QUERY_TIMEOUT", "15"))                # wall-clock seconds
+QUERY_MAX_STEPS = int(os.environ.get("SDM_QUERY_MAX_STEPS", "200000000"))       # SQLite VM instructions
+QUERY_STEP_INTERVAL = int(os.environ.get("SDM_QUERY_STEP_INTERVAL", "10000"))   # instructions per progress callback
+QUERY_MAX_PER_USER = int(os.environ.get("SDM_QUERY_MAX_PER_USER", "2"))
+QUERY_MAX_PER_DB = int(os.environ.get("SDM_QUERY_MAX_PER_DB", "4"))
+
+# Read-only console result cache (in the web process, LRU by size)
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("SDM_QUERY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+QUERY_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("SDM_QUERY_CACHE_MAX_ENTRY_BYTES", str(2 * 1024 * 1024)))
+
+# Sandbox processes for console queries and test suites (0 = run on the request thread)
+SQL_PROCESSES = int(os.environ.get("SDM_SQL_PROCESSES", str(min(4, os.cpu_count() or 1))))
+SQL_PROCESS_MAX_TASKS = int(os.environ.get("SDM_SQL_PROCESS_MAX_TASKS", "200"))   # recycle a worker after N jobs
+SQL_PROCESS_MEMORY_MB = int(os.environ.get("SDM_SQL_PROCESS_MEMORY_MB", "2048"))  # RLIMIT_AS per worker, 0 = unlimited
+
+# Test-suite runner: parallel workers over private snapshot copies of the version DB
+TEST_WORKERS = int(os.environ.get("SDM_TEST_WORKERS", "4"))
+TEST_TIMEOUT = float(os.environ.get("SDM_TEST_TIMEOUT", "10"))  # seconds per test
+TEST_SLOWEST_N = int(os.environ.get("SDM_TEST_SLOWEST_N", "5"))   # slowest tests listed in the suite summary
+TEST_SNAPSHOT_DIR = os.environ.get("SDM_TEST_SNAPSHOT_DIR") or None  # where suite snapshot files go (default: system temp)
+
+# Index advisor
+QUERY_HISTORY_SIZE = int(os.environ.get("SDM_QUERY_HISTORY_SIZE", "200"))        # distinct console statements kept per version
+QUERY_HISTORY_FLUSH_SECONDS = float(os.environ.get("SDM_QUERY_HISTORY_FLUSH_SECONDS", "10"))  # in-memory counts -> query_history.json
+ADVISOR_MAX_INDEXES = int(os.environ.get("SDM_ADVISOR_MAX_INDEXES", "10"))
+ADVISOR_ASSUMED_ROWS = int(os.environ.get("SDM_ADVISOR_ASSUMED_ROWS", "1000"))   # table size assumed for empty/small tables
+ADVISOR_TIMING_RUNS = int(os.environ.get("SDM_ADVISOR_TIMING_RUNS", "3"))
+
+# Background version-creation jobs
+JOB_WORKERS = int(os.environ.get("SDM_JOB_WORKERS", "4"))
+JOB_HISTORY = int(os.environ.get("SDM_JOB_HISTORY", "500"))  # finished jobs kept for polling
+JOB_STORE_PATH = os.path.join(DATA_ROOT, "jobs.db")           # job state + events, shared by all worker processes
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("SDM_JOB_HEARTBEAT_SECONDS", "5"))
+JOB_ORPHAN_SECONDS = float(os.environ.get("SDM_JOB_ORPHAN_SECONDS", "30"))     # no heartbeat for this long: failed
+JOB_POLL_SECONDS = float(os.environ.get("SDM_JOB_POLL_SECONDS", "0.25"))       # event polling for jobs run elsewhere
+
+# Cold-version archival (interval 0 disables the background archiver)
+ARCHIVE_INTERVAL = float(os.environ.get("SDM_ARCHIVE_INTERVAL", "3600"))        # seconds between passes
+ARCHIVE_AFTER_DAYS = float(os.environ.get("SDM_ARCHIVE_AFTER_DAYS", "7"))       # idle days before compressing
+VACUUM_IDLE_SECONDS = float(os.environ.get("SDM_VACUUM_IDLE_SECONDS", "3600"))  # idle time before VACUUM
+
+# Metrics: /metrics (Prometheus text), optional Server-Timing on every response
+# without SDM_METRICS_TOKEN only loopback clients may scrape; set a token behind a reverse proxy
+METRICS_TOKEN = os.environ.get("SDM_METRICS_TOKEN", "")            # bearer token required by /metrics if set
+METRICS_MAX_DB_LABELS = int(os.environ.get("SDM_METRICS_MAX_DB_LABELS", "200"))
+SERVER_TIMING = os.environ.get("SDM_SERVER_TIMING", "0") == "1"      # else per request via X-SDM-Server-Timing: 1
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET", "change-me-in-prod")
 app.config['DEBUG'] = True
 # SQLite app database (for users/projects metadata)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(BASE_DIR, "app.db")
+APP_DB_PATH = os.environ.get("SDM_APP_DB", os.path.join(BASE_DIR, "app.db"))
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + APP_DB_PATH
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db = SQLAlchemy(app)
-llm = ChatOpenAI(model="gpt-4o-mini")
+
+# ---------- Lazy heavy imports ----------
+# langchain/sqlglot are only loaded when first used, so worker boot, CLI commands
+# and sandbox processes don't pay for them (see warmup() for pre-fork loading).
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+exp = _LazyModule("sqlglot.expressions")
+
+def parse_one(sql, **kwargs):
+    from sqlglot import parse_one as _parse_one
+    return _parse_one(sql, **kwargs)
+
+def chat_prompt(messages):
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_messages(messages)
+
+llm = None  # chat model, built by get_llm() on first use; assign to substitute another runnable
+_llm_lock = threading.Lock()
+
+def get_llm():
+    global llm
+    if llm is None:
+        with _llm_lock:
+            if llm is None:
+                llm = _build_llm()
+    return llm
+
+def _build_llm():
+    global llm_fixtures
+    if LLM_BACKEND not in ("openai", "record", "replay"):
+        raise ValueError(f"unknown SDM_LLM_BACKEND {LLM_BACKEND!r} (expected openai, record or replay)")
+    if LLM_BACKEND == "replay":
+        llm_fixtures = LLMFixtureStore(LLM_FIXTURES_PATH)
+        return replay_backend(llm_fixtures)
+    from langchain_openai import ChatOpenAI
+    model = ChatOpenAI(model=LLM_MODEL, stream_usage=True)  # token counts for streamed calls too
+    if LLM_BACKEND == "record":
+        llm_fixtures = LLMFixtureStore(LLM_FIXTURES_PATH)
+        return record_backend(model, llm_fixtures)
+    return model
+
+# ---------- LLM record / replay ----------
+# Fixtures are one JSON object per line: {"key", "system_key", "content", "usage",
+# "latency_ms", ...}. The key hashes (model, system prompt, normalized user input)
+# like the response cache; system_key hashes the system prompt alone, which is
+# what identifies the kind of call (schema, tests, utility docs, edits).
+class LLMReplayMiss(RuntimeError):
+    pass
+
+llm_fixtures = None  # LLMFixtureStore behind the record/replay backend, if one is active
+
+class LLMFixtureStore:
+    def __init__(self, path):
+        self.path = path
+        self.by_key = {}
+        self.by_system = {}
+        self.hits = 0
+        self.fallbacks = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for n, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        self._add(json.loads(line))
+                    except (ValueError, KeyError) as e:
+                        print(f"Warning: skipping bad LLM fixture {path}:{n}: {e}")
+
+    def _add(self, fixture):
+        if fixture["key"] not in self.by_key:
+            self.by_system.setdefault(fixture["system_key"], []).append(fixture)
+        self.by_key[fixture["key"]] = fixture
+
+    @staticmethod
+    def prompt_parts(prompt_value):
+        messages = prompt_value.to_messages() if hasattr(prompt_value, "to_messages") else prompt_value
+        system = "\n".join(m.content for m in messages if m.type == "system")
+        user = "\n".join(m.content for m in messages if m.type != "system")
+        return system, user
+
+    @staticmethod
+    def keys(system, user):
+        return (LLMResponseCache.make_key(LLM_MODEL, system, user),
+                hashlib.sha256(system.encode("utf-8")).hexdigest())
+
+    def lookup(self, system, user):
+        key, system_key = self.keys(system, user)
+        with self._lock:
+            fixture = self.by_key.get(key)
+            if fixture is not None:
+                self.hits += 1
+                return key, fixture
+            candidates = self.by_system.get(system_key) if LLM_REPLAY_FALLBACK else None
+            if candidates:
+                # deterministic: the same unseen input always gets the same stand-in
+                self.fallbacks += 1
+                return key, candidates[int(key, 16) % len(candidates)]
+            self.misses += 1
+        raise LLMReplayMiss(f"no recorded LLM response for this prompt ({system[:60]!r}...) in {self.path}")
+
+    def record(self, system, user, content, usage, latency_ms):
+        key, system_key = self.keys(system, user)
+        fixture = {"key": key, "system_key": system_key, "model": LLM_MODEL,
+                   "system": system[:200], "input": user[:200],  # previews, for people reading the file
+                   "content": content, "usage": dict(usage or {}), "latency_ms": round(latency_ms, 1),
+                   "recorded_at": datetime.datetime.utcnow().isoformat()}
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(fixture) + "\n")
+            self._add(fixture)
+            self.recorded += 1
+
+    def stats(self):
+        with self._lock:
+            return {"fixtures": len(self.by_key), "prompts": len(self.by_system), "hits": self.hits,
+                    "fallbacks": self.fallbacks, "misses": self.misses, "recorded": self.recorded}
+
+def _replay_delay(fixture, key):
+    base = fixture.get("latency_ms", 0) if LLM_REPLAY_LATENCY_MS < 0 else LLM_REPLAY_LATENCY_MS
+    jitter = random.Random(key).uniform(0, LLM_REPLAY_JITTER_MS) if LLM_REPLAY_JITTER_MS > 0 else 0
+    return max(0.0, base + jitter) / 1000
+
+def replay_backend(store, chunks=20):
+    """Runnable answering from `store`; the response streams in ~`chunks` pieces spread over the replay latency."""
+    from langchain_core.messages import AIMessageChunk
+    from langchain_core.runnables import RunnableGenerator
+
+    def replay(inputs):
+        for prompt_value in inputs:
+            system, user = store.prompt_parts(prompt_value)
+            key, fixture = store.lookup(system, user)
+            content = fixture["content"]
+            size = max(1, -(-len(content) // chunks))
+            pieces = [content[i:i + size] for i in range(0, len(content), size)] or [""]
+            pause = _replay_delay(fixture, key) / len(pieces)
+            for piece in pieces:
+                time.sleep(pause)
+                yield AIMessageChunk(content=piece)
+            usage = fixture.get("usage") or {}
+            if not usage:
+                prompt_tokens, output_tokens = estimate_tokens(system + user), estimate_tokens(content)
+                usage = {"input_tokens": prompt_tokens, "output_tokens": output_tokens,
+                         "total_tokens": prompt_tokens + output_tokens}
+            yield AIMessageChunk(content="", usage_metadata=usage)
+
+    return RunnableGenerator(replay, name="llm_replay")
+
+def record_backend(model, store):
+    """Runnable passing every call through to `model` (streamed) and appending the exchange to `store`."""
+    from langchain_core.runnables import RunnableGenerator
+
+    def record(inputs):
+        for prompt_value in inputs:
+            started = time.perf_counter()
+            message = None
+            for chunk in model.stream(prompt_value):
+                message = chunk if message is None else message + chunk
+                yield chunk
+            if message is not None:
+                system, user = store.prompt_parts(prompt_value)
+                store.record(system, user, message.content, getattr(message, "usage_metadata", None),
+                             (time.perf_counter() - started) * 1000)
+
+    return RunnableGenerator(record, name="llm_record")
 
 # ---------- SQLAlchemy models ----------
 class User(db.Model):
@@ -58,9 +359,23 @@ class Version(db.Model):
     mermaid_file = db.Column(db.String(512))
     db_file = db.Column(db.String(512))
 
-# Create DB tables if not present
-with app.app_context():
-    db.create_all()
+_db_ready = False
+
+def init_db(force=False):
+    """Creates the metadata tables; without force only when app.db doesn't exist yet."""
+    global _db_ready
+    if force or not os.path.exists(APP_DB_PATH):
+        with app.app_context():
+            db.create_all()
+            # no pooled connection may survive into forked workers (gunicorn --preload)
+            db.engine.dispose()
+    _db_ready = True
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the users/projects/versions tables (run once per deployment)."""
+    init_db(force=True)
+    print("Initialized", APP_DB_PATH)
 
 # ---------- Helpers ----------
 def login_required(f):
@@ -86,6 +401,151 @@ def version_dir(user_id, project_id, version_name):
     os.makedirs(p, exist_ok=True)
     return p
 
+# ---------- Metrics ----------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class MetricsRegistry:
+    """
+    In-process counters and latency histograms keyed by (name, labels),
+    rendered in the Prometheus text format. Collectors add gauges computed
+    at scrape time (cache sizes, limiter state, ...).
+    """
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def capped_label(self, values, label, limit):
+        # keeps a label's cardinality bounded: past `limit` distinct values new ones become "other"
+        with self._lock:
+            if label not in values:
+                if len(values) >= limit:
+                    return "other"
+                values.add(label)
+        return label
+
+    def collector(self, fn):
+        # fn() -> [(name, labels dict, value)] sampled on every scrape as gauges
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+                        for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                          for k, h in self._histograms.items()}
+        gauges = {}
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    gauges[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                print("Warning: metrics collector failed:", e)
+        lines, seen = [], set()
+        def header(name, default_kind):
+            if name not in seen:
+                seen.add(name)
+                kind, text = self._help.get(name, (default_kind, name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in sorted(histograms.items()):
+            header(name, "histogram")
+            for bound, n in zip(LATENCY_BUCKETS, hist["buckets"]):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {n}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {hist['count']}")
+            lines.append(f"{name}_sum{self._labels(labels)} {round(hist['sum'], 6)}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist['count']}")
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("sdm_http_request_seconds", "histogram", "Request latency by endpoint, method and status.")
+metrics.describe("sdm_stage_seconds", "histogram", "Latency of pipeline stages and instrumented functions.")
+metrics.describe("sdm_llm_request_seconds", "histogram", "LLM call latency (one attempt).")
+metrics.describe("sdm_llm_requests_total", "counter", "LLM call attempts by outcome (ok, error, rate_limited).")
+metrics.describe("sdm_llm_tokens_total", "counter", "LLM tokens reported by the provider, by type (prompt, completion).")
+metrics.describe("sdm_sqlite_query_seconds", "histogram", "Console query / test-suite time per version DB.")
+metrics.describe("sdm_sqlite_queries_total", "counter", "Console queries / test suites per version DB and outcome.")
+metrics.describe("sdm_cache_hits_total", "counter", "Cache hits (llm response cache, console result cache).")
+metrics.describe("sdm_cache_misses_total", "counter", "Cache misses (llm response cache, console result cache).")
+metrics.describe("sdm_cache_entries", "gauge", "Entries currently held per cache.")
+metrics.describe("sdm_cache_bytes", "gauge", "Bytes currently held per cache.")
+metrics.describe("sdm_llm_rate_limited_total", "counter", "Provider 429s seen by the LLM rate limiter.")
+metrics.describe("sdm_llm_rate_limit_wait_seconds_total", "counter", "Time spent waiting on the LLM rate limiter.")
+metrics.describe("sdm_llm_rate_factor", "gauge", "Current LLM rate limiter throttle factor (1.0 = configured rate).")
+metrics.describe("sdm_jobs_running", "gauge", "Background jobs not yet finished.")
+metrics.describe("sdm_llm_fixture_lookups_total", "counter", "Record/replay LLM backend: fixture hits, fallbacks, misses and recordings.")
+
+_db_labels = set()  # guarded by the registry lock (capped_label)
+
+def db_label(db_file):
+    # keyed hash of the version dir, so scrapes don't list user/project ids but a DB
+    # keeps the same label in every worker; capped so label cardinality stays bounded
+    if not db_file:
+        return "none"
+    path = os.path.relpath(os.path.dirname(os.path.abspath(db_file)), DATA_ROOT)
+    label = hmac.new(app.secret_key.encode("utf-8"), path.encode("utf-8"), hashlib.sha256).hexdigest()[:12]
+    return metrics.capped_label(_db_labels, label, METRICS_MAX_DB_LABELS)
+
+def _server_timing_enabled():
+    return has_request_context() and (SERVER_TIMING or request.headers.get("X-SDM-Server-Timing") == "1")
+
+@contextmanager
+def timed(stage, metric="sdm_stage_seconds", **labels):
+    """Observes the block's duration under `stage`; also adds it to the request's Server-Timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(metric, elapsed, stage=stage, **labels)
+        if _server_timing_enabled():
+            g.setdefault("server_timing", []).append((stage, elapsed))
+
+def instrumented(stage):
+    def decorate(fn):
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return inner
+    return decorate
+
 # Safe sqlite connector factory for version DBs
 import sqlite3
 def get_sqlite_conn(db_path):
@@ -93,20 +553,392 @@ def get_sqlite_conn(db_path):
     conn.execute("PRAGMA foreign_keys = ON;")
     return conn
 
+class SQLitePool:
+    """
+    Bounded pool of connections to one version DB. Each connection gets the
+    SQLITE_PRAGMAS (WAL journaling, cache/mmap sizes, ...) once when it is
+    opened; a checked-out connection belongs to one thread until returned.
+    `generation` is the DB file generation the connections were opened at.
+    """
+    def __init__(self, db_path, size=SQLITE_POOL_SIZE, generation=0):
+        self.db_path = db_path
+        self.generation = generation
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        for name, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=SQLITE_POOL_WAIT):
+            raise sqlite3.OperationalError(f"no free connection for {os.path.basename(self.db_path)} after {SQLITE_POOL_WAIT}s")
+        conn = None
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        finally:
+            if conn is not None:
+                self._release(conn)
+            self._slots.release()
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if not self.closed:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+_sqlite_pools = OrderedDict()
+_sqlite_pools_lock = threading.Lock()
+DB_GENERATION_FILENAME = ".db_generation"
+
+def db_generation(db_path):
+    # bumped whenever the file behind db_path is replaced or removed (archive,
+    # rehydrate, a new version created at a deleted one's path); read on every
+    # checkout so pools in other processes (sandbox workers, gunicorn workers) notice
+    try:
+        with open(os.path.join(os.path.dirname(db_path), DB_GENERATION_FILENAME)) as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def bump_db_generation(db_path):
+    # time-based so a version recreated at a deleted one's path never repeats its value
+    generation = max(db_generation(db_path) + 1, time.time_ns())
+    replace_file(os.path.join(os.path.dirname(db_path), DB_GENERATION_FILENAME), str(generation))
+    close_sqlite_pool(db_path)
+    return generation
+
+def sqlite_connection(db_path):
+    """Context manager handing out a pooled connection to a version DB."""
+    key = os.path.abspath(db_path)
+    generation = db_generation(key)
+    evicted = []
+    with _sqlite_pools_lock:
+        pool = _sqlite_pools.get(key)
+        if pool is not None and pool.generation != generation:
+            evicted.append(pool)
+            pool = None
+        if pool is None:
+            pool = _sqlite_pools[key] = SQLitePool(key, generation=generation)
+        _sqlite_pools.move_to_end(key)
+        while len(_sqlite_pools) > SQLITE_POOL_MAX_DBS:
+            evicted.append(_sqlite_pools.popitem(last=False)[1])
+    # connections still checked out from an evicted or stale pool are closed when they come back
+    for old in evicted:
+        old.close()
+    return pool.connection()
+
+def close_sqlite_pool(db_path):
+    # drop pooled connections before a version DB is deleted, moved or rebuilt
+    if not db_path:
+        return
+    with _sqlite_pools_lock:
+        pool = _sqlite_pools.pop(os.path.abspath(db_path), None)
+    if pool is not None:
+        pool.close()
+
+class LLMRateLimiter:
+    """
+    Token buckets for requests/min and tokens/min shared by every LLM call in
+    the process. acquire() blocks until both buckets cover the call. A 429
+    pauses all callers (Retry-After when given) and halves the effective
+    rate; each success wins back a little of it.
+    """
+    def __init__(self, requests_per_min=LLM_REQUESTS_PER_MIN, tokens_per_min=LLM_TOKENS_PER_MIN):
+        self.rpm = requests_per_min
+        self.tpm = tokens_per_min
+        self.factor = 1.0               # adaptive share of the configured rate
+        self._requests = requests_per_min
+        self._tokens = tokens_per_min
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self.calls = 0
+        self.rate_limited = 0
+        self.waited = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self._refilled
+        self._refilled = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm * self.factor / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm * self.factor / 60)
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    short_r = (1 - self._requests) if self.rpm else 0
+                    short_t = (tokens - self._tokens) if self.tpm else 0
+                    if short_r <= 0 and short_t <= 0:
+                        if self.rpm:
+                            self._requests -= 1
+                        self._tokens -= tokens
+                        self.calls += 1
+                        self.waited += now - started
+                        return tokens
+                    wait = max(short_r * 60 / (self.rpm * self.factor) if short_r > 0 else 0,
+                               short_t * 60 / (self.tpm * self.factor) if short_t > 0 else 0)
+                self._cond.wait(min(wait, 5.0))
+
+    def settle(self, reserved, used):
+        # give back (or charge) the difference once the real token count is known
+        if self.tpm and used is not None:
+            with self._cond:
+                self._tokens = min(self.tpm, self._tokens + reserved - used)
+                self._cond.notify_all()
+
+    def record_success(self):
+        with self._cond:
+            self.factor = min(1.0, self.factor + 0.05)
+
+    def penalize(self, retry_after=None):
+        with self._cond:
+            self.rate_limited += 1
+            self.factor = max(0.1, self.factor / 2)
+            pause = retry_after if retry_after else 60 / max(self.rpm or 60, 1) * 2
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            return pause
+
+    def stats(self):
+        with self._cond:
+            return {"calls": self.calls, "rate_limited": self.rate_limited, "waited_seconds": round(self.waited, 3),
+                    "rate_factor": round(self.factor, 3), "requests_per_min": self.rpm, "tokens_per_min": self.tpm}
+
+llm_limiter = LLMRateLimiter()
+
+def _rate_limit_retry_after(exc):
+    """Seconds to back off if exc is a provider 429 (0 when it gives no hint), else None."""
+    status = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    if status != 429 and "RateLimit" not in type(exc).__name__ and "429" not in str(exc):
+        return None
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def invoke_with_retry(chain, inputs, retries=None, backoff=None, prompt_tokens=None):
+    # retry transient LLM failures with exponential backoff (+ a little jitter);
+    # every attempt waits for the shared rate limiter first
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    backoff = LLM_RETRY_BACKOFF if backoff is None else backoff
+    if prompt_tokens is None:
+        prompt_tokens = sum(estimate_tokens(str(v)) for v in inputs.values())
+    attempt = 0
+    while True:
+        with timed("llm_rate_limit_wait"):
+            reserved = llm_limiter.acquire(prompt_tokens + LLM_RESERVED_OUTPUT_TOKENS)
+        started = time.perf_counter()
+        try:
+            response = chain.invoke(inputs)
+        except Exception as e:
+            metrics.observe("sdm_llm_request_seconds", time.perf_counter() - started)
+            llm_limiter.settle(reserved, 0)
+            retry_after = _rate_limit_retry_after(e)
+            metrics.inc("sdm_llm_requests_total", outcome="error" if retry_after is None else "rate_limited")
+            if retry_after is not None:
+                retry_after = llm_limiter.penalize(retry_after)
+            if attempt >= retries or isinstance(e, LLMReplayMiss):
+                raise
+            delay = backoff * (2 ** attempt)
+            delay += random.uniform(0, delay * 0.1)
+            delay = max(delay, retry_after or 0)
+            print(f"LLM call failed ({e}); retry {attempt + 1}/{retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+        elapsed = time.perf_counter() - started
+        metrics.observe("sdm_llm_request_seconds", elapsed)
+        metrics.inc("sdm_llm_requests_total", outcome="ok")
+        if _server_timing_enabled():
+            g.setdefault("server_timing", []).append(("llm", elapsed))
+        usage = getattr(response, "usage_metadata", None) or {}
+        if usage:
+            metrics.inc("sdm_llm_tokens_total", usage.get("input_tokens", 0), type="prompt")
+            metrics.inc("sdm_llm_tokens_total", usage.get("output_tokens", 0), type="completion")
+        llm_limiter.settle(reserved, usage.get("total_tokens"))
+        llm_limiter.record_success()
+        return response
+
+# ---------- LLM response cache ----------
+class LLMResponseCache:
+    """
+    SQLite-backed cache of raw LLM responses, keyed by a hash of
+    (model, system prompt, normalized user input). Entries expire after `ttl`
+    seconds and the least recently used ones are evicted once the stored
+    responses exceed `max_bytes`.
+    """
+    def __init__(self, path, max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL,
+                size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model, system_prompt, user_text):
+        normalized = " ".join((user_text or "").split()).lower()
+        payload = "\x1f".join([model or "", system_prompt or "", normalized])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            conn = self._db()
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_access) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (key, model, response, size, now, now))
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+            if total > self.max_bytes:
+                victims = []
+                for victim_key, victim_size in conn.execute(
+                        "SELECT key, size FROM llm_cache ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((victim_key,))
+                    total -= victim_size
+                conn.executemany("DELETE FROM llm_cache WHERE key = ?", victims)
+            conn.commit()
+
+    def discard(self, key):
+        with self._lock:
+            self._db().execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": entries, "bytes": size, "max_bytes": self.max_bytes, "ttl": self.ttl}
+
+llm_cache = LLMResponseCache(LLM_CACHE_PATH)
+
+class StreamingCall:
+    """
+    Wraps a chain so invoke() streams: each chunk's text goes to on_token as it
+    arrives and the merged message is returned. on_token(None) marks the start
+    of an attempt, so consumers can drop partial output when a call is retried.
+    """
+    def __init__(self, chain, on_token):
+        self.chain = chain
+        self.on_token = on_token
+
+    def invoke(self, inputs):
+        self.on_token(None)
+        message = None
+        for chunk in self.chain.stream(inputs):
+            message = chunk if message is None else message + chunk
+            if chunk.content:
+                self.on_token(chunk.content)
+        if message is None:
+            raise RuntimeError("empty response stream")
+        return message
+
+def ask_llm(system_prompt, user_text, parse=None, use_cache=True, on_token=None):
+    """
+    Sends one system+user exchange to the model and returns parse(content)
+    (or the raw content). Responses are cached only once they parse, so a
+    malformed answer is never replayed; use_cache=False skips the lookup but
+    still refreshes the stored entry. With on_token the response is streamed
+    to it chunk by chunk (a cache hit arrives as one chunk).
+    """
+    parse = parse or (lambda content: content)
+    key = LLMResponseCache.make_key(LLM_MODEL, system_prompt, user_text)
+    if use_cache:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            try:
+                result = parse(cached)
+                if on_token:
+                    on_token(None)
+                    on_token(cached)
+                return result
+            except Exception:
+                llm_cache.discard(key)
+    # user text goes in as a variable so braces in SQL/JSON aren't read as template fields
+    prompt = chat_prompt([("system", system_prompt), ("user", "{input}")])
+    chain = prompt | get_llm()
+    response = invoke_with_retry(StreamingCall(chain, on_token) if on_token else chain, {"input": user_text},
+                                 prompt_tokens=estimate_tokens(system_prompt) + estimate_tokens(user_text))
+    result = parse(response.content)
+    llm_cache.put(key, LLM_MODEL, response.content)
+    return result
+
 # ---------- Reused original LLM/SQL functions (adapted to be inside this file) ----------
-def generate_schema_and_diagram(prompt_text):
+def generate_schema_and_diagram(prompt_text, use_cache=True, on_token=None):
     print(f"Generating for prompt: {prompt_text}")
-    generation_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are a database design assistant. You must generate BOTH a complete SQL schema and a valid Mermaid.js ERD diagram. Respond with the SQL first, then the Mermaid.js code inside a 'mermaid' code block.Always generate SQL compatible with SQLite. Use INTEGER PRIMARY KEY AUTOINCREMENT instead of AUTO_INCREMENT. Do not use MySQL-specific syntax."),
-        ("user", f"Generate a database model for the following concept: {prompt_text}")
-    ])
-    chain = generation_prompt | llm
-    try:
-        response = chain.invoke({"prompt": prompt_text})
-        content = response.content
+    system_prompt = "You are a database design assistant. You must generate BOTH a complete SQL schema and a valid Mermaid.js ERD diagram. Respond with the SQL first, then the Mermaid.js code inside a 'mermaid' code block.Always generate SQL compatible with SQLite. Use INTEGER PRIMARY KEY AUTOINCREMENT instead of AUTO_INCREMENT. Do not use MySQL-specific syntax."
+
+    def parse_response(content):
         sql_schema = content.split("```sql")[1].split("```")[0].strip()
         mermaid_code = content.split("```mermaid")[1].split("```")[0].strip()
         return sql_schema, mermaid_code
+
+    try:
+        return ask_llm(system_prompt, f"Generate a database model for the following concept: {prompt_text}",
+                       parse=parse_response, use_cache=use_cache, on_token=on_token)
     except Exception as e:
         print(f"Error generating schema: {e}")
         return f"Error: {e}", "graph TD\n    Error[Error generating diagram]"
@@ -142,6 +974,179 @@ import re
 
 import re
 
+# ---------- Schema model (one sqlglot pass, shared by every consumer) ----------
+_TABLE_OPTIONS_RE = re.compile(r"\)\s*((?:WITHOUT\s+ROWID|STRICT)(?:\s*,\s*(?:WITHOUT\s+ROWID|STRICT))*)\s*;?\s*$", re.I)
+_CREATE_TABLE_NAME_RE = re.compile(
+    r"^\s*CREATE\s+(?:TEMP(?:ORARY)?\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?:[`\"\[]?\w+[`\"\]]?\.)?[`\"\[]?(\w+)", re.I)
+_CREATE_TRIGGER_RE = re.compile(r"^\s*CREATE\s+(?:TEMP(?:ORARY)?\s+)?TRIGGER\b", re.I)
+
+_schema_models = OrderedDict()
+_schema_models_lock = threading.Lock()
+
+def _split_statements(sql_text):
+    # statement spans (start, end) in the source; a ";" only ends a statement where
+    # sqlite3.complete_statement agrees, so semicolons inside strings, comments and
+    # CREATE TRIGGER ... BEGIN ... END bodies don't split it
+    spans = []
+    start = 0
+    for end in [m.end() for m in re.finditer(";", sql_text)] + [len(sql_text)]:
+        chunk = sql_text[start:end]
+        if end < len(sql_text) and not sqlite3.complete_statement(chunk):
+            continue
+        if chunk.strip().strip(";").strip():
+            lead = len(chunk) - len(chunk.lstrip())
+            spans.append((start + lead, start + len(chunk.rstrip())))
+        start = end
+    return spans
+
+def _names(node):
+    return [i.name for i in (node.expressions if node is not None else [])]
+
+def _reference(ref):
+    target = ref.this  # Schema(Table, [cols]) or bare Table
+    if isinstance(target, exp.Schema):
+        return target.this.name, _names(target)
+    return target.name, []
+
+# SQLite type name: identifiers, optionally followed by (n) or (n, m)
+_DECLARED_TYPE_RE = re.compile(
+    r"\s*((?:[A-Za-z_]\w*)(?:\s+(?!(?:CONSTRAINT|PRIMARY|NOT|NULL|UNIQUE|CHECK|DEFAULT|COLLATE|REFERENCES|"
+    r"GENERATED|AS)\b)[A-Za-z_]\w*)*(?:\s*\([^()]*\))?)", re.IGNORECASE)
+
+def _declared_type(item, kind, sql):
+    # the type as written in the DDL; sqlglot normalizes it (INT8 -> TINYINT, NVARCHAR -> VARCHAR, ...)
+    end = item.this.meta.get("end") if isinstance(item.this, exp.Identifier) else None
+    if end is not None:
+        m = _DECLARED_TYPE_RE.match(sql, end + 1)
+        if m:
+            return " ".join(m.group(1).split())
+    return kind.sql() if kind is not None else ""
+
+def _model_table(expr, sql, span, options):
+    table = {"name": expr.this.this.name, "columns": [], "primary_key": [], "foreign_keys": [],
+             "unique": [], "without_rowid": "ROWID" in options.upper(), "sql": sql, "span": span,
+             "expression": expr, "error": None}
+    for item in expr.this.expressions:
+        inner = item.expressions if isinstance(item, exp.Constraint) else [item]
+        if isinstance(item, exp.Identifier):
+            table["columns"].append({"name": item.name, "type": "", "base_type": "", "pk": False,
+                                     "not_null": False, "unique": False, "autoincrement": False})
+            continue
+        if isinstance(item, exp.ColumnDef):
+            kind = item.args.get("kind")
+            col_type = _declared_type(item, kind, sql) if kind is not None else ""
+            col = {"name": item.name, "type": col_type, "base_type": col_type.split("(")[0].strip().upper(),
+                   "pk": False, "not_null": False, "unique": False, "autoincrement": False}
+            for c in item.constraints:
+                k = c.args.get("kind")
+                if isinstance(k, exp.PrimaryKeyColumnConstraint):
+                    col["pk"] = True
+                    table["primary_key"].append(item.name)
+                elif isinstance(k, exp.AutoIncrementColumnConstraint):
+                    col["autoincrement"] = True
+                elif isinstance(k, exp.NotNullColumnConstraint) and not k.args.get("allow_null"):
+                    col["not_null"] = True
+                elif isinstance(k, exp.UniqueColumnConstraint):
+                    col["unique"] = True
+                    table["unique"].append([item.name])
+                elif isinstance(k, exp.Reference):
+                    ref_table, ref_cols = _reference(k)
+                    table["foreign_keys"].append({"columns": [item.name], "ref_table": ref_table, "ref_columns": ref_cols})
+            table["columns"].append(col)
+            continue
+        for c in inner:
+            if isinstance(c, exp.PrimaryKey):
+                table["primary_key"].extend(i.name for i in c.expressions)
+            elif isinstance(c, exp.UniqueColumnConstraint):
+                table["unique"].append(_names(c.this))
+            elif isinstance(c, exp.ForeignKey):
+                ref = c.args.get("reference")
+                ref_table, ref_cols = _reference(ref) if ref is not None else ("", [])
+                table["foreign_keys"].append({"columns": _names(c), "ref_table": ref_table, "ref_columns": ref_cols})
+    for col in table["columns"]:
+        col["pk"] = col["pk"] or col["name"] in table["primary_key"]
+    return table
+
+def _model_index(expr, sql, span):
+    params = expr.this.args.get("params")
+    columns = []
+    for ordered in (params.args.get("columns") or [] if params is not None else []):
+        node = ordered.this if isinstance(ordered, exp.Ordered) else ordered
+        columns.append(node.name if isinstance(node, exp.Column) else node.sql(dialect="sqlite"))
+    table = expr.this.args.get("table")
+    return {"name": expr.this.name, "table": table.name if table is not None else "", "columns": columns,
+            "unique": bool(expr.args.get("unique")), "sql": sql, "span": span}
+
+def _build_schema_model(sql_text):
+    model = {"tables": [], "indexes": [], "statements": [], "errors": []}
+    for span in _split_statements(sql_text):
+        sql = sql_text[span[0]:span[1]]
+        statement = {"sql": sql, "span": span, "kind": None, "error": None}
+        model["statements"].append(statement)
+        if _CREATE_TRIGGER_RE.match(sql):
+            # sqlglot can't parse trigger bodies; SQLite checks them when the DDL runs
+            statement["kind"] = "TRIGGER"
+            continue
+        # sqlglot doesn't know SQLite's table options; strip them and remember them
+        options = ""
+        m = _TABLE_OPTIONS_RE.search(sql)
+        parse_sql = sql
+        if m and _CREATE_TABLE_NAME_RE.match(sql):
+            options = m.group(1)
+            parse_sql = sql[:m.start(1)]
+        try:
+            expr = parse_one(parse_sql, read="sqlite")
+            if isinstance(expr, exp.Command):
+                raise ValueError("unsupported syntax")
+        except Exception as e:
+            statement["error"] = f"{e}"
+            model["errors"].append({"sql": sql, "span": span, "error": statement["error"]})
+            name = _CREATE_TABLE_NAME_RE.match(sql)
+            if name:
+                # keep the table visible to splitters even though its columns are unknown
+                statement["kind"] = "TABLE"
+                model["tables"].append({"name": name.group(1), "columns": [], "primary_key": [], "foreign_keys": [],
+                                        "unique": [], "without_rowid": "ROWID" in options.upper(), "sql": sql,
+                                        "span": span, "expression": None, "error": statement["error"]})
+            continue
+        if isinstance(expr, exp.Create):
+            statement["kind"] = expr.kind
+            if expr.kind == "TABLE" and isinstance(expr.this, exp.Schema):
+                model["tables"].append(_model_table(expr, sql, span, options))
+            elif expr.kind == "INDEX":
+                model["indexes"].append(_model_index(expr, sql, span))
+        else:
+            statement["kind"] = expr.key.upper()
+    return model
+
+def schema_hash(sql_text):
+    # content key shared by the schema model, diagram caches and erd.mmd; no parse needed
+    return hashlib.sha256((sql_text or "").encode("utf-8")).hexdigest()
+
+@instrumented("parse_schema")
+def parse_schema(sql_text):
+    """
+    Parses schema text once into a model shared by the Mermaid renderer,
+    check_schema, the utility generator and the CREATE TABLE splitter:
+      {"hash", "tables": [{name, columns, primary_key, foreign_keys, unique,
+        without_rowid, sql, span, expression, error}], "indexes", "statements", "errors"}
+    Models are memoized by content hash; treat them as read-only.
+    """
+    sql_text = sql_text or ""
+    key = schema_hash(sql_text)
+    with _schema_models_lock:
+        model = _schema_models.get(key)
+        if model is not None:
+            _schema_models.move_to_end(key)
+            return model
+    model = _build_schema_model(sql_text)
+    model["hash"] = key
+    with _schema_models_lock:
+        _schema_models[key] = model
+        while len(_schema_models) > SCHEMA_MODEL_CACHE_SIZE:
+            _schema_models.popitem(last=False)
+    return model
+
 def fix_mermaid_relations(mermaid_code):
     lines = mermaid_code.split("\n")
     cleaned = []
@@ -162,499 +1167,2801 @@ def fix_mermaid_relations(mermaid_code):
 
     return "\n".join(cleaned)
 
-def sql_to_mermaid(sql_text):
-    print("\n=== DEBUG: Starting SQL → Mermaid Parsing ===\n")
+MERMAID_TYPE_MAP = {
+    "INTEGER": "int",
+    "TEXT": "string",
+    "REAL": "float",
+    "DATETIME": "datetime",
+}
+
+@instrumented("sql_to_mermaid")
+def sql_to_mermaid(sql_text, model=None):
+    # tracing is opt-in (logging "sdm" at DEBUG); when off the checks below are all it costs
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("=== Starting SQL → Mermaid Parsing ===")
+
+    tables = [t for t in (model or parse_schema(sql_text))["tables"] if t["expression"] is not None]
+
+    if not tables:
+        if debug:
+            logger.debug("No CREATE TABLE statements found.")
+        return "erDiagram\n    ErrorTable {{ string error }}\n    ErrorTable ||--|| ErrorTable : none"
+
+    mermaid = ["erDiagram"]
+    relationships = []
+    seen = set()
+
+    for table in tables:
+        table_name = table["name"]
+        if debug:
+            logger.debug("--- Processing table: %s ---", table_name)
+
+        mermaid.append(f"    {table_name} {{")
+
+        for col in table["columns"]:
+            # Map SQLite types → Mermaid types
+            mermaid_type = MERMAID_TYPE_MAP.get(col["base_type"], "string")
+
+            col_line_out = f"        {mermaid_type} {col['name']}"
+            if col["pk"]:
+                col_line_out += " PK"
+
+            if debug:
+                logger.debug("  ADD column → %s", col_line_out)
+            mermaid.append(col_line_out)
+
+        for fk in table["foreign_keys"]:
+            if not fk["columns"] or not fk["ref_table"]:
+                continue
+            fk_col = fk["columns"][0]
+            if debug:
+                logger.debug("  ADD FK → %s.%s → %s.%s", table_name, fk_col, fk["ref_table"], ",".join(fk["ref_columns"]))
+
+            rel = f"    {table_name} }}o--|| {fk['ref_table']} : {fk_col}"
+            if rel not in seen:
+                seen.add(rel)
+                relationships.append(rel)
+
+        mermaid.append("    }")
+
+    mermaid.extend(relationships)
+
+    if debug:
+        logger.debug("=== Completed Successfully ===")
+
+    st= "\n".join(mermaid)
+    st= fix_mermaid_relations(st)
+    return st
+
+_mermaid_cache = OrderedDict()
+_mermaid_cache_lock = threading.Lock()
+
+@instrumented("render_mermaid")
+def render_mermaid(sql_text):
+    # sql_to_mermaid memoized per schema hash
+    key = schema_hash(sql_text)
+    with _mermaid_cache_lock:
+        if key in _mermaid_cache:
+            _mermaid_cache.move_to_end(key)
+            return _mermaid_cache[key]
+    diagram = sql_to_mermaid(sql_text)
+    with _mermaid_cache_lock:
+        _mermaid_cache[key] = diagram
+        while len(_mermaid_cache) > MERMAID_CACHE_SIZE:
+            _mermaid_cache.popitem(last=False)
+    return diagram
+
+ERD_FILENAME = "erd.mmd"
+_ERD_HEADER = "%% schema-sha256: "
+
+def write_version_erd(v_dir, sql_text):
+    # rendered diagram stored with the version, tagged with the schema hash it came from
+    diagram = render_mermaid(sql_text)
+    # replaced, never rewritten in place: the file may be hardlinked to a shared blob
+    replace_file(os.path.join(v_dir, ERD_FILENAME), f"{_ERD_HEADER}{schema_hash(sql_text)}\n{diagram}")
+    return diagram
+
+def load_version_erd(v_dir, sql_text):
+    """Rendered ER diagram for a version: from erd.mmd when it matches the schema, else rebuilt and stored."""
+    path = os.path.join(v_dir, ERD_FILENAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            header = f.readline().rstrip("\n")
+            if header == f"{_ERD_HEADER}{schema_hash(sql_text)}":
+                return f.read()
+    try:
+        return write_version_erd(v_dir, sql_text)
+    except OSError:
+        return render_mermaid(sql_text)
+
+# ---------- Schema lint rules ----------
+# Each rule gets the parsed schema model and yields (table, message) findings.
+# Rule ids are stable so projects can suppress them (meta.json "suppressed_rules").
+SCHEMA_RULES = []
+
+def schema_rule(rule_id, severity):
+    def register(fn):
+        SCHEMA_RULES.append({"id": rule_id, "severity": severity, "name": fn.__name__, "check": fn})
+        return fn
+    return register
+
+def _tables_by_name(model):
+    return {t["name"].lower(): t for t in model["tables"]}
+
+def _indexes_by_table(model):
+    # declared indexes grouped per table, in schema order
+    grouped = {}
+    for idx in model["indexes"]:
+        grouped.setdefault(idx["table"].lower(), []).append(idx)
+    return grouped
+
+def _is_rowid_pk(table):
+    # only a column declared exactly INTEGER (any case) aliases the rowid; INT, BIGINT
+    # and INTEGER(8) PRIMARY KEY get a separate unique index
+    if table["without_rowid"] or len(table["primary_key"]) != 1:
+        return False
+    col = next((c for c in table["columns"] if c["name"].lower() == table["primary_key"][0].lower()), None)
+    return bool(col) and col["type"].strip().upper() == "INTEGER"
+
+def _key_column_lists(table, indexes):
+    # column lists SQLite can search by: PK, UNIQUE constraints (auto-indexed) and declared indexes
+    lists = []
+    if table["primary_key"]:
+        lists.append([c.lower() for c in table["primary_key"]])
+    lists += [[c.lower() for c in u] for u in table["unique"]]
+    lists += [[c.lower() for c in i["columns"]] for i in indexes.get(table["name"].lower(), ())]
+    return lists
+
+@schema_rule("SDM001", "warning")
+def lowercase_table_names(model):
+    for table in model["tables"]:
+        if not table["name"].islower():
+            yield table["name"], f"Naming Convention: Table '{table['name']}' is not in lowercase."
+
+@schema_rule("SDM002", "error")
+def missing_primary_key(model):
+    for table in model["tables"]:
+        if not table["error"] and not table["primary_key"]:
+            yield table["name"], f"Missing Primary Key: Table '{table['name']}' does not have a PRIMARY KEY defined."
+
+@schema_rule("SDM003", "error")
+def dangling_foreign_key(model):
+    tables = _tables_by_name(model)
+    for table in model["tables"]:
+        for fk in table["foreign_keys"]:
+            if fk["ref_table"].lower() not in tables:
+                yield table["name"], f"Invalid Foreign Key: Table '{table['name']}' has a FOREIGN KEY that references a non-existent table '{fk['ref_table']}'."
+
+@schema_rule("PERF001", "warning")
+def unindexed_foreign_key(model):
+    # SQLite never indexes FK columns itself: joins from the parent and ON DELETE checks scan the child
+    indexes = _indexes_by_table(model)
+    for table in model["tables"]:
+        keys = _key_column_lists(table, indexes)
+        for fk in table["foreign_keys"]:
+            cols = [c.lower() for c in fk["columns"]]
+            if cols and not any(k[:len(cols)] == cols for k in keys):
+                yield table["name"], (f"Unindexed Foreign Key: '{table['name']}({', '.join(fk['columns'])})' references "
+                                      f"'{fk['ref_table']}' but no index starts with those columns; joins and parent deletes will scan '{table['name']}'.")
+
+@schema_rule("PERF002", "warning")
+def text_primary_key_high_fanout(model):
+    fanout = {}
+    for table in model["tables"]:
+        for fk in table["foreign_keys"]:
+            fanout[fk["ref_table"].lower()] = fanout.get(fk["ref_table"].lower(), 0) + 1
+    for table in model["tables"]:
+        refs = fanout.get(table["name"].lower(), 0)
+        if len(table["primary_key"]) != 1 or refs < LINT_HIGH_FANOUT:
+            continue
+        col = next((c for c in table["columns"] if c["name"].lower() == table["primary_key"][0].lower()), None)
+        if col and col["base_type"] in ("TEXT", "CHAR", "VARCHAR", "NVARCHAR", "CLOB"):
+            yield table["name"], (f"Text Primary Key: '{table['name']}.{col['name']}' is {col['type']} and referenced by {refs} foreign keys; "
+                                  f"every referencing row and index stores the full string. Prefer an INTEGER PRIMARY KEY with a UNIQUE text column.")
+
+@schema_rule("PERF003", "info")
+def without_rowid_candidate(model):
+    for table in model["tables"]:
+        if table["error"] or table["without_rowid"] or not table["primary_key"] or _is_rowid_pk(table):
+            continue
+        if any(c["autoincrement"] for c in table["columns"]) or len(table["columns"]) > LINT_WITHOUT_ROWID_MAX_COLUMNS:
+            continue
+        if any(c["base_type"] in ("BLOB", "VARBINARY") for c in table["columns"]):
+            continue
+        yield table["name"], (f"WITHOUT ROWID Candidate: '{table['name']}' has a non-integer primary key "
+                              f"({', '.join(table['primary_key'])}) and small rows; WITHOUT ROWID stores rows in the PK B-tree and drops the separate index.")
+
+@schema_rule("PERF004", "warning")
+def wide_table(model):
+    for table in model["tables"]:
+        if len(table["columns"]) > LINT_WIDE_TABLE_COLUMNS:
+            yield table["name"], (f"Wide Table: '{table['name']}' has {len(table['columns'])} columns (limit {LINT_WIDE_TABLE_COLUMNS}); "
+                                  f"consider splitting rarely used columns into a 1:1 side table.")
+
+@schema_rule("PERF005", "warning")
+def redundant_index(model):
+    tables = _tables_by_name(model)
+    indexes = _indexes_by_table(model)
+    for idx in model["indexes"]:
+        table = tables.get(idx["table"].lower())
+        if not table:
+            continue
+        cols = [c.lower() for c in idx["columns"]]
+        constraint_keys = [[c.lower() for c in table["primary_key"]]] + [[c.lower() for c in u] for u in table["unique"]]
+        if cols in constraint_keys:
+            yield table["name"], f"Redundant Index: '{idx['name']}' duplicates the PRIMARY KEY/UNIQUE constraint on ({', '.join(idx['columns'])})."
+            continue
+        siblings = indexes[idx["table"].lower()]
+        position = next(i for i, other in enumerate(siblings) if other is idx)
+        for i, other in enumerate(siblings):
+            if other is idx:
+                continue
+            other_cols = [c.lower() for c in other["columns"]]
+            if other_cols == cols and i < position:
+                yield table["name"], f"Duplicate Index: '{idx['name']}' has the same columns as '{other['name']}'."
+                break
+            if len(other_cols) > len(cols) and other_cols[:len(cols)] == cols and not idx["unique"]:
+                yield table["name"], f"Redundant Index: '{idx['name']}' ({', '.join(idx['columns'])}) is a prefix of '{other['name']}' and adds only write cost."
+                break
+
+@schema_rule("PERF006", "info")
+def needless_autoincrement(model):
+    for table in model["tables"]:
+        for col in table["columns"]:
+            if col["autoincrement"]:
+                yield table["name"], (f"AUTOINCREMENT: '{table['name']}.{col['name']}' uses AUTOINCREMENT, which writes sqlite_sequence on every insert; "
+                                      f"plain INTEGER PRIMARY KEY already assigns unique rowids unless ids must never be reused.")
+
+@instrumented("check_schema")
+def check_schema(sql_schema, suppress=(), model=None):
+    """
+    Static checks over the parsed schema: the SCHEMA_RULES above plus parse
+    errors (SDM000). Findings are {"type": severity, "rule", "table", "message"};
+    rule ids in `suppress` are skipped. Pass `model` to lint an already built
+    (e.g. uncached) schema model.
+    """
+    report = []
+    suppress = {r.upper() for r in suppress or ()}
+    model = model or parse_schema(sql_schema)
+    if not model["statements"]:
+        report.append({"type": "error", "rule": "SDM000", "message": "SQL schema is empty or could not be parsed."})
+        return report
+    if "SDM000" not in suppress:
+        for err in model["errors"]:
+            report.append({"type": "error", "rule": "SDM000", "message": f"Schema Parsing Error: {err['error']}", "sql": err["sql"]})
+    for rule in SCHEMA_RULES:
+        if rule["id"] in suppress:
+            continue
+        try:
+            for table, message in rule["check"](model):
+                report.append({"type": rule["severity"], "rule": rule["id"], "table": table, "message": message})
+        except Exception as e:
+            report.append({"type": "error", "rule": rule["id"], "message": f"Rule {rule['name']} failed: {e}"})
+    if not report:
+        report.append({"type":"success","message":"All static checks passed!"})
+    return report
+
+def generate_test_suite(sql_schema, use_cache=True):
+    print("Generating test suite with rationales...")
+    system_prompt = """
+You are a database test case generator. Given a SQL schema, you must generate a JSON array of test transactions.
+Each object in the array must have **four** keys:
+Always generate SQL compatible with SQLite. Use INTEGER PRIMARY KEY AUTOINCREMENT instead of AUTO_INCREMENT.
+Do not use MySQL-specific syntax.
+1. "name": A short description of the test.
+2. "type": Either 'normal' or 'edge'.
+3. "sql": The full SQL command for the test (e.g., INSERT, UPDATE, SELECT, DELETE).
+4. "rationale": A brief, one-sentence explanation for *why* this test is important.
+
+Generate at least 5 normal tests and 5 edge case tests.
+Respond with *only* the JSON array inside a single ```json code block.
+"""
+
+    def parse_response(content):
+        json_response_str = content.split("```json")[1].split("```")[0].strip()
+        return json.loads(json_response_str)
+
+    try:
+        return ask_llm(system_prompt, f"Here is the schema:\n\n{sql_schema}", parse=parse_response, use_cache=use_cache)
+    except Exception as e:
+        print(f"Error generating test suite: {e}")
+        return [{"name":"Error generating test suite","type":"error","sql":str(e),"rationale":"An error occurred during test generation."}]
+
+# ---------- Utility generator (heuristic, can be improved with LLM) ----------
+UTILITY_HEADER = ("# Utility Table\n\n"
+                  "This document explains the purpose of each table and why key attributes exist.\n\n")
+
+def _normalize_ddl(sql):
+    # fingerprint-stable form of a CREATE TABLE block: no quoting, case or whitespace noise
+    sql = re.sub(r"[`\"\[\]]", "", sql or "")
+    sql = re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+    sql = re.sub(r"\s*([(),])\s*", r"\1", sql)
+    return sql.lower()
+
+def table_fingerprint(sql):
+    return hashlib.sha256(_normalize_ddl(sql).encode("utf-8")).hexdigest()
+
+def schema_fingerprints(sql_text):
+    return {b["name"]: table_fingerprint(b["sql"]) for b in _split_create_table_blocks(sql_text or "")}
+
+def generate_utility_sections(sql_text, concurrency=None, reuse=None):
+    """
+    Builds the per-table sections of utility.md using an LLM.
+    The LLM explains:
+      - Why each table exists
+      - Why each attribute exists
+    Tables are explained concurrently (at most `concurrency` calls in flight,
+    default UTILITY_CONCURRENCY); sections keep the schema's table order.
+    `reuse` maps table name -> {"fingerprint", "markdown"} from a previous
+    version; a table whose DDL fingerprint is unchanged is copied, not re-asked.
+    """
+    # -----------------------------
+    # 1. Extract tables + columns
+    # -----------------------------
+    tables = {t["name"]: [c["name"] for c in t["columns"]] for t in parse_schema(sql_text)["tables"]}
+
+    fingerprints = schema_fingerprints(sql_text)
+    reuse = reuse or {}
+
+    # -----------------------------
+    # 2. Ask the LLM to explain each new or changed table
+    # -----------------------------
+    def explain(item):
+        table_name, columns = item
+        prompt = chat_prompt([
+            ("system",
+             """You are a database architect. For the given table name and list of columns:
+1. Explain in 2–4 sentences **why this table exists** in a business context.
+2. For each column, explain its purpose in 1 concise sentence.
+Output must be Markdown ONLY."""
+             ),
+            ("user",
+             f"Table name: {table_name}\nColumns: {columns}")
+        ])
+
+        chain = prompt | get_llm()
+        response = invoke_with_retry(chain, {}, prompt_tokens=estimate_tokens(f"{table_name} {columns}") + 100)
+        return response.content.strip()
+
+    sections = []
+    todo = []
+    for table_name, columns in tables.items():
+        fp = fingerprints.get(table_name)
+        prev = reuse.get(table_name)
+        section = {"table": table_name, "fingerprint": fp, "markdown": None}
+        if fp and prev and prev.get("fingerprint") == fp and prev.get("markdown"):
+            section["markdown"] = prev["markdown"]
+        else:
+            todo.append((section, (table_name, columns)))
+        sections.append(section)
+
+    items = [item for _, item in todo]
+    concurrency = UTILITY_CONCURRENCY if concurrency is None else concurrency
+    if concurrency > 1 and len(items) > 1:
+        # map() yields results in submission order, so the document is stable
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as pool:
+            explanations = list(pool.map(explain, items))
+    else:
+        explanations = [explain(item) for item in items]
+    for (section, _), explanation_md in zip(todo, explanations):
+        section["markdown"] = explanation_md
+
+    if reuse:
+        print(f"utility: reused {len(sections) - len(todo)}/{len(sections)} table explanations")
+    return sections
+
+def render_utility_doc(sections):
+    final_doc = [UTILITY_HEADER]
+    for section in sections:
+        final_doc.append(f"## Table `{section['table']}`\n\n")
+        final_doc.append(section["markdown"])
+        final_doc.append("\n\n---\n\n")
+    return "".join(final_doc)
+
+def generate_utility_table_from_schema(sql_text, concurrency=None, reuse=None):
+    return render_utility_doc(generate_utility_sections(sql_text, concurrency=concurrency, reuse=reuse))
+
+def _parse_utility_doc(text):
+    # split a rendered utility.md back into {table: markdown}
+    parts = re.split(r"^## Table `([^`]+)`[ \t]*$", text or "", flags=re.M)
+    out = {}
+    for i in range(1, len(parts) - 1, 2):
+        body = parts[i + 1].strip()
+        if body.endswith("---"):
+            body = body[:-3].rstrip()
+        out[parts[i]] = body
+    return out
+
+def load_utility_sections(version_obj):
+    """Per-table utility sections of an existing version, keyed by table name."""
+    if not version_obj or not version_obj.utility_file:
+        return {}
+    sidecar = os.path.join(os.path.dirname(version_obj.utility_file), "utility.json")
+    if os.path.exists(sidecar):
+        try:
+            return json.load(open(sidecar)).get("tables", {})
+        except Exception:
+            pass
+    # older versions have no sidecar: pair the rendered doc with its schema's fingerprints
+    if not os.path.exists(version_obj.utility_file):
+        return {}
+    docs = _parse_utility_doc(open(version_obj.utility_file).read())
+    schema = ""
+    if version_obj.schema_file and os.path.exists(version_obj.schema_file):
+        schema = open(version_obj.schema_file).read()
+    fps = schema_fingerprints(schema)
+    return {t: {"fingerprint": fps[t], "markdown": md} for t, md in docs.items() if t in fps and md}
+
+
+# ---------- Content-addressed artifact store ----------
+# Immutable version artifacts are hardlinked to BLOB_ROOT/<sha[:2]>/<sha>, so
+# identical files across versions share one inode. The link count is the
+# reference count: a blob whose only link is the store itself is garbage.
+# backend.db (and other files written after creation) stay per-version copies.
+DEDUP_ARTIFACTS = ("schema.sql", "test_suite.json", "utility.md", "utility.json", "mermaid.md", ERD_FILENAME)
+MANIFEST_FILENAME = "manifest.json"
+_blob_lock = threading.Lock()
+
+def replace_file(path, text):
+    # atomic rewrite via rename; leaves any other hardlink to the old inode untouched
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def _blob_path(digest):
+    return os.path.join(BLOB_ROOT, digest[:2], digest)
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def intern_artifact(path):
+    """Swaps `path` for a hardlink to its blob (adding the blob if new); returns the digest."""
+    digest = _file_digest(path)
+    blob = _blob_path(digest)
+    with _blob_lock:
+        try:
+            if os.path.exists(blob):
+                tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+                os.link(blob, tmp)
+                os.replace(tmp, path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(path, blob)
+        except OSError as e:
+            # no hardlinks on this filesystem: keep the private copy
+            print("Warning: could not deduplicate artifact", path, e)
+    return digest
+
+def intern_version_artifacts(v_dir):
+    manifest = {}
+    for name in DEDUP_ARTIFACTS:
+        path = os.path.join(v_dir, name)
+        if os.path.exists(path):
+            manifest[name] = intern_artifact(path)
+    with open(os.path.join(v_dir, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def version_blob_digests(v_dir):
+    try:
+        return set(json.load(open(os.path.join(v_dir, MANIFEST_FILENAME))).values())
+    except Exception:
+        return set()
+
+def release_blobs(digests):
+    # call after the version directories holding these digests are gone
+    removed = 0
+    with _blob_lock:
+        for digest in digests:
+            blob = _blob_path(digest)
+            try:
+                if os.stat(blob).st_nlink <= 1:
+                    os.remove(blob)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+# ---------- Cold-version archival ----------
+# Idle version DBs are VACUUMed; versions untouched for ARCHIVE_AFTER_DAYS have
+# backend.db compressed into archive.zip (LZMA) and are rehydrated on first access.
+# The other artifacts are already deduplicated blobs and stay as they are.
+# Every gunicorn worker runs an archiver, so the coordination is flock()-based:
+# a version's lock file is held shared while its DB is queried or tested and
+# exclusively while it is rehydrated, vacuumed or archived.
+VERSION_ARCHIVE_FILENAME = "archive.zip"
+ACCESS_MARKER_FILENAME = ".last_access"
+VERSION_LOCK_FILENAME = ".version.lock"
+ARCHIVER_LOCK_PATH = os.path.join(DATA_ROOT, ".archiver.lock")
+_archiver_guard = threading.Lock()
+_archiver_started = False
+
+@contextmanager
+def _flock(path, shared=False, blocking=True):
+    # yields False instead of waiting when blocking=False and the lock is taken;
+    # each call opens its own descriptor, so threads of one process exclude each other too
+    with open(path, "a") as f:
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def version_lock(db_path, shared=False, blocking=True):
+    return _flock(os.path.join(os.path.dirname(db_path), VERSION_LOCK_FILENAME), shared, blocking)
+
+def _last_access(db_path):
+    v_dir = os.path.dirname(db_path)
+    stamps = [os.path.getmtime(p) for p in (os.path.join(v_dir, ACCESS_MARKER_FILENAME), db_path,
+                                             os.path.join(v_dir, VERSION_ARCHIVE_FILENAME)) if os.path.exists(p)]
+    return max(stamps) if stamps else 0.0
+
+def ensure_version_online(version_obj):
+    """
+    Marks the version as accessed and restores backend.db from its archive if
+    needed. Returns the rehydration time in ms, or None if it was already online.
+    """
+    db_path = version_obj.db_file
+    if not db_path:
+        return None
+    v_dir = os.path.dirname(db_path)
+    archive = os.path.join(v_dir, VERSION_ARCHIVE_FILENAME)
+    # the access mark comes first, so an archiver that locks the version after
+    # this no longer sees it as idle
+    with open(os.path.join(v_dir, ACCESS_MARKER_FILENAME), "a"):
+        pass
+    os.utime(os.path.join(v_dir, ACCESS_MARKER_FILENAME))
+    if not os.path.exists(archive) or os.path.exists(db_path):
+        return None  # online: no exclusive lock, which would wait for open streams
+    elapsed = None
+    with version_lock(db_path):
+        if os.path.exists(archive) and not os.path.exists(db_path):
+            started = time.perf_counter()
+            tmp = f"{db_path}.{uuid.uuid4().hex}.tmp"
+            with zipfile.ZipFile(archive) as zf, zf.open(os.path.basename(db_path)) as src, open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(tmp, db_path)
+            os.remove(archive)
+            bump_db_generation(db_path)
+            elapsed = round((time.perf_counter() - started) * 1000, 2)
+            logger.info("rehydrated %s in %.1f ms", db_path, elapsed)
+    return elapsed
+
+@contextmanager
+def version_online(version_obj):
+    """
+    ensure_version_online() plus a shared version lock for the block, so no
+    archiver (in any worker) removes or vacuums the DB while it is in use.
+    Yields the rehydration time in ms (None if the DB was already online).
+    """
+    db_path = version_obj.db_file
+    if not db_path:
+        yield None
+        return
+    rehydrated_ms = None
+    while True:
+        elapsed = ensure_version_online(version_obj)
+        if elapsed is not None:
+            rehydrated_ms = elapsed
+        with version_lock(db_path, shared=True):
+            # archived again between the two locks: restore once more
+            if os.path.exists(db_path) or not os.path.exists(os.path.join(os.path.dirname(db_path), VERSION_ARCHIVE_FILENAME)):
+                yield rehydrated_ms
+                return
+
+def vacuum_version_db(db_path):
+    # returns bytes reclaimed; skipped when there are no free pages
+    close_sqlite_pool(db_path)
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        if not conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            return 0
+        before = os.path.getsize(db_path)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return before - os.path.getsize(db_path)
+
+def archive_version_db(db_path):
+    """VACUUMs and compresses backend.db into archive.zip, then removes the DB (+ WAL files)."""
+    v_dir = os.path.dirname(db_path)
+    archive = os.path.join(v_dir, VERSION_ARCHIVE_FILENAME)
+    vacuum_version_db(db_path)
+    # other processes may still have idle pooled connections, so commits can sit in
+    # the WAL: fold it into the main file first (only backend.db is archived)
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
+    if busy:
+        raise sqlite3.OperationalError("WAL checkpoint blocked by an open reader")
+    tmp = f"{archive}.{uuid.uuid4().hex}.tmp"
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_LZMA) as zf:
+        zf.write(db_path, os.path.basename(db_path))
+    os.replace(tmp, archive)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    bump_db_generation(db_path)
+    return os.path.getsize(archive)
+
+def archive_idle_versions(now=None):
+    """One archiver pass over all versions; returns counters for logging."""
+    now = now or time.time()
+    stats = {"vacuumed": 0, "archived": 0, "bytes_reclaimed": 0, "errors": 0, "busy": 0}
+    for version in Version.query.all():
+        db_path = version.db_file
+        if not db_path or not os.path.exists(db_path):
+            continue
+        with version_lock(db_path, blocking=False) as held:
+            if not held:
+                stats["busy"] += 1  # being queried or rehydrated: it isn't idle
+                continue
+            if not os.path.exists(db_path):
+                continue
+            idle = now - _last_access(db_path)
+            try:
+                if idle >= ARCHIVE_AFTER_DAYS * 86400:
+                    size = os.path.getsize(db_path)
+                    stats["bytes_reclaimed"] += size - archive_version_db(db_path)
+                    stats["archived"] += 1
+                elif idle >= VACUUM_IDLE_SECONDS:
+                    reclaimed = vacuum_version_db(db_path)
+                    if reclaimed:
+                        stats["vacuumed"] += 1
+                        stats["bytes_reclaimed"] += reclaimed
+            except Exception as e:
+                stats["errors"] += 1
+                print("Warning: archiving version DB failed:", db_path, e)
+    return stats
+
+def _archiver_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        try:
+            # one pass at a time across workers; the others skip this round
+            with _flock(ARCHIVER_LOCK_PATH, blocking=False) as held:
+                if not held:
+                    continue
+                with app.app_context():
+                    stats = archive_idle_versions()
+            logger.info("archiver pass: %s", stats)
+        except Exception as e:
+            print("Warning: archiver pass failed:", e)
+
+def start_archiver():
+    global _archiver_started
+    with _archiver_guard:
+        if _archiver_started or ARCHIVE_INTERVAL <= 0:
+            return
+        _archiver_started = True
+    threading.Thread(target=_archiver_loop, name="sdm-archiver", daemon=True).start()
+
+# ---------- Version DB migration ----------
+_CREATE_OBJECT_RE = re.compile(
+    r"^\s*CREATE\s+(?:TEMP(?:ORARY)?\s+)?(VIEW|TRIGGER)\s+(?:IF\s+NOT\s+EXISTS\s+)?[`\"\[]?(\w+)", re.I)
+_INSERT_TARGET_RE = re.compile(r"^\s*(?:INSERT|REPLACE)\s+(?:OR\s+\w+\s+)?(?:INTO\s+)?[`\"\[]?(\w+)", re.I)
+
+def _quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _migration_plan(conn, sql_text):
+    # diff the objects actually in the copied DB against the new schema text
+    model = parse_schema(sql_text)
+    current = {}
+    for kind, name, tbl, sql in conn.execute(
+            "SELECT type, name, tbl_name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"):
+        current[(kind, name.lower())] = {"name": name, "table": tbl, "sql": sql or ""}
+    wanted = {t["name"].lower(): t for t in model["tables"]}
+    plan = {"create": [], "drop": [], "rebuild": [], "keep": [], "indexes": [], "drop_indexes": [],
+            "objects": [], "drop_objects": [], "inserts": []}
+    for (kind, key), obj in current.items():
+        if kind == "table" and key not in wanted:
+            plan["drop"].append(obj["name"])
+    for key, table in wanted.items():
+        obj = current.get(("table", key))
+        if obj is None:
+            plan["create"].append(table)
+        elif _normalize_ddl(obj["sql"]) == _normalize_ddl(table["sql"]):
+            plan["keep"].append(table["name"])
+        else:
+            plan["rebuild"].append(table)
+    rebuilt = {t["name"].lower() for t in plan["rebuild"]}
+    wanted_indexes = {i["name"].lower(): i for i in model["indexes"]}
+    for (kind, key), obj in current.items():
+        if kind != "index" or not obj["sql"]:
+            continue  # sql is NULL for PK/UNIQUE autoindexes
+        idx = wanted_indexes.get(key)
+        if idx is None or _normalize_ddl(idx["sql"]) != _normalize_ddl(obj["sql"]):
+            if obj["table"].lower() not in rebuilt and obj["table"].lower() in wanted:
+                plan["drop_indexes"].append(obj["name"])
+    for key, idx in wanted_indexes.items():
+        obj = current.get(("index", key))
+        if obj is None or key in [n.lower() for n in plan["drop_indexes"]] or idx["table"].lower() in rebuilt \
+                or _normalize_ddl(obj["sql"]) != _normalize_ddl(idx["sql"]):
+            plan["indexes"].append(idx)
+    # views/triggers are cheap to recreate; seed rows only go into tables that start empty
+    created = {t["name"].lower() for t in plan["create"]}
+    wanted_objects = set()
+    for stmt in model["statements"]:
+        m = _CREATE_OBJECT_RE.match(stmt["sql"])
+        if m:
+            wanted_objects.add((m.group(1).lower(), m.group(2).lower()))
+            plan["objects"].append(stmt["sql"])
+            continue
+        m = _INSERT_TARGET_RE.match(stmt["sql"])
+        if m and m.group(1).lower() in created:
+            plan["inserts"].append(stmt["sql"])
+    for (kind, key), obj in current.items():
+        if kind in ("view", "trigger") and obj["table"].lower() not in {n.lower() for n in plan["drop"]}:
+            plan["drop_objects"].append((kind, obj["name"]))
+    return plan
+
+def _apply_migration(conn, plan):
+    counts = {}
+    for kind, name in plan["drop_objects"]:
+        conn.execute(f"DROP {kind.upper()} IF EXISTS {_quote_ident(name)}")
+    for name in plan["drop_indexes"]:
+        conn.execute(f"DROP INDEX IF EXISTS {_quote_ident(name)}")
+    for name in plan["drop"]:
+        conn.execute(f"DROP TABLE IF EXISTS {_quote_ident(name)}")
+    for table in plan["create"]:
+        conn.execute(table["sql"])
+    for table in plan["rebuild"]:
+        # create-copy-rename: move the old table aside, create the new one under its
+        # real name (so sqlite_master keeps the schema text as written), copy shared columns
+        name = table["name"]
+        old = f"_sdm_old_{name}"
+        old_cols = [r[1] for r in conn.execute(f"PRAGMA table_info({_quote_ident(name)})")]
+        conn.execute(f"ALTER TABLE {_quote_ident(name)} RENAME TO {_quote_ident(old)}")
+        conn.execute(table["sql"])
+        new_cols = {r[1].lower() for r in conn.execute(f"PRAGMA table_info({_quote_ident(name)})")}
+        shared = ", ".join(_quote_ident(c) for c in old_cols if c.lower() in new_cols)
+        if shared:
+            cur = conn.execute(f"INSERT INTO {_quote_ident(name)} ({shared}) SELECT {shared} FROM {_quote_ident(old)}")
+            counts[name] = cur.rowcount
+        conn.execute(f"DROP TABLE {_quote_ident(old)}")
+    for idx in plan["indexes"]:
+        conn.execute(f"DROP INDEX IF EXISTS {_quote_ident(idx['name'])}")
+        conn.execute(idx["sql"])
+    for sql in plan["objects"]:
+        conn.execute(sql)
+    for sql in plan["inserts"]:
+        conn.execute(sql)
+    return counts
+
+def migrate_version_db(base_db, db_path, sql_text):
+    """
+    Builds a new version DB as a page-level copy of `base_db` (sqlite3 backup
+    API) and applies only the schema diff: new tables created, removed ones
+    dropped, changed ones rebuilt with their rows copied. Returns a summary;
+    raises if the migration can't be applied (the copy is left untouched).
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    try:
+        with sqlite_connection(base_db) as src:
+            src.backup(conn)
+        plan = _migration_plan(conn, sql_text)
+        # FK enforcement must be off (it can't change inside a transaction) and
+        # legacy renames keep other tables' REFERENCES pointing at the real name
+        conn.execute("PRAGMA foreign_keys = OFF")
+        conn.execute("PRAGMA legacy_alter_table = ON")
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = _apply_migration(conn, plan)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+    finally:
+        conn.close()
+    return {
+        "mode": "migrated",
+        "created": [t["name"] for t in plan["create"]],
+        "dropped": plan["drop"],
+        "rebuilt": [t["name"] for t in plan["rebuild"]],
+        "kept": plan["keep"],
+        "indexes": [i["name"] for i in plan["indexes"]],
+        "rows_copied": counts,
+        "foreign_key_violations": len(violations),
+        "ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+# ---------- Version creation / file management ----------
+def create_project(user_obj, project_name):
+    project = Project(name=project_name, owner=user_obj)
+    db.session.add(project)
+    db.session.commit()
+    # create folder
+    project_dir_path = project_dir(user_obj.id, project.id)
+    meta = {"name": project_name, "created_at": project.created_at.isoformat(), "versions": []}
+    with open(os.path.join(project_dir_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return project
+
+# serializes version numbering + directory creation between concurrent jobs
+_version_create_lock = threading.Lock()
+
+def _next_version_name(project_obj):
+    taken = [v.name for v in Version.query.filter_by(project_id=project_obj.id).all()]
+    numbers = [int(n[len("version"):]) for n in taken if n.startswith("version") and n[len("version"):].isdigit()]
+    return f"version{max(numbers + [len(taken)]) + 1}"
+
+def create_version_for_project(user_obj, project_obj, sql_schema_text, test_suite, mermaid_code=None,
+                               base_version_obj=None, utility_sections=None, job=None):
+    # utility docs are the slow (LLM) part
+    if utility_sections is None:
+        with job_stage(job, "utility"):
+            utility_sections = generate_utility_sections(sql_schema_text or "", reuse=load_utility_sections(base_version_obj))
+
+    # everything is written into a staging dir (the base DB migration can take a
+    # while); the lock only covers picking the name, the rename and the row insert
+    with job_stage(job, "persist"):
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=project_dir(user_obj.id, project_obj.id))
+        written = staging  # where the files are now, removed again if anything fails
+        try:
+            with timed("version_files"):
+                with open(os.path.join(staging, "schema.sql"), "w") as f:
+                    f.write(sql_schema_text or "")
+                with open(os.path.join(staging, "test_suite.json"), "w") as f:
+                    json.dump(test_suite or [], f, indent=2)
+                # utility.md (+ per-table sidecar so the next version can reuse unchanged tables)
+                with open(os.path.join(staging, "utility.md"), "w") as f:
+                    f.write(render_utility_doc(utility_sections))
+                with open(os.path.join(staging, "utility.json"), "w") as f:
+                    json.dump({"tables": {s["table"]: {"fingerprint": s["fingerprint"], "markdown": s["markdown"]} for s in utility_sections}}, f, indent=2)
+                # mermaid (as generated) + the rendered ER diagram served by version_detail
+                with open(os.path.join(staging, "mermaid.md"), "w") as f:
+                    f.write(mermaid_code or "")
+                write_version_erd(staging, sql_schema_text or "")
+                intern_version_artifacts(staging)
+
+            # per-version sqlite DB: a migrated copy of the base version's data when
+            # there is one, otherwise a blank DB built from the schema text
+            staged_db = os.path.join(staging, "backend.db")
+            migration = None
+            with timed("version_db"):
+                with version_online(base_version_obj) if base_version_obj else nullcontext():
+                    if base_version_obj and base_version_obj.db_file and os.path.exists(base_version_obj.db_file):
+                        # no silent fallback to an empty DB: that would drop every row of the base
+                        try:
+                            migration = migrate_version_db(base_version_obj.db_file, staged_db, sql_schema_text or "")
+                        except Exception as e:
+                            raise RuntimeError(f"Migrating the data of {base_version_obj.name} failed: {e}") from e
+                        migration["base_version"] = base_version_obj.name
+                if migration is None:
+                    conn = get_sqlite_conn(staged_db)
+                    try:
+                        if sql_schema_text and sql_schema_text.strip():
+                            conn.executescript(sql_schema_text)
+                            conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        print("Warning: schema execution failed for new version DB:", e)
+                    finally:
+                        conn.close()
+                if migration:
+                    with open(os.path.join(staging, "migration.json"), "w") as f:
+                        json.dump(migration, f, indent=2)
+                # pools another process still holds for a deleted version at the same path go stale
+                bump_db_generation(staged_db)
+
+            with _version_create_lock:
+                version_name = _next_version_name(project_obj)
+                v_dir = os.path.join(project_dir(user_obj.id, project_obj.id), version_name)
+                if os.path.exists(v_dir):
+                    # left over from an interrupted run: no Version row points at it
+                    shutil.rmtree(v_dir)
+                os.rename(staging, v_dir)
+                written = v_dir
+                schema_path = os.path.join(v_dir, "schema.sql")
+                test_path = os.path.join(v_dir, "test_suite.json")
+                util_path = os.path.join(v_dir, "utility.md")
+                mermaid_path = os.path.join(v_dir, "mermaid.md")
+                db_path = os.path.join(v_dir, "backend.db")
+                version = Version(
+                    name=version_name,
+                    project=project_obj,
+                    schema_file=schema_path,
+                    test_file=test_path,
+                    utility_file=util_path,
+                    mermaid_file=mermaid_path,
+                    db_file=db_path
+                )
+                db.session.add(version)
+                db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            digests = version_blob_digests(written)
+            shutil.rmtree(written, ignore_errors=True)
+            release_blobs(digests)
+            raise
+    # update project meta.json
+    with _version_create_lock:
+        proj_meta_path = os.path.join(project_dir(user_obj.id, project_obj.id), "meta.json")
+        try:
+            meta = json.load(open(proj_meta_path))
+        except Exception:
+            meta = {"name": project_obj.name, "versions": []}
+        meta.setdefault("versions", []).append({
+            "name": version_name,
+            "created_at": version.created_at.isoformat(),
+            "schema_file": schema_path,
+            "test_file": test_path,
+            "utility_file": util_path,
+            "db_file": db_path
+        })
+        with open(proj_meta_path, "w") as f:
+            json.dump(meta, f, indent=2)
+    return version
+
+def initialize_version_database(schema_path, db_path):
+    import sqlite3
+    with open(schema_path, "r") as f:
+        schema_sql = f.read()
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    # Execute the schema
+    cursor.executescript(schema_sql)
+    conn.commit()
+    conn.close()
+
+
+# ---------- Query governor ----------
+class QueryBudgetExceeded(Exception):
+    """A console query was stopped (or refused) by the governor; `budget` is time, steps or concurrency."""
+    def __init__(self, budget, limit, elapsed_ms=0.0, steps=0):
+        self.budget = budget
+        self.limit = limit
+        self.elapsed_ms = elapsed_ms
+        self.steps = steps
+        super().__init__(f"budget exceeded: {budget} limit {limit}")
+
+    def __reduce__(self):
+        # raised inside sandbox processes and re-raised in the web tier
+        return (QueryBudgetExceeded, (self.budget, self.limit, self.elapsed_ms, self.steps))
+
+    def to_dict(self):
+        return {"type": "error", "error": "budget exceeded", "budget": self.budget, "limit": self.limit,
+                "elapsed_ms": self.elapsed_ms, "steps": self.steps}
+
+class QueryBudget:
+    """
+    Wall-clock + VM-step budget for one connection, enforced by a progress
+    handler; a timer calls interrupt() as a backstop for work that doesn't
+    reach the handler.
+    """
+    def __init__(self, conn, timeout=None, max_steps=None, interval=None):
+        self.conn = conn
+        self.timeout = QUERY_TIMEOUT if timeout is None else timeout
+        self.max_steps = QUERY_MAX_STEPS if max_steps is None else max_steps
+        self.interval = interval or QUERY_STEP_INTERVAL
+        self.steps = 0
+        self.exceeded = None
+        self._timer = None
+        self._stopped = False
+
+    def _progress(self):
+        self.steps += self.interval
+        if self.max_steps and self.steps > self.max_steps:
+            self.exceeded = "steps"
+        elif self.timeout and time.monotonic() > self._deadline:
+            self.exceeded = "time"
+        return 1 if self.exceeded else 0
+
+    def _arm(self, seconds):
+        self._timer = threading.Timer(seconds, self._interrupt)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _interrupt(self):
+        if self._stopped:
+            return
+        self.exceeded = self.exceeded or "time"
+        self.conn.interrupt()
+
+    def start(self):
+        self._started = time.monotonic()
+        self._deadline = self._started + (self.timeout or 0)
+        self.conn.set_progress_handler(self._progress, self.interval)
+        if self.timeout:
+            self._arm(self.timeout + 0.5)
+        return self
+
+    def stop(self):
+        # idempotent; call before any cleanup statements so they can't be interrupted
+        self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.conn.set_progress_handler(None, 0)
+
+    def error(self):
+        limit = self.max_steps if self.exceeded == "steps" else self.timeout
+        return QueryBudgetExceeded(self.exceeded, limit, round((time.monotonic() - self._started) * 1000, 2), self.steps)
+
+@contextmanager
+def query_budget(conn, timeout=None, max_steps=None):
+    budget = QueryBudget(conn, timeout, max_steps).start()
+    try:
+        yield budget
+    finally:
+        budget.stop()
+
+_query_slots = {}
+_query_slots_lock = threading.Lock()
+
+def acquire_query_slot(user_id, db_file):
+    """Takes a console query slot for the user and the version DB; refuses (no queueing) at the cap."""
+    keys = [("db", os.path.abspath(db_file), QUERY_MAX_PER_DB)]
+    if user_id is not None:
+        keys.append(("user", user_id, QUERY_MAX_PER_USER))
+    with _query_slots_lock:
+        for kind, key, cap in keys:
+            if cap and _query_slots.get((kind, key), 0) >= cap:
+                raise QueryBudgetExceeded(f"concurrency:{kind}", cap)
+        for kind, key, _ in keys:
+            _query_slots[(kind, key)] = _query_slots.get((kind, key), 0) + 1
+    return keys
+
+def release_query_slot(keys):
+    with _query_slots_lock:
+        for kind, key, _ in keys:
+            left = _query_slots.get((kind, key), 1) - 1
+            if left:
+                _query_slots[(kind, key)] = left
+            else:
+                _query_slots.pop((kind, key), None)
+
+@contextmanager
+def query_slot(user_id, db_file):
+    keys = acquire_query_slot(user_id, db_file)
+    try:
+        yield
+    finally:
+        release_query_slot(keys)
+
+# ---------- Console result cache ----------
+# Functions whose value changes between runs of the same statement
+_VOLATILE_SQL_RE = re.compile(r"\b(random|randomblob|changes|last_insert_rowid|total_changes)\s*\(|"
+                              r"\b(current_(date|time|timestamp))\b|'now'", re.I)
+
+class QueryResultCache:
+    """
+    LRU cache of read-only console pages keyed by (db_file, SQL text, limit,
+    offset); the text is exact, as even whitespace shows in column names. Each entry remembers the DB generation it was read at:
+    a per-file counter bumped on console commits plus the stat of the DB and
+    its WAL, so writes from any connection or process make it stale.
+    """
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, max_entry_bytes=QUERY_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def generation(self, db_file):
+        path = os.path.abspath(db_file)
+        stamp = [self._counters.get(path, 0)]
+        for p in (path, path + "-wal"):
+            try:
+                st = os.stat(p)
+                stamp += [st.st_mtime_ns, st.st_size]
+            except FileNotFoundError:
+                stamp += [0, 0]
+        return tuple(stamp)
+
+    @staticmethod
+    def cacheable(sql):
+        # PRAGMAs can set state or report per-connection values; never cache them
+        return (is_read_query(sql) and not sql.lstrip().lower().startswith("pragma")
+                and not _VOLATILE_SQL_RE.search(sql))
+
+    def get(self, db_file, sql, limit, cursor):
+        key = (os.path.abspath(db_file), sql.strip(), limit, cursor or "")
+        generation = self.generation(db_file)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1], cached=True)
+
+    def put(self, db_file, sql, limit, cursor, result, generation):
+        size = len(json.dumps(result, default=str))
+        if self.max_bytes <= 0 or size > min(self.max_entry_bytes, self.max_bytes):
+            return
+        key = (os.path.abspath(db_file), sql.strip(), limit, cursor or "")
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (generation, result, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self.bytes -= self._entries.pop(key)[2]
+
+    def invalidate(self, db_file):
+        # committed write (or file replaced): bump the generation and free the DB's pages now
+        path = os.path.abspath(db_file)
+        with self._lock:
+            self._counters[path] = self._counters.get(path, 0) + 1
+            for key in [k for k in self._entries if k[0] == path]:
+                self._drop(key)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                    "entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+query_cache = QueryResultCache()
+
+# ---------- SQL sandbox processes ----------
+# Long-lived spawned workers run console queries and test suites so heavy SQLite
+# work neither competes with request threads nor takes the web process down with
+# it. Workers are recycled after SQL_PROCESS_MAX_TASKS jobs; a worker that dies
+# breaks the pool, which is replaced on the next call.
+class SandboxCrashed(RuntimeError):
+    pass
+
+_sql_executor = None
+_sql_executor_lock = threading.Lock()
+
+def _sandbox_init(memory_mb):
+    if memory_mb:
+        try:
+            import resource
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            print("Warning: could not limit sandbox memory:", e)
+
+def get_sql_executor():
+    global _sql_executor
+    with _sql_executor_lock:
+        if _sql_executor is None:
+            _sql_executor = ProcessPoolExecutor(max_workers=SQL_PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_sandbox_init, initargs=(SQL_PROCESS_MEMORY_MB,),
+                                                max_tasks_per_child=SQL_PROCESS_MAX_TASKS or None)
+        return _sql_executor
+
+def _reset_sql_executor(broken):
+    global _sql_executor
+    with _sql_executor_lock:
+        if _sql_executor is broken:
+            _sql_executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def run_in_sandbox(fn, db_file, *args):
+    """Runs fn(db_file, *args) in a sandbox worker (or inline when SQL_PROCESSES is 0)."""
+    if SQL_PROCESSES <= 0:
+        return fn(db_file, *args)
+    executor = get_sql_executor()
+    try:
+        # workers keep their pools between jobs; db_generation() retires stale ones
+        return executor.submit(fn, db_file, *args).result()
+    except BrokenProcessPool as e:
+        _reset_sql_executor(executor)
+        raise SandboxCrashed(f"SQL worker process died (crash or memory limit): {e}") from e
+
+# ---------- Test and query runners ----------
+def _snapshot_db(db_file, directory):
+    # page-level copy of the version DB taken once per suite run; kept on disk so
+    # a suite's memory doesn't grow with the DB size times the worker count
+    path = os.path.join(directory, "snapshot.db")
+    snapshot = sqlite3.connect(path)
+    try:
+        with sqlite_connection(db_file) as src:
+            src.backup(snapshot)
+        snapshot.execute("PRAGMA journal_mode = DELETE;")  # clones are plain files, no -wal/-shm
+    finally:
+        snapshot.close()
+    return path
+
+def _clone_snapshot(snapshot_path, clone_path):
+    shutil.copyfile(snapshot_path, clone_path)
+    conn = sqlite3.connect(clone_path, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA synchronous = OFF;")  # throwaway copy
+    return conn
+
+_PLANNED_STATEMENT_RE = re.compile(r"^\s*(select|update|delete|with)\b", re.I)
+_FULL_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?([\w\"`\[\]]+)", re.I)
+
+def _table_aliases(stmt):
+    # {alias or name (lowercase): table name} for the tables a statement reads
+    try:
+        tree = parse_one(stmt, read="sqlite")
+    except Exception:
+        return {}
+    aliases = {}
+    for t in tree.find_all(exp.Table):
+        if t.name:
+            aliases[t.alias_or_name.lower()] = t.name
+            aliases.setdefault(t.name.lower(), t.name)
+    return aliases
+
+def explain_query_plan(conn, stmt, tables=None):
+    """
+    EXPLAIN QUERY PLAN for one statement: {"sql", "plan": [detail, ...],
+    "full_scans": [table, ...], "temp_btree": bool}, or None if it can't be planned.
+    `tables` (lowercase names) limits full-scan flags to real tables.
+    """
+    try:
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {stmt}").fetchall()
+    except sqlite3.Error:
+        return None
+    plan = [row[-1] for row in rows]
+    aliases = _table_aliases(stmt)
+    scans = []
+    for detail in plan:
+        m = _FULL_SCAN_RE.match(detail)
+        if m and "USING" not in detail.upper():
+            # plans name tables by their alias ("SCAN u" for "users u")
+            table = m.group(1).strip('"`[]')
+            table = aliases.get(table.lower(), table)
+            if (tables is None or table.lower() in tables) and table not in scans:
+                scans.append(table)
+    return {"sql": stmt, "plan": plan, "full_scans": scans,
+            "temp_btree": any("USE TEMP B-TREE" in d.upper() for d in plan)}
+
+def _run_one_test(conn, t, timeout):
+    """Runs a test inside a savepoint; returns (result, dirty) where dirty means the copy can't be reused."""
+    name = t.get("name", "<unnamed>")
+    sql = t.get("sql", "")
+    t_type = t.get("type", "normal")
+    cur = conn.cursor()
+    tables = {r[0].lower() for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    plans = []
+    executed = 0
+    exec_seconds = 0.0   # statement time only; planning isn't charged to the test
+    stmt_started = None
+    deadline = time.monotonic() + timeout if timeout else None
+    if deadline:
+        conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 1000)
+    try:
+        # Start savepoint
+        cur.execute("SAVEPOINT test_sp;")
+
+        # Split into individual statements
+        statements = [s.strip() for s in sql.split(";") if s.strip()]
+
+        for stmt in statements:
+            if _PLANNED_STATEMENT_RE.match(stmt):
+                plan = explain_query_plan(conn, stmt, tables)
+                if plan:
+                    plans.append(plan)
+            stmt_started = time.perf_counter()
+            cur.execute(stmt)
+            exec_seconds += time.perf_counter() - stmt_started
+            stmt_started = None
+            executed += 1
+
+        result = {"name": name, "status": "ok", "type": t_type}
+    except Exception as e:
+        if stmt_started is not None:
+            exec_seconds += time.perf_counter() - stmt_started
+        timed_out = deadline is not None and time.monotonic() > deadline
+        result = {
+            "name": name,
+            "status": "timeout" if timed_out else "error",
+            "error": f"exceeded {timeout}s" if timed_out else str(e),
+            "type": t_type
+        }
+    finally:
+        conn.set_progress_handler(None, 0)
+    result["ms"] = round(exec_seconds * 1000, 3)
+    result["statements"] = executed
+    result["plans"] = plans
+    result["full_scans"] = sorted({table for p in plans for table in p["full_scans"]})
+    # a test that ran COMMIT/ROLLBACK/RELEASE itself has ended our savepoint
+    dirty = not conn.in_transaction
+    try:
+        # Cleanup and rollback to clean state
+        cur.execute("ROLLBACK TO test_sp;")
+        cur.execute("RELEASE test_sp;")
+    except Exception:
+        dirty = True
+    return result, dirty
+
+def _percentile(values, pct):
+    # nearest-rank percentile of an unsorted list
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+def summarize_test_results(results, slowest=None):
+    """Suite-level aggregates for run_tests_against_db results."""
+    slowest = TEST_SLOWEST_N if slowest is None else slowest
+    times = [r.get("ms", 0.0) for r in results]
+    scanned = {}
+    for r in results:
+        for table in r.get("full_scans", []):
+            scanned[table] = scanned.get(table, 0) + 1
+    by_time = sorted(results, key=lambda r: r.get("ms", 0.0), reverse=True)
+    return {
+        "total": len(results),
+        "passed": sum(1 for r in results if r["status"] == "ok"),
+        "failed": sum(1 for r in results if r["status"] == "error"),
+        "timed_out": sum(1 for r in results if r["status"] == "timeout"),
+        "total_ms": round(sum(times), 3),
+        "p50_ms": _percentile(times, 50),
+        "p95_ms": _percentile(times, 95),
+        "max_ms": max(times) if times else 0.0,
+        "statements": sum(r.get("statements", 0) for r in results),
+        "slowest": [{"name": r["name"], "ms": r.get("ms", 0.0), "status": r["status"]} for r in by_time[:slowest]],
+        "tests_with_full_scans": sum(1 for r in results if r.get("full_scans")),
+        "full_scans_by_table": dict(sorted(scanned.items(), key=lambda kv: -kv[1])),
+    }
+
+def run_tests_against_db(db_file, test_suite, workers=None, timeout=None):
+    """
+    Runs a generated test suite against a snapshot of the version DB, in a
+    sandbox process. Raises SandboxCrashed if the worker dies.
+    """
+    if not test_suite:
+        return []
+    with timed("sqlite_tests", metric="sdm_sqlite_query_seconds", db=db_label(db_file)):
+        return run_in_sandbox(_run_tests_local, db_file, list(test_suite), workers, timeout)
+
+def _run_tests_local(db_file, test_suite, workers=None, timeout=None):
+    """
+    Runs a generated test suite against a snapshot of the version DB.
+    The DB is copied once with the backup API into a temp file; each of
+    `workers` threads gets a private file copy of it, so tests never touch the
+    real DB or each other (a copy that a test committed into is replaced
+    before reuse).
+    Results come back in suite order; `timeout` bounds each test in seconds.
+    """
+    tests = list(test_suite or [])
+    if not tests:
+        return []
+    workers = max(1, min(TEST_WORKERS if workers is None else workers, len(tests)))
+    timeout = TEST_TIMEOUT if timeout is None else timeout
+
+    scratch = tempfile.mkdtemp(prefix="sdm-tests-", dir=TEST_SNAPSHOT_DIR)
+    pending = queue.SimpleQueue()
+    for i in range(len(tests)):
+        pending.put(i)
+    results = [None] * len(tests)
+
+    def worker(n):
+        clone_path = os.path.join(scratch, f"worker{n}.db")
+        conn = _clone_snapshot(snapshot, clone_path)
+        try:
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except queue.Empty:
+                    return
+                results[i], dirty = _run_one_test(conn, tests[i], timeout)
+                if dirty:
+                    conn.close()
+                    conn = _clone_snapshot(snapshot, clone_path)
+        finally:
+            conn.close()
+
+    try:
+        snapshot = _snapshot_db(db_file, scratch)
+        if workers == 1:
+            worker(0)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sdm-test") as pool:
+                for fut in [pool.submit(worker, n) for n in range(workers)]:
+                    fut.result()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+_WRITE_IN_CTE_RE = re.compile(r"\b(insert|update|delete|replace)\b", re.I)
+
+# console PRAGMAs run on pooled connections shared by every user of a version DB:
+# only the reading forms are allowed, so no session setting outlives the query
+_PRAGMA_RE = re.compile(r"^(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/)*pragma\s+(?:\w+\s*\.\s*)?(\w+)\s*(=|\()?", re.I | re.S)
+_PRAGMA_READ_ARGS = {"table_info", "table_xinfo", "table_list", "index_list", "index_info", "index_xinfo",
+                     "foreign_key_list", "foreign_key_check", "integrity_check", "quick_check"}
+
+def check_console_sql(sql):
+    # raises ValueError for statements that would change state on a shared connection
+    m = _PRAGMA_RE.match(sql or "")
+    if m and m.group(2) and (m.group(2) == "=" or m.group(1).lower() not in _PRAGMA_READ_ARGS):
+        raise ValueError(f"PRAGMA {m.group(1)} can only be read in the console, not set")
+
+def is_read_query(sql):
+    sql_strip = sql.lstrip().lower()
+    if sql_strip.startswith(("select", "pragma", "explain", "values")):
+        return True
+    return sql_strip.startswith("with") and not _WRITE_IN_CTE_RE.search(sql_strip)
+
+def _json_value(v):
+    # BLOBs aren't JSON; ship them as hex
+    return v.hex() if isinstance(v, (bytes, bytearray, memoryview)) else v
+
+def _json_row(row):
+    return [_json_value(v) for v in row]
+
+def _encode_query_cursor(sql, offset):
+    token = json.dumps({"o": offset, "h": hashlib.sha256(sql.encode("utf-8")).hexdigest()[:12]})
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+def _decode_query_cursor(sql, cursor):
+    # opaque page token: the row offset, bound to the SQL text it was issued for
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if token["h"] != hashlib.sha256(sql.encode("utf-8")).hexdigest()[:12]:
+            raise ValueError("cursor belongs to a different query")
+        return max(0, int(token["o"]))
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {e}")
+
+def _skip_rows(cur, count):
+    while count > 0:
+        skipped = len(cur.fetchmany(min(count, 1000)))
+        if not skipped:
+            break
+        count -= skipped
+
+def run_single_query(db_file, sql, commit=False, limit=None, cursor=None, user_id=None):
+    """
+    Runs one console statement under the query governor, in a sandbox process.
+    Reads return a page in columnar form:
+      {"type": "select", "columns": [...], "rows": [[...], ...], "row_count",
+       "next_cursor": <token or None>}
+    Pass next_cursor back as `cursor` to fetch the following page. Raises
+    QueryBudgetExceeded when the user/DB is already at its concurrency cap and
+    ValueError for PRAGMA assignments (see check_console_sql).
+    """
+    check_console_sql(sql)
+    limit = max(1, min(int(limit or QUERY_PAGE_SIZE), QUERY_MAX_PAGE_SIZE))
+    cacheable = query_cache.cacheable(sql)
+    if cacheable:
+        cached = query_cache.get(db_file, sql, limit, cursor)
+        if cached is not None:
+            return cached
+        generation = query_cache.generation(db_file)
+    label = db_label(db_file)
+    with query_slot(user_id, db_file):
+        try:
+            with timed("sqlite_query", metric="sdm_sqlite_query_seconds", db=label):
+                result = run_in_sandbox(_execute_query, db_file, sql, commit, limit, cursor)
+        except SandboxCrashed as e:
+            metrics.inc("sdm_sqlite_queries_total", db=label, outcome="crashed")
+            return {"type": "error", "error": str(e)}
+    metrics.inc("sdm_sqlite_queries_total", db=label, outcome=result.get("type", "error"))
+    if cacheable and result.get("type") == "select":
+        query_cache.put(db_file, sql, limit, cursor, result, generation)
+    elif result.get("note") == "committed":
+        query_cache.invalidate(db_file)
+    return result
+
+def _execute_query(db_file, sql, commit, limit, cursor):
+    with sqlite_connection(db_file) as conn, query_budget(conn) as budget:
+        cur = conn.cursor()
+
+        savepoint_created = False
+
+        try:
+            # READ query
+            if is_read_query(sql):
+                offset = _decode_query_cursor(sql, cursor) if cursor else 0
+                cur.execute(sql)
+                cols = [d[0] for d in cur.description] if cur.description else []
+                _skip_rows(cur, offset)
+                page = cur.fetchmany(limit + 1)
+                more = len(page) > limit
+                rows = [_json_row(row) for row in page[:limit]]
+                return {"type": "select", "columns": cols, "rows": rows, "row_count": len(rows), "offset": offset,
+                        "next_cursor": _encode_query_cursor(sql, offset + limit) if more else None}
+
+            # WRITE query → start savepoint
+            cur.execute("SAVEPOINT tmp_sp;")
+            savepoint_created = True
+
+            cur.execute(sql)
+            affected = cur.rowcount
+
+            if commit:
+                # RELEASE first: it ends the transaction SAVEPOINT opened, commit() makes sure it's durable
+                cur.execute("RELEASE tmp_sp;")
+                conn.commit()
+                return {"type": "write", "affected": affected, "note": "committed"}
+
+            else:
+                cur.execute("ROLLBACK TO tmp_sp;")
+                cur.execute("RELEASE tmp_sp;")
+                return {"type": "write", "affected": affected, "note": "rolled back (use commit=True to persist)"}
+
+        except Exception as e:
+            budget.stop()
+            # Rollback only if savepoint was created
+            if savepoint_created:
+                try:
+                    cur.execute("ROLLBACK TO tmp_sp;")
+                    cur.execute("RELEASE tmp_sp;")
+                except:
+                    pass
+
+            if budget.exceeded:
+                return budget.error().to_dict()
+            return {"type": "error", "error": str(e)}
+
+
+def stream_query_ndjson(db_file, sql, max_rows=None, user_id=None):
+    """
+    Yields a read query's result as NDJSON: a {"columns": [...]} header, one
+    JSON array per row, then a {"done": true, "row_count": n} trailer. The
+    query runs in a sandbox worker (_spool_query_ndjson), which writes the
+    stream to a spool file chunk by chunk; this generator follows that file,
+    so the web process never runs the SQL and SQLite never waits on a slow
+    consumer. The first item is b"" once the console query slot is held, so
+    callers can prime the generator and get a refusal (QueryBudgetExceeded)
+    up front. The slot is released when the worker is done or the generator
+    is closed, whichever comes first; closing early also stops the worker.
+    """
+    max_rows = QUERY_STREAM_MAX_ROWS if max_rows is None else max_rows
+    slot = spool = future = None
+    try:
+        slot = acquire_query_slot(user_id, db_file)
+        yield b""
+        fd, spool = tempfile.mkstemp(prefix="sdm-stream-", suffix=".ndjson")
+        os.close(fd)
+        # shared for the whole stream (the worker takes its own as well), so it can't be archived under us
+        with version_lock(db_file, shared=True), open(spool, "rb") as f:
+            executor = get_sql_executor() if SQL_PROCESSES > 0 else None
+            try:
+                future = (executor or _stream_threads).submit(_spool_query_ndjson, db_file, sql, max_rows, spool)
+                while True:
+                    done = future.done()
+                    if done and slot is not None:
+                        release_query_slot(slot)
+                        slot = None
+                    data = f.read(1 << 16)
+                    if data:
+                        yield data
+                    elif done:
+                        break
+                    else:
+                        time.sleep(QUERY_STREAM_POLL_SECONDS)
+                future.result()
+            except BrokenProcessPool as e:
+                _reset_sql_executor(executor)
+                yield (json.dumps({"type": "error", "error": f"SQL worker process died (crash or memory limit): {e}"})
+                       + "\n").encode("utf-8")
+    finally:
+        if future is not None:
+            future.cancel()
+        if slot is not None:
+            release_query_slot(slot)
+        if spool is not None:
+            os.remove(spool)  # a worker still writing sees the unlink and stops
+
+_stream_threads = ThreadPoolExecutor(thread_name_prefix="sdm-sql-stream")  # SQL_PROCESSES = 0
+
+def _spool_query_ndjson(db_file, sql, max_rows, spool_path):
+    # sandbox side of stream_query_ndjson: writes the NDJSON stream to spool_path,
+    # flushing every chunk; gives up once the web process has removed the file
+    try:
+        out = open(spool_path, "r+")  # never re-creates a spool the reader already dropped
+    except FileNotFoundError:
+        return
+    with out, version_lock(db_file, shared=True), sqlite_connection(db_file) as conn, query_budget(conn) as budget:
+        def write(text):
+            out.write(text)
+            out.flush()
+        try:
+            cur = conn.execute(sql)
+        except Exception as e:
+            write(json.dumps(budget.error().to_dict() if budget.exceeded else {"type": "error", "error": str(e)}) + "\n")
+            return
+        cols = [d[0] for d in cur.description] if cur.description else []
+        write(json.dumps({"type": "select", "columns": cols}) + "\n")
+        sent = 0
+        try:
+            while sent < max_rows:
+                batch = cur.fetchmany(min(500, max_rows - sent))
+                if not batch:
+                    break
+                sent += len(batch)
+                write("".join(json.dumps(_json_row(row)) + "\n" for row in batch))
+                if os.fstat(out.fileno()).st_nlink == 0:
+                    return  # the client went away
+        except Exception as e:
+            err = budget.error().to_dict() if budget.exceeded else {"type": "error", "error": str(e)}
+            write(json.dumps(dict(err, row_count=sent)) + "\n")
+            return
+        truncated = sent >= max_rows and cur.fetchone() is not None
+        write(json.dumps({"done": True, "row_count": sent, "truncated": truncated}) + "\n")
+
+
+# ---------- Index advisor ----------
+QUERY_HISTORY_FILENAME = "query_history.json"
+_query_history_lock = threading.Lock()       # guards _pending_history only (request path)
+_query_history_file_lock = threading.Lock()  # serializes read-merge-write of the files
+_pending_history = {}                        # history path -> {normalized sql: [runs, last_run]}
+_history_flusher_started = False
+
+# string literals, quoted identifiers and comments are kept verbatim; only the
+# whitespace between tokens is collapsed
+_SQL_WS_TOKEN_RE = re.compile(r"""('(?:[^']|'')*'?|"(?:[^"]|"")*"?|`[^`]*`?|\[[^\]]*\]?|--[^\n]*\n?|/\*.*?(?:\*/|$))|\s+""", re.S)
+
+def _normalize_sql(sql):
+    collapsed = _SQL_WS_TOKEN_RE.sub(lambda m: m.group(1) or " ", sql or "")
+    return collapsed.strip().rstrip(";").strip()
+
+def _history_path(version_obj):
+    return os.path.join(os.path.dirname(version_obj.schema_file), QUERY_HISTORY_FILENAME)
+
+def record_query_history(version_obj, sql):
+    # console statements feed the index advisor's workload; counted in memory here
+    # and merged into query_history.json by the flusher thread
+    key = _normalize_sql(sql)
+    if not key or not version_obj.schema_file:
+        return
+    path = _history_path(version_obj)
+    with _query_history_lock:
+        entry = _pending_history.setdefault(path, {}).setdefault(key, [0, 0.0])
+        entry[0] += 1
+        entry[1] = time.time()
+    if not _history_flusher_started:
+        _start_history_flusher()
+
+def flush_query_history(path=None):
+    """Merges pending console counts into the history files (one file when `path` is given)."""
+    global _pending_history
+    with _query_history_lock:
+        if path is None:
+            pending, _pending_history = _pending_history, {}
+        else:
+            pending = {path: _pending_history.pop(path)} if path in _pending_history else {}
+    for p, runs in pending.items():
+        if not os.path.isdir(os.path.dirname(p)):
+            continue  # version deleted since
+        with _query_history_file_lock:
+            try:
+                history = json.load(open(p))
+            except Exception:
+                history = []
+            by_sql = {e["sql"]: e for e in history}
+            for key, (count, last_run) in runs.items():
+                entry = by_sql.get(key)
+                if entry is None:
+                    history.append({"sql": key, "count": count, "last_run": last_run})
+                else:
+                    entry["count"] += count
+                    entry["last_run"] = max(entry["last_run"], last_run)
+            history = sorted(history, key=lambda e: e["last_run"])[-QUERY_HISTORY_SIZE:]
+            try:
+                replace_file(p, json.dumps(history, indent=2))
+            except OSError as e:
+                print("Warning: writing query history failed:", e)
+
+def _history_flusher_loop():
+    while True:
+        time.sleep(QUERY_HISTORY_FLUSH_SECONDS)
+        try:
+            flush_query_history()
+        except Exception as e:
+            print("Warning: query history flush failed:", e)
+
+def _start_history_flusher():
+    global _history_flusher_started
+    with _query_history_lock:
+        if _history_flusher_started:
+            return
+        _history_flusher_started = True
+    atexit.register(flush_query_history)
+    threading.Thread(target=_history_flusher_loop, name="sdm-history-flush", daemon=True).start()
+
+def load_query_history(version_obj):
+    if not version_obj.schema_file:
+        return []
+    flush_query_history(_history_path(version_obj))
+    if not os.path.exists(_history_path(version_obj)):
+        return []
+    try:
+        return json.load(open(_history_path(version_obj)))
+    except Exception:
+        return []
+
+def _advisor_workload(version_obj):
+    workload = OrderedDict()
+    def add(sql, weight, source):
+        key = _normalize_sql(sql)
+        if not _PLANNED_STATEMENT_RE.match(key):
+            return
+        item = workload.setdefault(key, {"sql": key, "weight": 0, "sources": []})
+        item["weight"] += weight
+        if source not in item["sources"]:
+            item["sources"].append(source)
+    tests = []
+    if version_obj.test_file and os.path.exists(version_obj.test_file):
+        try:
+            tests = json.load(open(version_obj.test_file))
+        except Exception:
+            tests = []
+    for t in tests:
+        for stmt in (t.get("sql") or "").split(";"):
+            add(stmt, 1, "test")
+    for entry in load_query_history(version_obj):
+        add(entry["sql"], entry.get("count", 1), "console")
+    return list(workload.values())
+
+def _statement_column_usage(stmt, table_columns):
+    """
+    Columns a statement filters, joins or sorts on, per table:
+      {table_lower: {"table", "eq": [...], "range": [...], "order": [...]}}
+    `table_columns` maps lowercase table -> set of lowercase column names and
+    resolves unqualified columns when more than one table is involved.
+    """
+    try:
+        tree = parse_one(stmt, read="sqlite")
+    except Exception:
+        return {}
+    aliases = {}
+    involved = []
+    for t in tree.find_all(exp.Table):
+        if t.name:
+            aliases[t.alias_or_name.lower()] = t.name
+            aliases.setdefault(t.name.lower(), t.name)
+            if t.name not in involved:
+                involved.append(t.name)
+    usage = {}
+
+    def resolve(col):
+        if col.table:
+            return aliases.get(col.table.lower())
+        owners = [t for t in involved if col.name.lower() in table_columns.get(t.lower(), ())]
+        if len(owners) == 1:
+            return owners[0]
+        return involved[0] if len(involved) == 1 else None
+
+    def add(kind, col):
+        table = resolve(col)
+        if not table or not col.name:
+            return
+        entry = usage.setdefault(table.lower(), {"table": table, "eq": [], "range": [], "order": []})
+        if col.name not in entry[kind]:
+            entry[kind].append(col.name)
+
+    conditions = [w.this for w in tree.find_all(exp.Where)]
+    conditions += [j.args["on"] for j in tree.find_all(exp.Join) if j.args.get("on") is not None]
+    for root in conditions:
+        for node in root.find_all(exp.EQ, exp.In, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between):
+            kind = "eq" if isinstance(node, (exp.EQ, exp.In)) else "range"
+            sides = [node.this] if isinstance(node, (exp.In, exp.Between)) else [node.this, node.expression]
+            for side in sides:
+                if isinstance(side, exp.Column):
+                    add(kind, side)
+    for clause in list(tree.find_all(exp.Order)) + list(tree.find_all(exp.Group)):
+        for col in clause.find_all(exp.Column):
+            add("order", col)
+    return usage
+
+def _index_prefixes(conn):
+    # {table_lower: [[col, ...], ...]} for every index (and rowid primary key) already present
+    out = {}
+    tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    for table in tables:
+        prefixes = []
+        for idx in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+            cols = [r[2] for r in conn.execute(f'PRAGMA index_info("{idx[1]}")')]
+            prefixes.append([c.lower() for c in cols if c])
+        pk = [r for r in conn.execute(f'PRAGMA table_info("{table}")') if r[5]]
+        if len(pk) == 1 and (pk[0][2] or "").strip().upper() == "INTEGER":
+            prefixes.append([pk[0][1].lower()])
+        out[table.lower()] = prefixes
+    return out
+
+def _time_statement(conn, sql, runs=None):
+    # best-of-N wall time (ms) inside a rolled-back savepoint; None if it fails
+    runs = ADVISOR_TIMING_RUNS if runs is None else runs
+    best = None
+    deadline = [0.0]
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline[0] else 0, 1000)
+    try:
+        for _ in range(max(1, runs)):
+            deadline[0] = time.monotonic() + TEST_TIMEOUT
+            conn.execute("SAVEPOINT advisor_sp;")
+            try:
+                started = time.perf_counter()
+                conn.execute(sql).fetchall()
+                elapsed = (time.perf_counter() - started) * 1000
+            except sqlite3.Error:
+                return None
+            finally:
+                conn.execute("ROLLBACK TO advisor_sp;")
+                conn.execute("RELEASE advisor_sp;")
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        conn.set_progress_handler(None, 0)
+    return round(best, 3)
+
+def _index_name(table, columns, taken):
+    base = re.sub(r"\W+", "_", f"idx_{table}_{'_'.join(columns)}").lower()
+    name, n = base, 2
+    while name in taken:
+        name, n = f"{base}_{n}", n + 1
+    taken.add(name)
+    return name
+
+def advise_indexes(version_obj, max_indexes=None):
+    """
+    Runs the version's test suite and console history through EXPLAIN QUERY
+    PLAN on a snapshot of its DB, proposes CREATE INDEX statements for full
+    scans and temp B-tree sorts ranked by estimated benefit, then measures
+    the affected statements before and after applying them to the snapshot.
+    """
+    max_indexes = ADVISOR_MAX_INDEXES if max_indexes is None else max_indexes
+    workload = _advisor_workload(version_obj)
+    scratch = tempfile.mkdtemp(prefix="sdm-advisor-", dir=TEST_SNAPSHOT_DIR)
+    snapshot = None
+    try:
+        snapshot = sqlite3.connect(_snapshot_db(version_obj.db_file, scratch), check_same_thread=False)
+        real_tables = {r[0].lower(): r[0] for r in snapshot.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")}
+        table_columns = {t: {r[1].lower() for r in snapshot.execute(f'PRAGMA table_info("{name}")')}
+                         for t, name in real_tables.items()}
+        row_counts = {t: snapshot.execute(f'SELECT count(*) FROM "{name}"').fetchone()[0] for t, name in real_tables.items()}
+        existing = _index_prefixes(snapshot)
+        taken = {r[0].lower() for r in snapshot.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+        candidates = OrderedDict()
+        plans_before = {}
+        for item in workload:
+            plan = explain_query_plan(snapshot, item["sql"], set(real_tables))
+            if not plan or not (plan["full_scans"] or plan["temp_btree"]):
+                continue
+            plans_before[item["sql"]] = plan
+            usage = _statement_column_usage(item["sql"], table_columns)
+            scanned = {t.lower() for t in plan["full_scans"]}
+            for table_key, u in usage.items():
+                if table_key not in real_tables:
+                    continue
+                rows = max(row_counts.get(table_key, 0), ADVISOR_ASSUMED_ROWS)
+                if table_key in scanned and (u["eq"] or u["range"]):
+                    columns = u["eq"][:3] + u["range"][:1]
+                    # a scan visits every row; an index lookup ~log2(rows) pages
+                    benefit = item["weight"] * (rows - math.log2(rows))
+                    reason = "full scan"
+                elif plan["temp_btree"] and u["order"]:
+                    columns = u["order"][:3]
+                    # a temp B-tree sort costs ~rows*log2(rows) comparisons
+                    benefit = item["weight"] * rows * math.log2(rows) / 4
+                    reason = "temp b-tree sort"
+                else:
+                    continue
+                lowered = [c.lower() for c in columns]
+                if any(prefix[:len(lowered)] == lowered for prefix in existing.get(table_key, [])):
+                    continue
+                cand = candidates.setdefault((table_key, tuple(lowered)), {
+                    "table": real_tables[table_key], "columns": columns, "estimated_benefit": 0.0,
+                    "statements": [], "reasons": []})
+                cand["estimated_benefit"] += benefit
+                cand["statements"].append(item["sql"])
+                if reason not in cand["reasons"]:
+                    cand["reasons"].append(reason)
+
+        # an index on (a) is redundant next to one on (a, b): fold it into the wider one
+        for key, cand in list(candidates.items()):
+            wider = [other for okey, other in candidates.items()
+                     if okey[0] == key[0] and len(okey[1]) > len(key[1]) and okey[1][:len(key[1])] == key[1]]
+            if wider:
+                target = max(wider, key=lambda c: c["estimated_benefit"])
+                target["estimated_benefit"] += cand["estimated_benefit"]
+                target["statements"] += [sql for sql in cand["statements"] if sql not in target["statements"]]
+                target["reasons"] += [r for r in cand["reasons"] if r not in target["reasons"]]
+                del candidates[key]
+        proposals = sorted(candidates.values(), key=lambda c: -c["estimated_benefit"])[:max_indexes]
+        affected = list(OrderedDict.fromkeys(sql for p in proposals for sql in p["statements"]))
+        before = {sql: _time_statement(snapshot, sql) for sql in affected}
+        applied = []
+        for p in proposals:
+            p["name"] = _index_name(p["table"], p["columns"], taken)
+            cols = ", ".join(f'"{c}"' for c in p["columns"])
+            p["sql"] = f'CREATE INDEX IF NOT EXISTS {p["name"]} ON "{p["table"]}" ({cols});'
+            p["estimated_benefit"] = round(p["estimated_benefit"], 1)
+            try:
+                snapshot.execute(p["sql"])
+                applied.append(p)
+            except sqlite3.Error as e:
+                print(f"Index advisor: skipping {p['name']}: {e}")
+        snapshot.commit()
+        timings = []
+        for sql in affected:
+            after_plan = explain_query_plan(snapshot, sql, set(real_tables))
+            timings.append({"sql": sql, "before_ms": before[sql], "after_ms": _time_statement(snapshot, sql),
+                            "plan_before": plans_before[sql]["plan"], "plan_after": after_plan["plan"] if after_plan else []})
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {
+        "proposals": applied,
+        "workload": {"statements": len(workload),
+                     "from_tests": sum(1 for w in workload if "test" in w["sources"]),
+                     "from_console": sum(1 for w in workload if "console" in w["sources"])},
+        "timings": {
+            "before_ms": round(sum(t["before_ms"] or 0 for t in timings), 3),
+            "after_ms": round(sum(t["after_ms"] or 0 for t in timings), 3),
+            "statements": timings,
+        },
+    }
+
+def create_indexed_version(user_obj, base_version_obj, advice, job=None):
+    # new version = base schema + the proposed indexes, created through the normal version path
+    base_schema = open(base_version_obj.schema_file).read() if base_version_obj.schema_file and os.path.exists(base_version_obj.schema_file) else ""
+    new_schema = base_schema.rstrip() + "\n\n" + "\n".join(p["sql"] for p in advice["proposals"]) + "\n"
+    tests = []
+    if base_version_obj.test_file and os.path.exists(base_version_obj.test_file):
+        try:
+            tests = json.load(open(base_version_obj.test_file))
+        except Exception:
+            tests = []
+    version = create_version_for_project(user_obj, base_version_obj.project, new_schema, tests, render_mermaid(new_schema),
+                                         base_version_obj=base_version_obj, job=job)
+    with open(os.path.join(os.path.dirname(version.schema_file), "index_advice.json"), "w") as f:
+        json.dump(dict(advice, base_version=base_version_obj.name), f, indent=2)
+    return version
+
+def index_advisor_job(job, user_id, base_version_id):
+    user = User.query.get(user_id)
+    base_version = Version.query.get(base_version_id)
+    with job.stage("analyze"), version_online(base_version):
+        advice = advise_indexes(base_version)
+    if not advice["proposals"]:
+        raise RuntimeError("no index proposals: the workload has no full scans or sorts an index would fix")
+    version = create_indexed_version(user, base_version, advice, job=job)
+    return dict(version_job_result(version), proposals=[p["sql"] for p in advice["proposals"]], timings={
+        "before_ms": advice["timings"]["before_ms"], "after_ms": advice["timings"]["after_ms"]})
+
+# ---------- LLM-driven schema edits ----------
+def estimate_tokens(text):
+    # ~4 characters per token for English/SQL; only used for budgeting
+    return (len(text or "") + 3) // 4
+
+def _word_forms(word):
+    # naive singular/plural variants so "category" finds "categories" and vice versa
+    forms = {word}
+    if word.endswith("ies"):
+        forms.add(word[:-3] + "y")
+    elif word.endswith("es"):
+        forms |= {word[:-2], word[:-1]}
+    elif word.endswith("s"):
+        forms.add(word[:-1])
+    if word.endswith("y"):
+        forms.add(word[:-1] + "ies")
+    forms |= {word + "s", word + "es"}
+    return forms
+
+def _table_summary(table):
+    cols = ", ".join(c["name"] for c in table["columns"][:12]) + (", ..." if len(table["columns"]) > 12 else "")
+    refs = sorted({fk["ref_table"] for fk in table["foreign_keys"]})
+    return f"-- {table['name']}({cols})" + (f" -> {', '.join(refs)}" if refs else "")
+
+def select_schema_context(sql_text, instruction, hops=None, max_tokens=None):
+    """
+    Picks the part of a schema an edit instruction needs: tables it names (or
+    whose columns it names), plus FK neighbours within `hops`, filled in
+    distance order up to `max_tokens`. Everything else becomes a one-line
+    summary comment. Small schemas, and instructions that name no table, get
+    the whole schema. Returns {"sql", "tables", "summarized", "tokens", "full_tokens"}.
+    """
+    hops = LLM_CONTEXT_HOPS if hops is None else hops
+    max_tokens = LLM_CONTEXT_MAX_TOKENS if max_tokens is None else max_tokens
+    full_tokens = estimate_tokens(sql_text)
+    model = parse_schema(sql_text or "")
+    tables = {t["name"].lower(): t for t in model["tables"]}
+    everything = {"sql": sql_text or "", "tables": [t["name"] for t in model["tables"]], "summarized": [],
+                  "tokens": full_tokens, "full_tokens": full_tokens}
+    if full_tokens <= max_tokens or not tables:
+        return everything
+
+    words = set()
+    for w in re.findall(r"[a-z_][a-z0-9_]*", (instruction or "").lower()):
+        words |= _word_forms(w)
+    seeds = [name for name in tables if name in words]
+    if not seeds:
+        seeds = [name for name, t in tables.items()
+                 if any(len(c["name"]) > 3 and c["name"].lower() in words for c in t["columns"])]
+    if not seeds:
+        return everything
+
+    # undirected FK graph, walked breadth-first from the named tables
+    graph = {name: set() for name in tables}
+    for name, t in tables.items():
+        for fk in t["foreign_keys"]:
+            ref = fk["ref_table"].lower()
+            if ref in graph:
+                graph[name].add(ref)
+                graph[ref].add(name)
+    order, dist = list(seeds), {name: 0 for name in seeds}
+    for name in order:
+        if dist[name] >= hops:
+            continue
+        for nb in sorted(graph[name]):
+            if nb not in dist:
+                dist[nb] = dist[name] + 1
+                order.append(nb)
+
+    selected, used = [], 0
+    for name in order:
+        cost = estimate_tokens(tables[name]["sql"])
+        if dist[name] > 0 and used + cost > max_tokens:
+            continue  # named tables always go in; neighbours only while they fit
+        selected.append(name)
+        used += cost
+    chosen = set(selected)
+    indexes = [i["sql"] for i in model["indexes"] if i["table"].lower() in chosen]
+    others = [t for name, t in tables.items() if name not in chosen]
+    parts = [tables[name]["sql"] for name in selected] + indexes
+    if others:
+        parts.append("-- Other tables (not shown in full; keep them unless the instruction says otherwise):\n"
+                     + "\n".join(_table_summary(t) for t in others))
+    context = "\n\n".join(parts)
+    return {"sql": context, "tables": [tables[name]["name"] for name in selected],
+            "summarized": [t["name"] for t in others], "tokens": estimate_tokens(context), "full_tokens": full_tokens}
+
+def ask_llm_modify_schema(old_schema_sql, user_instruction, use_cache=True, on_token=None):
+    system_prompt = """
+You are a database schema assistant. Given an existing SQL schema and a user's instruction to modify it,
+you must output a JSON object with two keys: "edits" and "test_suite".
+- "edits" is an array; each element is an object:
+  - "action": one of "m" (modify table), "a" (add table), "r" (remove table)
+  - "table": affected table name (string)
+  - "sql": only for "m" or "a": the full CREATE TABLE statement for the resulting table
+  - "rationale": one-sentence explanation
+- "test_suite" is an array of test objects with keys: name,type,sql,rationale
+
+Respond with *only* a single ```json block``` containing this object.
+"""
+
+    def parse_response(content):
+        json_text = content.split("```json")[1].split("```")[0].strip()
+        return json.loads(json_text)
+
+    # large schemas: only the tables the instruction touches go in full (edits merge over the whole base schema)
+    context = select_schema_context(old_schema_sql, user_instruction)
+    logger.info("modify_schema context: %d/%d tables, ~%d/%d tokens", len(context["tables"]),
+                len(context["tables"]) + len(context["summarized"]), context["tokens"], context["full_tokens"])
+    try:
+        result = ask_llm(system_prompt, f"Here is the current schema:\n\n{context['sql']}\n\nInstruction: {user_instruction}",
+                         parse=parse_response, use_cache=use_cache, on_token=on_token)
+        if isinstance(result, dict):
+            result["context"] = {k: context[k] for k in ("tables", "summarized", "tokens", "full_tokens")}
+        return result
+    except Exception as e:
+        print("LLM modification failed:", e)
+        return {"error": str(e)}
 
-    sql = sql_text.replace("\n", " ").replace("\t", " ")
-    sql = re.sub(r"\s+", " ", sql)
+def _split_create_table_blocks(sql_text):
+    return [{"name": t["name"], "sql": t["sql"]} for t in parse_schema(sql_text)["tables"]]
 
-    table_blocks = re.findall(
-        r"CREATE TABLE\s+([A-Za-z_][A-Za-z0-9_]*)\s*\((.*?)\);",
-        sql,
-        re.IGNORECASE
-    )
+def apply_llm_edits_and_create_version(user_obj, project_obj, base_version_obj, edits_obj, job=None):
+    print("editing schema")
+    with job_stage(job, "merge"):
+        base_schema = ""
+        if base_version_obj and base_version_obj.schema_file and os.path.exists(base_version_obj.schema_file):
+            base_schema = open(base_version_obj.schema_file).read()
+        blocks = {b["name"]: b for b in _split_create_table_blocks(base_schema)}
+        edits = edits_obj.get("edits", [])
+        for e in edits:
+            action = e.get("action")
+            tbl = e.get("table")
+            if action == "r":
+                if tbl in blocks:
+                    del blocks[tbl]
+            elif action in ("m","a"):
+                sql = e.get("sql", "")
+                if sql:
+                    blocks[tbl] = {"name": tbl, "sql": sql}
+        new_schema = "\n\n".join([b["sql"] for b in blocks.values()])
+        # carry the base version's indexes over when their table and columns survived the edit
+        kept = []
+        for idx in parse_schema(base_schema)["indexes"]:
+            block = blocks.get(idx["table"])
+            if not block:
+                continue
+            tables = parse_schema(block["sql"])["tables"]
+            columns = {c["name"].lower() for t in tables for c in t["columns"]}
+            if all(c.lower() in columns for c in idx["columns"]):
+                kept.append(idx["sql"])
+        if kept:
+            new_schema += "\n\n" + "\n".join(kept)
+        new_tests = edits_obj.get("test_suite", [])
+        # try to generate mermaid for new schema
+        try:
+            mermaid = render_mermaid(new_schema)
+        except Exception:
+            mermaid = ""
+        if job is not None:
+            job.emit("schema", {"sql": new_schema, "report": check_schema(new_schema), "mermaid": mermaid})
+    new_version = create_version_for_project(user_obj, project_obj, new_schema, new_tests, mermaid,
+                                             base_version_obj=base_version_obj, job=job)
+    return new_version
 
-    if not table_blocks:
-        print("DEBUG: No CREATE TABLE statements found.")
-        return "erDiagram\n    ErrorTable {{ string error }}\n    ErrorTable ||--|| ErrorTable : none"
+# ---------- Incremental schema preview (streamed LLM output) ----------
+_JSON_SQL_VALUE_RE = re.compile(r'"sql"\s*:\s*"((?:[^"\\]|\\.)*)"')
 
-    mermaid = ["erDiagram"]
-    relationships = []
+class IncrementalSchemaParser:
+    """
+    Follows a streamed LLM response and reports each CREATE TABLE as soon as
+    its statement is complete, with its check_schema findings and Mermaid
+    fragment. mode="sql" reads the ```sql block of a generated schema;
+    mode="edits" reads the "sql" values of a JSON edit list and previews them
+    applied over `base_schema`. Each chunk only scans the text after the last
+    complete statement, and only the new statement is parsed and linted.
+    """
+    def __init__(self, mode="sql", base_schema=""):
+        self.mode = mode
+        self.base = {b["name"].lower(): b["sql"] for b in _split_create_table_blocks(base_schema or "")}
+        self.base_model = parse_schema(base_schema) if mode == "edits" and base_schema else None
+        self.reset()
 
-    for table_name, cols_raw in table_blocks:
-        print(f"\n--- DEBUG: Processing table: {table_name} ---")
-
-        # ESCAPED braces for f-string
-        mermaid.append(f"    {table_name} {{")  # OK, not an f-string that needs escaping
-
-        # Split safe (ignore commas inside parentheses)
-        cols = []
-        depth = 0
-        current = ""
-        for ch in cols_raw:
-            if ch == "(":
-                depth += 1
-            elif ch == ")":
-                depth -= 1
-
-            if ch == "," and depth == 0:
-                cols.append(current.strip())
-                current = ""
-            else:
-                current += ch
-        if current.strip():
-            cols.append(current.strip())
-
-        # Process each column / constraint
-        for col_line in cols:
-            raw = col_line.strip()
-
-            # Skip constraints
-            if re.match(r"^(PRIMARY KEY|FOREIGN KEY|UNIQUE|CHECK|CONSTRAINT)",
-                        raw, re.IGNORECASE):
-                print(f"  SKIP constraint → {raw}")
-                continue
+    def reset(self):
+        self.text = ""
+        self.tables = OrderedDict()
+        self._body_start = None  # sql mode: offset of the ```sql block body
+        self._offset = 0         # end of the last complete statement (body offset / JSON position)
+        # table/index models seen so far (base schema first): the lint context for new tables
+        self._known = {t["name"].lower(): t for t in (self.base_model or {}).get("tables", [])}
+        self._indexes = list((self.base_model or {}).get("indexes", []))
 
-            # Column name + type
-            m = re.match(r"([A-Za-z_][A-Za-z0-9_]*)\s+([A-Za-z0-9()]+)", raw)
+    def feed(self, chunk):
+        if chunk is None:  # a new (retried) attempt starts
+            self.reset()
+            return []
+        self.text += chunk
+        # a statement can only have completed if this chunk closed it
+        if not any(mark in chunk for mark in (";", "`", '"')):
+            return []
+        new = []
+        for stmt in self._new_statements():
+            # an uncached model of the statement alone: re-parsing the growing preview
+            # would be quadratic and flood the schema/diagram caches with one-offs
+            model = _build_schema_model(stmt)
+            self._indexes += model["indexes"]
+            m = _CREATE_TABLE_NAME_RE.match(stmt)
             if not m:
-                print(f"  SKIP unrecognized line → {raw}")
                 continue
+            name = m.group(1)
+            self.tables[name.lower()] = stmt
+            for table in model["tables"]:
+                self._known[table["name"].lower()] = table
+            new.append(self._table_event(name, stmt, model))
+        return new
 
-            col_name = m.group(1)
-            sql_type = m.group(2).upper()
-
-            # Map SQLite types → Mermaid types
-            type_map = {
-                "INTEGER": "int",
-                "TEXT": "string",
-                "REAL": "float",
-                "DATETIME": "datetime",
-            }
-            mermaid_type = type_map.get(sql_type, "string")
-
-            pk = "PK" if "PRIMARY KEY" in raw.upper() else ""
-
-            col_line_out = f"        {mermaid_type} {col_name}"
-            if pk:
-                col_line_out += " PK"
+    def _new_statements(self):
+        if self.mode == "edits":
+            out = []
+            for m in _JSON_SQL_VALUE_RE.finditer(self.text, self._offset):
+                self._offset = m.end()
+                try:
+                    out.append(json.loads(f'"{m.group(1)}"').strip())
+                except ValueError:
+                    out.append("")
+            return out
+        if self._body_start is None:
+            start = self.text.find("```sql")
+            if start < 0:
+                return []
+            self._body_start = start + len("```sql")
+        body = self.text[self._body_start:]
+        closed = "```" in body
+        rest = body.split("```")[0][self._offset:]
+        spans = _split_statements(rest)
+        if spans and not closed and not sqlite3.complete_statement(rest[spans[-1][0]:spans[-1][1]]):
+            spans.pop()  # still being written
+        if spans:
+            self._offset += spans[-1][1]
+        return [rest[a:b] for a, b in spans]
 
-            print(f"  ADD column → {col_line_out}")
-            mermaid.append(col_line_out)
+    def preview_sql(self):
+        if self.mode == "edits":
+            merged = dict(self.base, **self.tables)
+            return "\n\n".join(merged.values())
+        return "\n\n".join(self.tables.values())
 
-        # Now detect FK constraints globally in block
-        fk_matches = re.findall(
-            r"FOREIGN KEY\s*\(\s*([A-Za-z_]+)\s*\)\s*REFERENCES\s*([A-Za-z_]+)\s*\(\s*([A-Za-z_]+)\s*\)",
-            cols_raw,
-            re.IGNORECASE
-        )
+    def _table_event(self, name, stmt, model):
+        # lint the new table against the tables its foreign keys reference and the
+        # indexes seen so far, not the whole preview
+        tables = list(model["tables"])
+        for table in model["tables"]:
+            for fk in table["foreign_keys"]:
+                ref = self._known.get((fk["ref_table"] or "").lower())
+                if ref is not None and ref not in tables:
+                    tables.append(ref)
+        names = {t["name"].lower() for t in model["tables"]}
+        context = dict(model, tables=tables, indexes=[i for i in self._indexes if i["table"].lower() in names])
+        findings = [f for f in check_schema(stmt, model=context) if (f.get("table") or "").lower() == name.lower()
+                    or (f["type"] == "error" and f.get("sql") == stmt)]
+        try:
+            mermaid = sql_to_mermaid(stmt, model=model)
+        except Exception:
+            mermaid = ""
+        return {"table": name, "sql": stmt, "findings": findings, "mermaid": mermaid}
 
-        for fk_col, ref_table, ref_col in fk_matches:
-            print(f"  ADD FK → {table_name}.{fk_col} → {ref_table}.{ref_col}")
+def streaming_preview(job, parser):
+    # on_token callback: forwards tokens and completed tables to the job's event log
+    def on_token(chunk):
+        if chunk is None:
+            job.emit("reset", {})
+        else:
+            job.emit("token", {"text": chunk})
+        for event in parser.feed(chunk):
+            job.emit("table", event)
+    return on_token
 
-            # ESCAPED BRACES: }} and {{
-            rel = (
-                f"    {table_name} }}o--|| {ref_table} : "
-                f"{fk_col} to {ref_col}"
-            )
+# ---------- Background version-creation jobs ----------
+JOB_ORPHANED_ERROR = "the worker running this job stopped before it finished"
 
-            if rel not in relationships:
-                relationships.append(rel)
+class JobStore:
+    """
+    Job state, event logs and batches in a WAL-mode SQLite file under
+    DATA_ROOT, so any worker process can answer /jobs/<id> and /batches/<id>
+    polls and event streams for work another one runs. The running process writes every change through and
+    refreshes a heartbeat; a queued or running job whose heartbeat has gone
+    stale (its worker exited or was recycled) is marked failed when it is
+    next read, and by the sweep each process runs when it starts.
+    """
+    def __init__(self, path, history=JOB_HISTORY, orphan_after=JOB_ORPHAN_SECONDS):
+        self.path = path
+        self.history = history
+        self.orphan_after = orphan_after
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
 
-        # Close block (OK, not part of an f-string)
-        mermaid.append("    }")
+    def _db(self):
+        if self._conn is None or self._pid != os.getpid():  # never reuse a connection across fork
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id INTEGER, project_id INTEGER,
+                    status TEXT NOT NULL, error TEXT, result TEXT, stages TEXT NOT NULL, created_at REAL NOT NULL,
+                    started_at REAL, finished_at REAL, heartbeat REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT, data TEXT,
+                    PRIMARY KEY (job_id, seq)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS batches (
+                    id TEXT PRIMARY KEY, user_id INTEGER, project_id INTEGER, created_at REAL NOT NULL,
+                    items TEXT NOT NULL);
+            """)
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
 
-    mermaid.extend(relationships)
+    def save(self, job):
+        # the job's state; its events are appended one by one
+        with job._lock:
+            stages = json.dumps(job.stages, default=str)
+        result = json.dumps(job.result, default=str) if job.result is not None else None
+        with self._lock:
+            conn = self._db()
+            conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job.id, job.kind, job.user_id, job.project_id, job.status, job.error, result, stages,
+                          job.created_at, job.started_at, job.finished_at, time.time()))
+            conn.commit()
 
-    print("\n=== DEBUG: Completed Successfully ===\n")
+    def append_event(self, job_id, seq, event, data):
+        with self._lock:
+            conn = self._db()
+            conn.execute("INSERT OR REPLACE INTO job_events VALUES (?, ?, ?, ?)",
+                         (job_id, seq, event, json.dumps(data, default=str)))
+            conn.commit()
 
-    st= "\n".join(mermaid)
-    st= fix_mermaid_relations(st)
-    return st
+    def rewrite_events(self, job_id, entries):
+        # entries: {seq: (event, data) or None}; None blanks an entry merged into an earlier one
+        with self._lock:
+            conn = self._db()
+            conn.executemany("UPDATE job_events SET event = ?, data = ? WHERE job_id = ? AND seq = ?",
+                             [(e[0], json.dumps(e[1], default=str), job_id, seq) if e else (None, None, job_id, seq)
+                              for seq, e in entries.items()])
+            conn.commit()
 
+    def events(self, job_id, start=0):
+        with self._lock:
+            rows = self._db().execute("SELECT event, data FROM job_events WHERE job_id = ? AND seq >= ? ORDER BY seq",
+                                      (job_id, start)).fetchall()
+        return [(r["event"], json.loads(r["data"])) if r["event"] else None for r in rows]
 
-def check_schema(sql_schema):
-    report = []
-    try:
-        parsed_expressions = parse(sql_schema)
-        if not parsed_expressions:
-            report.append({"type": "error", "message": "SQL schema is empty or could not be parsed."})
-            return report
-        tables = {}
-        # First pass: find table names
-        for expr in parsed_expressions:
-            if isinstance(expr, exp.Create) and expr.kind == 'TABLE':
-                table_name = expr.this.this.name
-                tables[table_name] = {'pk': False}
-                if not table_name.islower():
-                    report.append({"type":"warning","table":table_name,"message":f"Naming Convention: Table '{table_name}' is not in lowercase."})
-                for constraint in expr.constraints:
-                    if isinstance(constraint, exp.PrimaryKey):
-                        tables[table_name]['pk'] = True
-                for col_def in expr.find_all(exp.ColumnDef):
-                    if any(isinstance(c, exp.PrimaryKey) for c in col_def.constraints):
-                        tables[table_name]['pk'] = True
-        # second pass: check PKs and FKs
-        for expr in parsed_expressions:
-            if isinstance(expr, exp.Create) and expr.kind == 'TABLE':
-                table_name = expr.this.this.name
-                if not tables[table_name]['pk']:
-                    report.append({"type":"error","table":table_name,"message":f"Missing Primary Key: Table '{table_name}' does not have a PRIMARY KEY defined."})
-                for constraint in expr.constraints:
-                    if isinstance(constraint, exp.ForeignKey):
-                        ref_table = constraint.find(exp.Reference).this.this.name
-                        if ref_table not in tables:
-                            report.append({"type":"error","table":table_name,"message":f"Invalid Foreign Key: Table '{table_name}' has a FOREIGN KEY that references a non-existent table '{ref_table}'."})
-        if not report:
-            report.append({"type":"success","message":"All static checks passed!"})
-        return report
-    except Exception as e:
-        return [{"type":"error","message":f"Schema Parsing Error: {str(e)}"}]
+    def load(self, job_id):
+        """The job's row as a dict (None if unknown or pruned); an orphaned job is failed first."""
+        with self._lock:
+            row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is not None and row["finished_at"] is None and row["heartbeat"] < time.time() - self.orphan_after:
+            self.fail_orphans()
+            with self._lock:
+                row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        data = dict(row)
+        data["stages"] = json.loads(data["stages"])
+        data["result"] = json.loads(data["result"]) if data["result"] is not None else None
+        return data
 
-def generate_test_suite(sql_schema):
-    print("Generating test suite with rationales...")
-    test_gen_prompt = ChatPromptTemplate.from_messages([
-        ("system", """
-You are a database test case generator. Given a SQL schema, you must generate a JSON array of test transactions.
-Each object in the array must have **four** keys:
-Always generate SQL compatible with SQLite. Use INTEGER PRIMARY KEY AUTOINCREMENT instead of AUTO_INCREMENT.
-Do not use MySQL-specific syntax.
-1. "name": A short description of the test.
-2. "type": Either 'normal' or 'edge'.
-3. "sql": The full SQL command for the test (e.g., INSERT, UPDATE, SELECT, DELETE).
-4. "rationale": A brief, one-sentence explanation for *why* this test is important.
+    def heartbeat(self, job_ids):
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            conn.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ?", [(now, i) for i in job_ids])
+            conn.commit()
 
-Generate at least 5 normal tests and 5 edge case tests.
-Respond with *only* the JSON array inside a single ```json code block.
-"""),
-        ("user", f"Here is the schema:\n\n{sql_schema}")
-    ])
-    chain = test_gen_prompt | llm
-    try:
-        response = chain.invoke({"sql_schema": sql_schema})
-        content = response.content
-        json_response_str = content.split("```json")[1].split("```")[0].strip()
-        test_suite = json.loads(json_response_str)
-        return test_suite
-    except Exception as e:
-        print(f"Error generating test suite: {e}")
-        return [{"name":"Error generating test suite","type":"error","sql":str(e),"rationale":"An error occurred during test generation."}]
+    def fail_orphans(self, now=None):
+        """Marks queued/running jobs without a recent heartbeat as failed; returns how many."""
+        now = now or time.time()
+        with self._lock:
+            conn = self._db()
+            orphans = [r["id"] for r in conn.execute("SELECT id FROM jobs WHERE finished_at IS NULL AND heartbeat < ?",
+                                                     (now - self.orphan_after,))]
+            for job_id in orphans:
+                seq = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM job_events WHERE job_id = ?",
+                                   (job_id,)).fetchone()[0]
+                conn.execute("UPDATE jobs SET status = 'error', error = ?, finished_at = ? WHERE id = ?",
+                             (JOB_ORPHANED_ERROR, now, job_id))
+                conn.execute("INSERT OR REPLACE INTO job_events VALUES (?, ?, 'error', ?)",
+                             (job_id, seq, json.dumps({"result": None, "error": JOB_ORPHANED_ERROR})))
+            conn.commit()
+        return len(orphans)
 
-# ---------- Utility generator (heuristic, can be improved with LLM) ----------
-def generate_utility_table_from_schema(sql_text):
-    """
-    Generates a detailed utility explanation table using an LLM.
-    The LLM explains:
-      - Why each table exists
-      - Why each attribute exists
-    """
-    # -----------------------------
-    # 1. Extract tables + columns
-    # -----------------------------
-    tables = {}
-    pattern = r"CREATE TABLE\s+[`\"]?(\w+)[`\"]?\s*\((.*?)\);"
-    matches = re.findall(pattern, sql_text, flags=re.S)
-
-    for table_name, body in matches:
-        cols = []
-        for line in body.split(","):
-            line = line.strip()
-            if line == "":
-                continue
-            col_name = line.split()[0].strip('`"')
-            cols.append(col_name)
-        tables[table_name] = cols
+    def prune(self):
+        # keeps the newest `history` finished jobs
+        with self._lock:
+            conn = self._db()
+            old = [(r["id"],) for r in conn.execute(
+                "SELECT id FROM jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT -1 OFFSET ?",
+                (self.history,))]
+            conn.executemany("DELETE FROM job_events WHERE job_id = ?", old)
+            conn.executemany("DELETE FROM jobs WHERE id = ?", old)
+            conn.execute("DELETE FROM batches WHERE id IN (SELECT id FROM batches ORDER BY created_at DESC "
+                         "LIMIT -1 OFFSET ?)", (self.history,))
+            conn.commit()
 
-    # -----------------------------
-    # 2. Ask the LLM to explain each table
-    # -----------------------------
-    final_doc = ["# Utility Table\n\n",
-                 "This document explains the purpose of each table and why key attributes exist.\n\n"]
+    def save_batch(self, batch):
+        with self._lock:
+            conn = self._db()
+            conn.execute("INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, ?)",
+                         (batch["id"], batch["user_id"], batch["project_id"], batch["created_at"],
+                          json.dumps(batch["items"])))
+            conn.commit()
 
-    for table_name, columns in tables.items():
+    def load_batch(self, batch_id):
+        with self._lock:
+            row = self._db().execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return dict(row, items=json.loads(row["items"])) if row is not None else None
 
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             """You are a database architect. For the given table name and list of columns:
-1. Explain in 2–4 sentences **why this table exists** in a business context.
-2. For each column, explain its purpose in 1 concise sentence.
-Output must be Markdown ONLY."""
-             ),
-            ("user",
-             f"Table name: {table_name}\nColumns: {columns}")
-        ])
+    def active_count(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM jobs WHERE finished_at IS NULL").fetchone()[0]
 
-        chain = prompt | llm
-        response = chain.invoke({})
+job_store = JobStore(JOB_STORE_PATH)
 
-        explanation_md = response.content.strip()
+class Job:
+    """
+    A unit of background work with named, individually timed stages. The
+    process running it holds the live object and writes it through to
+    job_store; other processes get a read-only view (Job.from_row) that polls
+    the store for state and events.
+    """
+    def __init__(self, kind, user_id, project_id, stages=()):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.user_id = user_id
+        self.project_id = project_id
+        self.status = "queued"          # queued | running | done | error
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stages = [{"name": n, "status": "pending", "seconds": None} for n in stages]
+        self.events = []                # (event, data) log replayed to SSE listeners
+        self.remote = False             # a view of a job run by another process
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
 
-        final_doc.append(f"## Table `{table_name}`\n\n")
-        final_doc.append(explanation_md)
-        final_doc.append("\n\n---\n\n")
+    @classmethod
+    def from_row(cls, row):
+        job = cls(row["kind"], row["user_id"], row["project_id"])
+        job.id = row["id"]
+        job.remote = True
+        job._update(row)
+        return job
 
-    return "".join(final_doc)
+    def _update(self, row):
+        with self._lock:
+            for key in ("status", "error", "result", "created_at", "started_at", "finished_at", "stages"):
+                setattr(self, key, row[key])
 
+    def refresh(self):
+        # remote views: re-read state from the store
+        row = job_store.load(self.id)
+        if row is not None:
+            self._update(row)
 
-# ---------- Version creation / file management ----------
-def create_project(user_obj, project_name):
-    project = Project(name=project_name, owner=user_obj)
-    db.session.add(project)
-    db.session.commit()
-    # create folder
-    project_dir_path = project_dir(user_obj.id, project.id)
-    meta = {"name": project_name, "created_at": project.created_at.isoformat(), "versions": []}
-    with open(os.path.join(project_dir_path, "meta.json"), "w") as f:
-        json.dump(meta, f, indent=2)
-    return project
+    def save(self):
+        if not self.remote:
+            job_store.save(self)
 
-def create_version_for_project(user_obj, project_obj, sql_schema_text, test_suite, mermaid_code=None):
-    # determine version number
-    version_index = len(project_obj.versions) + 1
-    version_name = f"version{version_index}"
-    v_dir = version_dir(user_obj.id, project_obj.id, version_name)
-
-    # write schema
-    schema_path = os.path.join(v_dir, "schema.sql")
-    with open(schema_path, "w") as f:
-        f.write(sql_schema_text or "")
-
-    # write tests
-    test_path = os.path.join(v_dir, "test_suite.json")
-    with open(test_path, "w") as f:
-        json.dump(test_suite or [], f, indent=2)
-
-    # write utility.md
-    util_path = os.path.join(v_dir, "utility.md")
-    util_content = generate_utility_table_from_schema(sql_schema_text or "")
-    with open(util_path, "w") as f:
-        f.write(util_content)
-
-    # mermaid
-    mermaid_path = os.path.join(v_dir, "mermaid.md")
-    with open(mermaid_path, "w") as f:
-        f.write(mermaid_code or "")
-
-    # create a per-version sqlite DB file
-    db_path = os.path.join(v_dir, "backend.db")
-    conn = get_sqlite_conn(db_path)
-    try:
-        if sql_schema_text and sql_schema_text.strip():
-            conn.executescript(sql_schema_text)
-            conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print("Warning: schema execution failed for new version DB:", e)
-    finally:
-        conn.close()
+    def _stage_record(self, name):
+        with self._lock:
+            for rec in self.stages:
+                if rec["name"] == name and rec["status"] == "pending":
+                    return rec
+            rec = {"name": name, "status": "pending", "seconds": None}
+            self.stages.append(rec)
+            return rec
 
-    # persist Version record
-    version = Version(
-        name=version_name,
-        project=project_obj,
-        schema_file=schema_path,
-        test_file=test_path,
-        utility_file=util_path,
-        mermaid_file=mermaid_path,
-        db_file=db_path
-    )
-    db.session.add(version)
-    db.session.commit()
-    # update project meta.json
-    proj_meta_path = os.path.join(project_dir(user_obj.id, project_obj.id), "meta.json")
-    try:
-        meta = json.load(open(proj_meta_path))
-    except Exception:
-        meta = {"name": project_obj.name, "versions": []}
-    meta.setdefault("versions", []).append({
-        "name": version_name,
-        "created_at": version.created_at.isoformat(),
-        "schema_file": schema_path,
-        "test_file": test_path,
-        "utility_file": util_path,
-        "db_file": db_path
-    })
-    with open(proj_meta_path, "w") as f:
-        json.dump(meta, f, indent=2)
-    return version
+    @contextmanager
+    def stage(self, name):
+        rec = self._stage_record(name)
+        with self._lock:
+            rec["status"] = "running"
+        self.save()
+        self.emit("stage", {"name": name, "status": "running"})
+        started = time.time()
+        try:
+            yield rec
+        except Exception as e:
+            with self._lock:
+                rec["status"] = "error"
+                rec["error"] = str(e)
+            raise
+        else:
+            with self._lock:
+                rec["status"] = "done"
+        finally:
+            with self._lock:
+                rec["seconds"] = round(time.time() - started, 3)
+            metrics.observe("sdm_stage_seconds", time.time() - started, stage="job:" + name)
+            self.save()
+            self.emit("stage", {"name": name, "status": rec["status"], "seconds": rec["seconds"]})
 
-def initialize_version_database(schema_path, db_path):
-    import sqlite3
-    with open(schema_path, "r") as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    # Execute the schema
-    cursor.executescript(schema_sql)
-    conn.commit()
-    conn.close()
+    def emit(self, event, data):
+        with self._changed:
+            job_store.append_event(self.id, len(self.events), event, data)
+            self.events.append((event, data))
+            self._changed.notify_all()
 
+    def compact_tokens(self):
+        # once the job is over, each run of token events becomes one event; the rest
+        # become None (skipped by readers) so event ids, i.e. log positions, stay valid
+        with self._changed:
+            changes = {}
+            run = []  # positions of the current run of token events
+            for i, entry in enumerate(self.events + [("end", None)]):
+                if entry is None:
+                    continue
+                if entry[0] == "token":
+                    run.append(i)
+                    continue
+                if len(run) > 1:
+                    self.events[run[0]] = ("token", {"text": "".join(self.events[j][1]["text"] for j in run)})
+                    changes[run[0]] = self.events[run[0]]
+                    for j in run[1:]:
+                        self.events[j] = changes[j] = None
+                run = []
+            if changes:
+                job_store.rewrite_events(self.id, changes)
 
-# ---------- Test and query runners ----------
-def run_tests_against_db(db_file, test_suite):
-    results = []
-    conn = get_sqlite_conn(db_file)
-    cur = conn.cursor()
+    def finish(self):
+        # the final event is already logged, so a reader that sees finished_at has every event
+        with self._changed:
+            self.finished_at = time.time()
+            self._changed.notify_all()
+        self.save()
 
-    for t in test_suite:
-        name = t.get("name", "<unnamed>")
-        sql = t.get("sql", "")
-        t_type = t.get("type", "normal")
+    def events_after(self, index, timeout=15.0):
+        """Events from `index` on; blocks up to `timeout` for new ones while the job is running."""
+        if self.remote:
+            deadline = time.time() + timeout
+            while True:
+                events = job_store.events(self.id, index)
+                if events or self.finished_at or time.time() >= deadline:
+                    return events
+                time.sleep(JOB_POLL_SECONDS)
+                self.refresh()
+        with self._changed:
+            if index >= len(self.events) and not self.finished_at:
+                self._changed.wait(timeout)
+            return self.events[index:]
 
-        try:
-            # Start savepoint
-            cur.execute("SAVEPOINT test_sp;")
+    def parallel(self, stages):
+        # run independent stages side by side; returns {name: result}, re-raises the first failure
+        def run(name, fn):
+            with self.stage(name):
+                return fn()
+        with ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+            futures = {name: pool.submit(run, name, fn) for name, fn in stages.items()}
+            return {name: fut.result() for name, fut in futures.items()}
 
-            # Split into individual statements
-            statements = [s.strip() for s in sql.split(";") if s.strip()]
+    def skip(self, name):
+        rec = self._stage_record(name)
+        with self._lock:
+            rec["status"] = "skipped"
+        self.save()
 
-            for stmt in statements:
-                cur.execute(stmt)
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        with self._lock:
+            stages = [dict(rec) for rec in self.stages]
+        done = sum(1 for rec in stages if rec["status"] in ("done", "skipped"))
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "result": self.result,
+            "progress": {"done": done, "total": len(stages)},
+            "elapsed": round(end - (self.started_at or end), 3),
+            "stages": stages,
+        }
 
-            # Cleanup and rollback to clean state
-            cur.execute("ROLLBACK TO test_sp;")
-            cur.execute("RELEASE test_sp;")
+def job_stage(job, name):
+    return job.stage(name) if job is not None else nullcontext()
 
-            results.append({"name": name, "status": "ok", "type": t_type})
+JOBS = {}  # jobs queued or running in this process
+_jobs_lock = threading.Lock()
+_job_heartbeat_started = False
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="sdm-job")
 
+def _run_job(job, fn, args):
+    with app.app_context():
+        job.status = "running"
+        job.started_at = time.time()
+        job.save()
+        try:
+            job.result = fn(job, *args)
+            job.status = "done"
         except Exception as e:
-            # Ensure cleanup even on failure
-            try:
-                cur.execute("ROLLBACK TO test_sp;")
-                cur.execute("RELEASE test_sp;")
-            except:
-                pass
-
-            results.append({
-                "name": name,
-                "status": "error",
-                "error": str(e),
-                "type": t_type
-            })
-
-    conn.close()
-    return results
-
-
-def run_single_query(db_file, sql, commit=False):
-    conn = get_sqlite_conn(db_file)
-    cur = conn.cursor()
+            print(f"Job {job.id} ({job.kind}) failed:", e)
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.compact_tokens()
+            job.emit(job.status, {"result": job.result, "error": job.error})
+            job.finish()
+            with _jobs_lock:
+                JOBS.pop(job.id, None)
 
-    sql_strip = sql.lstrip().lower()
-    savepoint_created = False
+def _job_heartbeat_loop():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _jobs_lock:
+            job_ids = list(JOBS)
+        if not job_ids:
+            continue
+        try:
+            job_store.heartbeat(job_ids)
+        except Exception as e:
+            print("Warning: job heartbeat failed:", e)
 
+def start_job_heartbeat():
+    # once per worker process: fail the jobs dead workers left behind, then keep ours alive
+    global _job_heartbeat_started
+    with _jobs_lock:
+        if _job_heartbeat_started:
+            return
+        _job_heartbeat_started = True
     try:
-        # READ query
-        if sql_strip.startswith("select") or sql_strip.startswith("pragma"):
-            cur.execute(sql)
-            cols = [d[0] for d in cur.description] if cur.description else []
-            rows = [dict(zip(cols, row)) for row in cur.fetchall()]
-            return {"type": "select", "rows": rows}
+        job_store.fail_orphans()
+    except Exception as e:
+        print("Warning: failing orphaned jobs failed:", e)
+    threading.Thread(target=_job_heartbeat_loop, name="sdm-job-heartbeat", daemon=True).start()
 
-        # WRITE query → start savepoint
-        cur.execute("SAVEPOINT tmp_sp;")
-        savepoint_created = True
+def submit_job(kind, user_id, project_id, fn, *args, stages=()):
+    start_job_heartbeat()
+    job = Job(kind, user_id, project_id, stages=stages)
+    job.save()
+    job_store.prune()
+    with _jobs_lock:
+        JOBS[job.id] = job
+    job_executor.submit(_run_job, job, fn, args)
+    return job
 
-        cur.execute(sql)
-        affected = cur.rowcount
+def get_job(job_id):
+    """The job with this id: the live object if this process runs it, else a view read from job_store."""
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is not None:
+        return job
+    row = job_store.load(job_id)
+    return Job.from_row(row) if row is not None else None
 
-        if commit:
-            conn.commit()
-            cur.execute("RELEASE tmp_sp;")
-            return {"type": "write", "affected": affected, "note": "committed"}
+# A batch is a group of create_version jobs submitted together (bulk imports), kept in job_store
+def submit_batch(user_id, project_id, sql_items, prompts, use_cache=True):
+    """Queues one create_version job per SQL text ({"name", "sql"}) and per prompt; the job pool bounds concurrency."""
+    batch = {"id": uuid.uuid4().hex, "user_id": user_id, "project_id": project_id, "created_at": time.time(), "items": []}
+    stages = ("schema", "utility", "test_suite", "persist")
+    for item in sql_items:
+        job = submit_job("create_version", user_id, project_id, create_version_job, user_id, project_id,
+                         item["sql"], None, use_cache, stages=stages)
+        batch["items"].append({"source": item["name"], "kind": "sql", "job_id": job.id})
+    for prompt in prompts:
+        job = submit_job("create_version", user_id, project_id, create_version_job, user_id, project_id,
+                         None, prompt, use_cache, stages=stages)
+        batch["items"].append({"source": prompt[:80], "kind": "prompt", "job_id": job.id})
+    job_store.save_batch(batch)
+    return batch
 
-        else:
-            cur.execute("ROLLBACK TO tmp_sp;")
-            cur.execute("RELEASE tmp_sp;")
-            return {"type": "write", "affected": affected, "note": "rolled back (use commit=True to persist)"}
+def batch_status(batch):
+    items, counts = [], {}
+    last_finish = None
+    for i, item in enumerate(batch["items"]):
+        job = get_job(item["job_id"])
+        data = job.to_dict() if job else {"status": "expired", "error": None, "result": None, "elapsed": None}
+        counts[data["status"]] = counts.get(data["status"], 0) + 1
+        if job and job.finished_at:
+            last_finish = max(last_finish or 0, job.finished_at)
+        items.append(dict(item, index=i, status=data["status"], error=data["error"], result=data["result"],
+                          elapsed=data["elapsed"]))
+    finished = counts.get("done", 0) + counts.get("error", 0)
+    running = finished < len(items) and not counts.get("expired")
+    wall = ((time.time() if running else (last_finish or time.time())) - batch["created_at"])
+    return {
+        "id": batch["id"],
+        "status": "running" if running else "done",
+        "counts": counts,
+        "total": len(items),
+        "elapsed": round(wall, 3),
+        "throughput_per_min": round(finished * 60 / wall, 2) if wall > 0 else 0.0,
+        "llm": llm_limiter.stats(),
+        "items": items,
+    }
 
-    except Exception as e:
-        # Rollback only if savepoint was created
-        if savepoint_created:
-            try:
-                cur.execute("ROLLBACK TO tmp_sp;")
-                cur.execute("RELEASE tmp_sp;")
-            except:
-                pass
+def version_job_result(version):
+    return {"version_id": version.id, "version_name": version.name}
 
-        return {"type": "error", "error": str(e)}
+def create_version_job(job, user_id, project_id, sql_text=None, prompt=None, use_cache=True, stream=False):
+    user = User.query.get(user_id)
+    project = Project.query.get(project_id)
+    if prompt:
+        # generate schema + mermaid via LLM (streamed tables are previewed as they complete)
+        with job.stage("schema"):
+            on_token = streaming_preview(job, IncrementalSchemaParser("sql")) if stream else None
+            sql_text, mermaid = generate_schema_and_diagram(prompt, use_cache=use_cache, on_token=on_token)
+    else:
+        job.skip("schema")
+        mermaid = render_mermaid(sql_text)
+    job.emit("schema", {"sql": sql_text, "report": check_schema(sql_text or ""), "mermaid": render_mermaid(sql_text or "")})
+    # tests and utility docs only need the SQL text, so they run side by side
+    parallel = {"utility": lambda: generate_utility_sections(sql_text or "")}
+    if "Error:" not in sql_text:
+        parallel["test_suite"] = lambda: generate_test_suite(sql_text, use_cache=use_cache)
+    else:
+        job.skip("test_suite")
+    out = job.parallel(parallel)
+    version = create_version_for_project(user, project, sql_text, out.get("test_suite", []), mermaid,
+                                         utility_sections=out["utility"], job=job)
+    return version_job_result(version)
 
-    finally:
-        conn.close()
+def modify_schema_job(job, user_id, base_version_id, instruction, use_cache=True, stream=False):
+    user = User.query.get(user_id)
+    base_version = Version.query.get(base_version_id)
+    old_schema = open(base_version.schema_file).read() if base_version.schema_file and os.path.exists(base_version.schema_file) else ""
+    with job.stage("llm_edit"):
+        on_token = streaming_preview(job, IncrementalSchemaParser("edits", old_schema)) if stream else None
+        llm_resp = ask_llm_modify_schema(old_schema, instruction, use_cache=use_cache, on_token=on_token)
+        if "error" in llm_resp:
+            raise RuntimeError(llm_resp["error"])
+    new_version = apply_llm_edits_and_create_version(user, base_version.project, base_version, llm_resp, job=job)
+    return version_job_result(new_version)
 
+# ---------- Flask routes ----------
+def _job_accepted(job):
+    # JSON clients get the job id to poll; browsers land on a page that polls for them
+    status_url = url_for("job_status", job_id=job.id)
+    if request.is_json or request.accept_mimetypes.best == "application/json":
+        return jsonify({"job_id": job.id, "status_url": status_url,
+                        "events_url": url_for("job_events", job_id=job.id)}), 202
+    return redirect(status_url)
 
-# ---------- LLM-driven schema edits ----------
-def ask_llm_modify_schema(old_schema_sql, user_instruction):
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """
-You are a database schema assistant. Given an existing SQL schema and a user's instruction to modify it,
-you must output a JSON object with two keys: "edits" and "test_suite".
-- "edits" is an array; each element is an object:
-  - "action": one of "m" (modify table), "a" (add table), "r" (remove table)
-  - "table": affected table name (string)
-  - "sql": only for "m" or "a": the full CREATE TABLE statement for the resulting table
-  - "rationale": one-sentence explanation
-- "test_suite" is an array of test objects with keys: name,type,sql,rationale
+def job_event_stream(job, start=0):
+    """
+    Server-Sent Events for a job: stage changes, streamed LLM tokens, table
+    previews, the final schema report, then done/error. Event ids are log
+    positions, so a reconnecting EventSource resumes via Last-Event-ID.
+    """
+    def generate():
+        index = start
+        while True:
+            events = job.events_after(index)
+            if not events:
+                # the final event is logged before finished_at is set: re-read once to be sure
+                if job.finished_at and not job.events_after(index, timeout=0):
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for entry in events:
+                index += 1
+                if entry is None:
+                    continue  # merged into an earlier token event
+                event, data = entry
+                if event == "done" and data.get("result"):
+                    data = dict(data, version_url=url_for("version_detail", version_id=data["result"]["version_id"]))
+                yield f"id: {index}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+                if event in ("done", "error"):
+                    return
+    resp = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
-Respond with *only* a single ```json block``` containing this object.
-"""),
-        ("user", f"Here is the current schema:\n\n{old_schema_sql}\n\nInstruction: {user_instruction}")
-    ])
-    chain = prompt | llm
-    try:
-        resp = chain.invoke({"old_schema": old_schema_sql, "instruction": user_instruction})
-        content = resp.content
-        json_text = content.split("```json")[1].split("```")[0].strip()
-        parsed = json.loads(json_text)
-        return parsed
-    except Exception as e:
-        print("LLM modification failed:", e)
-        return {"error": str(e)}
+def _cache_bypass_requested():
+    # per-request opt-out of the LLM response cache: ?no_cache=1, form field or JSON key
+    flag = request.values.get("no_cache")
+    if flag is None and request.is_json:
+        flag = (request.get_json(silent=True) or {}).get("no_cache")
+    return str(flag).lower() in ("1", "true", "yes", "on")
 
-def _split_create_table_blocks(sql_text):
-    tokens = sql_text.split("CREATE TABLE")
-    blocks = []
-    for t in tokens[1:]:
-        try:
-            header = t.split("(")[0].strip()
-            table_name = header.split()[0].strip('`"')
-            if ");" in t:
-                sql_block = "CREATE TABLE " + t.split(");", 1)[0] + ");"
-            else:
-                sql_block = "CREATE TABLE " + t
-            blocks.append({"name": table_name, "sql": sql_block.strip()})
-        except Exception:
-            continue
-    return blocks
+@app.before_request
+def _start_background_workers():
+    if not _db_ready:
+        init_db()
+    start_archiver()
+    start_job_heartbeat()
 
-def apply_llm_edits_and_create_version(user_obj, project_obj, base_version_obj, edits_obj):
-    print("editing schema")
-    base_schema = ""
-    if base_version_obj and base_version_obj.schema_file and os.path.exists(base_version_obj.schema_file):
-        base_schema = open(base_version_obj.schema_file).read()
-    blocks = {b["name"]: b for b in _split_create_table_blocks(base_schema)}
-    edits = edits_obj.get("edits", [])
-    for e in edits:
-        action = e.get("action")
-        tbl = e.get("table")
-        if action == "r":
-            if tbl in blocks:
-                del blocks[tbl]
-        elif action in ("m","a"):
-            sql = e.get("sql", "")
-            if sql:
-                blocks[tbl] = {"name": tbl, "sql": sql}
-    new_schema = "\n\n".join([b["sql"] for b in blocks.values()])
-    new_tests = edits_obj.get("test_suite", [])
-    # try to generate mermaid for new schema
-    try:
-        mermaid = sql_to_mermaid(new_schema)
-    except Exception:
-        mermaid = ""
-    new_version = create_version_for_project(user_obj, project_obj, new_schema, new_tests, mermaid)
-    return new_version
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("sdm_http_request_seconds", elapsed, endpoint=endpoint, method=request.method,
+                    status=response.status_code)
+    if _server_timing_enabled():
+        # repeated stages (e.g. several LLM attempts) are summed into one entry
+        totals = OrderedDict()
+        for stage, seconds in g.get("server_timing", []):
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        totals["total"] = elapsed
+        response.headers["Server-Timing"] = ", ".join(f"{stage};dur={seconds * 1000:.1f}"
+                                                      for stage, seconds in totals.items())
+    return response
 
-# ---------- Flask routes ----------
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -749,26 +4056,79 @@ def create_version_route(project_id):
         # prefer uploaded file if provided
         uploaded = request.files.get("sql_file")
         prompt = request.form.get("prompt")
+        use_cache = not _cache_bypass_requested()
         if uploaded and uploaded.filename:
             sql_text = uploaded.read().decode("utf-8")
-            mermaid = sql_to_mermaid(sql_text)
-            test_suite = generate_test_suite(sql_text)
-            version = create_version_for_project(user, project, sql_text, test_suite, mermaid)
-            flash("Version created from uploaded SQL.", "success")
-            return redirect(url_for("version_detail", version_id=version.id))
+            job = submit_job("create_version", user.id, project.id, create_version_job, user.id, project.id, sql_text,
+                             None, use_cache, stages=("schema", "utility", "test_suite", "persist"))
+            return _job_accepted(job)
         elif prompt and prompt.strip():
-            # generate schema + mermaid via LLM
-            sql_text, mermaid = generate_schema_and_diagram(prompt.strip())
-            test_suite = []
-            if "Error:" not in sql_text:
-                test_suite = generate_test_suite(sql_text)
-            version = create_version_for_project(user, project, sql_text, test_suite, mermaid)
-            flash("Version created from prompt.", "success")
-            return redirect(url_for("version_detail", version_id=version.id))
+            job = submit_job("create_version", user.id, project.id, create_version_job, user.id, project.id, None,
+                             prompt.strip(), use_cache, True, stages=("schema", "utility", "test_suite", "persist"))
+            return _job_accepted(job)
         else:
             flash("Provide a prompt or an SQL file.", "warning")
     return render_template("create_version.html", project=project)
 
+# Generate a version from a prompt with a live table preview; POST starts the job (no side
+# effects on GET), its Server-Sent Events come from /jobs/<id>/events
+@app.route("/project/<int:project_id>/versions/stream", methods=["POST"])
+@login_required
+def create_version_stream(project_id):
+    user = User.query.get(session["user_id"])
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != user.id:
+        return jsonify({"error":"unauthorized"}), 403
+    prompt = (request.values.get("prompt") or (request.get_json(silent=True) or {}).get("prompt") or "").strip()
+    if not prompt:
+        return jsonify({"error":"prompt missing"}), 400
+    job = submit_job("create_version", user.id, project.id, create_version_job, user.id, project.id, None,
+                     prompt, not _cache_bypass_requested(), True, stages=("schema", "utility", "test_suite", "persist"))
+    return _job_accepted(job)
+
+# Bulk import: many .sql files and/or prompts, one background job each
+@app.route("/project/<int:project_id>/versions/batch", methods=["POST"])
+@login_required
+def create_versions_batch(project_id):
+    user = User.query.get(session["user_id"])
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != user.id:
+        return jsonify({"error":"unauthorized"}), 403
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "JSON body must be an object"}), 400
+    for field in ("sql", "prompts"):
+        values = payload.get(field, [])
+        if not isinstance(values, list):
+            return jsonify({"error": f"'{field}' must be a list of strings"}), 400
+        for i, value in enumerate(values):
+            if not isinstance(value, str):
+                return jsonify({"error": f"'{field}' must be a list of strings", "item": f"{field}[{i}]"}), 400
+    sql_items = []
+    for f in request.files.getlist("sql_file"):
+        if not f or not f.filename:
+            continue
+        try:
+            sql_items.append({"name": f.filename, "sql": f.read().decode("utf-8")})
+        except UnicodeDecodeError:
+            return jsonify({"error": "SQL files must be UTF-8 text", "item": f.filename}), 400
+    sql_items += [{"name": f"sql[{i}]", "sql": text} for i, text in enumerate(payload.get("sql", [])) if text.strip()]
+    prompts = [p.strip() for p in request.form.getlist("prompt") + payload.get("prompts", []) if p.strip()]
+    if not sql_items and not prompts:
+        return jsonify({"error": "provide sql_file uploads, 'sql' texts or 'prompts'"}), 400
+    if len(sql_items) + len(prompts) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"at most {BATCH_MAX_ITEMS} items per batch"}), 400
+    batch = submit_batch(user.id, project.id, sql_items, prompts, use_cache=not _cache_bypass_requested())
+    return jsonify(dict(batch_status(batch), status_url=url_for("batch_status_route", batch_id=batch["id"]))), 202
+
+@app.route("/batches/<batch_id>")
+@login_required
+def batch_status_route(batch_id):
+    batch = job_store.load_batch(batch_id)
+    if not batch or batch["user_id"] != session["user_id"]:
+        return jsonify({"error": "batch not found"}), 404
+    return jsonify(batch_status(batch))
+
 # Version detail / workspace
 @app.route("/version/<int:version_id>")
 @login_required
@@ -779,6 +4139,7 @@ def version_detail(version_id):
     if project.user_id != user.id:
         flash("Unauthorized", "danger")
         return redirect(url_for("dashboard"))
+    rehydrated_ms = ensure_version_online(version)
     # load files
     schema = open(version.schema_file).read() if version.schema_file and os.path.exists(version.schema_file) else ""
     tests = []
@@ -788,9 +4149,16 @@ def version_detail(version_id):
         except Exception:
             tests = []
     utility = open(version.utility_file).read() if version.utility_file and os.path.exists(version.utility_file) else ""
-    mermaid = sql_to_mermaid(schema) if schema else schema
-    print(mermaid)
-    return render_template("version_detail.html", project=project, version=version, schema=schema, tests=tests, utility=utility, mermaid=mermaid)
+    mermaid = load_version_erd(os.path.dirname(version.schema_file), schema) if schema else schema
+    resp = make_response(render_template("version_detail.html", project=project, version=version, schema=schema, tests=tests,
+                                         utility=utility, mermaid=mermaid, rehydrated_ms=rehydrated_ms))
+    return with_rehydration_header(resp, rehydrated_ms)
+
+def with_rehydration_header(resp, rehydrated_ms):
+    # lets clients see when a request paid for restoring an archived version
+    if rehydrated_ms is not None:
+        resp.headers["X-SDM-Rehydrated-Ms"] = str(rehydrated_ms)
+    return resp
 
 # Run single SQL (AJAX)
 @app.route("/version/<int:version_id>/run_query", methods=["POST"])
@@ -800,10 +4168,40 @@ def version_run_query(version_id):
     version = Version.query.get_or_404(version_id)
     if version.project.user_id != user.id:
         return jsonify({"error":"unauthorized"}), 403
-    sql = request.json.get("sql", "")
-    commit = bool(request.json.get("commit", False))
-    result = run_single_query(version.db_file, sql, commit=commit)
-    return jsonify(result)
+    payload = request.json or {}
+    sql = payload.get("sql", "")
+    commit = bool(payload.get("commit", False))
+    try:
+        if payload.get("stream") and is_read_query(sql):
+            # chunked NDJSON: rows go out as they are read instead of being buffered
+            check_console_sql(sql)
+            rehydrated_ms = ensure_version_online(version)
+            rows = stream_query_ndjson(version.db_file, sql, user_id=user.id)
+            next(rows)  # takes the query slot, or raises QueryBudgetExceeded (429)
+            try:
+                record_query_history(version, sql)
+                # the server closes the generator when it is done with the response,
+                # which releases the slot even if the body was never read
+                resp = Response(rows, mimetype="application/x-ndjson")
+            except BaseException:
+                rows.close()
+                raise
+            return with_rehydration_header(resp, rehydrated_ms)
+        with version_online(version) as rehydrated_ms:
+            result = run_single_query(version.db_file, sql, commit=commit, limit=payload.get("limit"),
+                                      cursor=payload.get("cursor"), user_id=user.id)
+    except QueryBudgetExceeded as e:
+        resp = jsonify(e.to_dict())
+        resp.headers["Retry-After"] = "1"
+        return resp, 429
+    except ValueError as e:
+        return jsonify({"type": "error", "error": str(e)}), 400
+    # "load more" pages and result-cache hits are not new runs of the statement
+    if result.get("type") != "error" and not payload.get("cursor") and not result.get("cached"):
+        record_query_history(version, sql)
+    if rehydrated_ms is not None:
+        result["rehydrated_ms"] = rehydrated_ms
+    return with_rehydration_header(jsonify(result), rehydrated_ms)
 
 # Run tests
 @app.route("/version/<int:version_id>/run_tests", methods=["POST"])
@@ -817,8 +4215,81 @@ def version_run_tests(version_id):
         tests = json.load(open(version.test_file)) if version.test_file and os.path.exists(version.test_file) else []
     except Exception:
         tests = []
-    results = run_tests_against_db(version.db_file, tests)
-    return jsonify({"results": results})
+    try:
+        with version_online(version) as rehydrated_ms:
+            results = run_tests_against_db(version.db_file, tests)
+    except SandboxCrashed as e:
+        return jsonify({"error": str(e)}), 500
+    out = {"summary": summarize_test_results(results), "results": results}
+    if rehydrated_ms is not None:
+        out["rehydrated_ms"] = rehydrated_ms
+    return with_rehydration_header(jsonify(out), rehydrated_ms)
+
+def project_meta_path(project):
+    return os.path.join(project_dir(project.user_id, project.id), "meta.json")
+
+def project_suppressed_rules(project):
+    try:
+        return json.load(open(project_meta_path(project))).get("suppressed_rules", [])
+    except Exception:
+        return []
+
+# Static schema checks, honouring the project's suppressed rule ids
+@app.route("/version/<int:version_id>/check")
+@login_required
+def version_check_schema(version_id):
+    user = User.query.get(session["user_id"])
+    version = Version.query.get_or_404(version_id)
+    if version.project.user_id != user.id:
+        return jsonify({"error":"unauthorized"}), 403
+    schema = open(version.schema_file).read() if version.schema_file and os.path.exists(version.schema_file) else ""
+    suppressed = project_suppressed_rules(version.project)
+    return jsonify({"report": check_schema(schema, suppress=suppressed), "suppressed_rules": suppressed})
+
+# List lint rules / set the project's suppressed rule ids
+@app.route("/project/<int:project_id>/lint_rules", methods=["GET", "POST"])
+@login_required
+def project_lint_rules(project_id):
+    user = User.query.get(session["user_id"])
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != user.id:
+        return jsonify({"error":"unauthorized"}), 403
+    if request.method == "POST":
+        known = {r["id"] for r in SCHEMA_RULES} | {"SDM000"}
+        wanted = [str(r).upper() for r in (request.get_json(silent=True) or {}).get("suppressed_rules", [])]
+        unknown = [r for r in wanted if r not in known]
+        if unknown:
+            return jsonify({"error": f"unknown rule ids: {', '.join(unknown)}"}), 400
+        with _version_create_lock:
+            path = project_meta_path(project)
+            try:
+                meta = json.load(open(path))
+            except Exception:
+                meta = {"name": project.name, "versions": []}
+            meta["suppressed_rules"] = sorted(set(wanted))
+            with open(path, "w") as f:
+                json.dump(meta, f, indent=2)
+    suppressed = project_suppressed_rules(project)
+    return jsonify({"rules": [{"id": r["id"], "severity": r["severity"], "name": r["name"],
+                               "suppressed": r["id"] in suppressed} for r in SCHEMA_RULES],
+                    "suppressed_rules": suppressed})
+
+# Index advisor: propose indexes for the version's workload; apply=true builds an indexed version
+@app.route("/version/<int:version_id>/advise_indexes", methods=["POST"])
+@login_required
+def version_advise_indexes(version_id):
+    user = User.query.get(session["user_id"])
+    version = Version.query.get_or_404(version_id)
+    if version.project.user_id != user.id:
+        return jsonify({"error":"unauthorized"}), 403
+    payload = request.get_json(silent=True) or {}
+    if payload.get("apply"):
+        job = submit_job("index_advisor", user.id, version.project_id, index_advisor_job, user.id, version.id,
+                         stages=("analyze", "utility", "persist"))
+        return jsonify({"job_id": job.id, "status_url": url_for("job_status", job_id=job.id)}), 202
+    with version_online(version):
+        advice = advise_indexes(version)
+    return jsonify(advice)
 
 # Modify schema via LLM edits -> creates new version
 @app.route("/version/<int:version_id>/modify_schema", methods=["POST"])
@@ -831,12 +4302,93 @@ def version_modify_schema(version_id):
     instruction = request.json.get("instruction", "")
     if not instruction:
         return jsonify({"error":"instruction missing"}), 400
-    old_schema = open(base_version.schema_file).read() if base_version.schema_file and os.path.exists(base_version.schema_file) else ""
-    llm_resp = ask_llm_modify_schema(old_schema, instruction)
-    if "error" in llm_resp:
-        return jsonify({"error": llm_resp["error"]}), 500
-    new_version = apply_llm_edits_and_create_version(user, base_version.project, base_version, llm_resp)
-    return jsonify({"new_version_id": new_version.id, "new_version_name": new_version.name})
+    job = submit_job("modify_schema", user.id, base_version.project_id, modify_schema_job, user.id, base_version.id,
+                     instruction, not _cache_bypass_requested(), False, stages=("llm_edit", "merge", "utility", "persist"))
+    return jsonify({"job_id": job.id, "status_url": url_for("job_status", job_id=job.id),
+                    "events_url": url_for("job_events", job_id=job.id)}), 202
+
+# Same as modify_schema with a live preview of the edited tables (events from /jobs/<id>/events)
+@app.route("/version/<int:version_id>/modify_schema/stream", methods=["POST"])
+@login_required
+def version_modify_schema_stream(version_id):
+    user = User.query.get(session["user_id"])
+    base_version = Version.query.get_or_404(version_id)
+    if base_version.project.user_id != user.id:
+        return jsonify({"error":"unauthorized"}), 403
+    instruction = (request.values.get("instruction") or (request.get_json(silent=True) or {}).get("instruction") or "").strip()
+    if not instruction:
+        return jsonify({"error":"instruction missing"}), 400
+    job = submit_job("modify_schema", user.id, base_version.project_id, modify_schema_job, user.id, base_version.id,
+                     instruction, not _cache_bypass_requested(), True, stages=("llm_edit", "merge", "utility", "persist"))
+    return _job_accepted(job)
+
+# Background job status (polled by the UI)
+@app.route("/jobs/<job_id>")
+@login_required
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job or job.user_id != session["user_id"]:
+        return jsonify({"error": "job not found"}), 404
+    data = job.to_dict()
+    if job.status == "done" and job.result:
+        data["version_url"] = url_for("version_detail", version_id=job.result["version_id"])
+    if request.accept_mimetypes.best == "text/html":
+        return render_template("job_status.html", job=data)
+    return jsonify(data)
+
+# Live event stream of a background job (SSE)
+@app.route("/jobs/<job_id>/events")
+@login_required
+def job_events(job_id):
+    job = get_job(job_id)
+    if not job or job.user_id != session["user_id"]:
+        return jsonify({"error": "job not found"}), 404
+    try:
+        start = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+    except ValueError:
+        start = 0
+    return job_event_stream(job, start)
+
+# LLM response cache counters
+@app.route("/llm_cache/stats")
+@login_required
+def llm_cache_stats():
+    return jsonify(llm_cache.stats())
+
+# Console result cache counters
+@app.route("/query_cache/stats")
+@login_required
+def query_cache_stats():
+    return jsonify(query_cache.stats())
+
+@metrics.collector
+def _cache_and_limiter_gauges():
+    samples = []
+    for cache_name, stats in (("llm", llm_cache.stats()), ("query", query_cache.stats())):
+        for key, name in (("hits", "sdm_cache_hits_total"), ("misses", "sdm_cache_misses_total"),
+                          ("entries", "sdm_cache_entries"), ("bytes", "sdm_cache_bytes")):
+            samples.append((name, {"cache": cache_name}, stats[key]))
+    limiter = llm_limiter.stats()
+    samples.append(("sdm_llm_rate_limited_total", {}, limiter["rate_limited"]))
+    samples.append(("sdm_llm_rate_limit_wait_seconds_total", {}, limiter["waited_seconds"]))
+    samples.append(("sdm_llm_rate_factor", {}, limiter["rate_factor"]))
+    samples.append(("sdm_jobs_running", {}, job_store.active_count()))
+    if llm_fixtures is not None:
+        fixtures = llm_fixtures.stats()
+        for outcome in ("hits", "fallbacks", "misses", "recorded"):
+            samples.append(("sdm_llm_fixture_lookups_total", {"outcome": outcome}, fixtures[outcome]))
+    return samples
+
+# Prometheus scrape endpoint (no session): bearer token if SDM_METRICS_TOKEN is set, else loopback only
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            return Response("unauthorized\n", status=401, mimetype="text/plain")
+    elif request.remote_addr not in ("127.0.0.1", "::1"):
+        return Response("forbidden: set SDM_METRICS_TOKEN to scrape from other hosts\n", status=403,
+                        mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # Download files from a version
 @app.route("/version/<int:version_id>/download/<path:filename>")
@@ -848,10 +4400,13 @@ def version_download_file(version_id, filename):
         flash("Unauthorized", "danger")
         return redirect(url_for("dashboard"))
     v_dir = os.path.dirname(version.schema_file) if version.schema_file else None
-    if not v_dir or not os.path.exists(os.path.join(v_dir, filename)):
-        flash("File not found", "warning")
-        return redirect(url_for("version_detail", version_id=version.id))
-    return send_from_directory(v_dir, filename, as_attachment=True)
+    with version_online(version) as rehydrated_ms:
+        if not v_dir or not os.path.exists(os.path.join(v_dir, filename)):
+            flash("File not found", "warning")
+            return redirect(url_for("version_detail", version_id=version.id))
+        # the file is opened here, so an archiver pass after the lock is released can't pull it away
+        resp = send_from_directory(v_dir, filename, as_attachment=True)
+    return with_rehydration_header(resp, rehydrated_ms)
 
 # Misc: delete project (caution)
 @app.route("/project/<int:project_id>/delete", methods=["POST"])
@@ -863,11 +4418,16 @@ def delete_project(project_id):
         flash("Unauthorized", "danger")
         return redirect(url_for("dashboard"))
     # remove folder on disk
+    digests = set()
+    for v in project.versions:
+        close_sqlite_pool(v.db_file)
+        digests |= version_blob_digests(version_dir(user.id, project.id, v.name))
     projdir = project_dir(user.id, project.id)
     try:
         shutil.rmtree(projdir)
     except Exception as e:
         print("Warning: deleting project folder failed:", e)
+    release_blobs(digests)
     db.session.delete(project)
     db.session.commit()
     flash("Project deleted.", "info")
@@ -883,9 +4443,12 @@ def delete_version(project_id, version_id):
         return redirect(url_for("view_project", project_id=project_id))
 
     # Delete version folder from disk
+    close_sqlite_pool(version.db_file)
     v_dir = version_dir(user_id, project_id, version.name)
     if os.path.exists(v_dir):
+        digests = version_blob_digests(v_dir)
         shutil.rmtree(v_dir)
+        release_blobs(digests)
 
     # Delete from DB
     db.session.delete(version)
@@ -894,5 +4457,35 @@ def delete_version(project_id, version_id):
     flash(f"Version '{version.name}' deleted.", "success")
     return redirect(url_for("project_detail", project_id=project_id))
 
+def warmup():
+    """
+    Loads what the first requests would otherwise pay for: sqlglot (parsing and
+    rendering a small schema) and the langchain modules. Safe to run before
+    forking: it opens no sockets or SQLite connections.
+    """
+    started = time.perf_counter()
+    sample = "CREATE TABLE warmup (id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES warmup(id));"
+    render_mermaid(sample)
+    check_schema(sample)
+    importlib.import_module("langchain_core.prompts")
+    importlib.import_module("langchain_openai")
+    logger.info("warmup done in %.2fs", time.perf_counter() - started)
+
+def create_app(warmup_imports=False):
+    """
+    Application factory for WSGI servers, e.g. with gunicorn's --preload:
+        gunicorn --preload -w 4 "app:create_app(warmup_imports=True)"
+    Tables are created only when app.db is missing (or via `flask init-db`).
+    Background jobs run in the worker that accepted them; their state and
+    events go through jobs.db under DATA_ROOT, so any worker can serve them.
+    """
+    init_db()
+    if warmup_imports:
+        warmup()
+    with app.app_context():
+        db.engine.dispose()  # workers forked from here open their own connections
+    return app
+
 if __name__ == "__main__":
+    create_app()
     app.run(debug=True)
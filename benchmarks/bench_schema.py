@@ -0,0 +1,179 @@
+"""
+Micro-benchmarks for the schema-processing hot paths in app.py on synthetic
+schemas of 10 to 2,000 tables.
+
+    python benchmarks/bench_schema.py                  # run, compare with baseline.json
+    python benchmarks/bench_schema.py --save-baseline  # run, overwrite baseline.json
+    python benchmarks/bench_schema.py --sizes 10,100 --repeat 3 --json out.json
+
+parse_schema is timed cold (memo caches cleared before every call). The
+other functions all consume its memoized model, so they are timed against a
+warm model: their numbers are their own cost (string building, relation
+dedup, rule evaluation) on top of parse_schema's. Peak memory comes from a
+separate tracemalloc pass (tracing slows the code down, so it never overlaps
+the timing runs). Exits 1 when a timing or peak regresses by more than
+--threshold over the baseline. Baselines are machine specific: refresh
+baseline.json on the machine the comparison runs on.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as sdm  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = (10, 100, 500, 2000)
+MIN_REGRESSION_SECONDS = 0.002   # ignore noise on sub-millisecond timings
+
+_COLUMN_TYPES = ("INTEGER", "TEXT", "REAL", "DATETIME", "DECIMAL(10,2)", "BOOLEAN", "BLOB")
+
+
+def synthetic_schema(n_tables, seed=0):
+    """
+    A schema shaped like the large customer ones: a few hub tables that most
+    others reference (users, accounts, ...), long-tail FKs to arbitrary earlier
+    tables, 3-30 columns per table and an index on most FK columns.
+    """
+    rng = random.Random(seed)
+    names = [f"t{i:04d}_entity" for i in range(n_tables)]
+    hubs = names[:max(1, n_tables // 50)]
+    statements = []
+    for i, name in enumerate(names):
+        cols = ["    id INTEGER PRIMARY KEY"]
+        fks = []
+        if i:
+            fanout = min(i, rng.choice((0, 1, 1, 2, 2, 3, 4, 6)))
+            targets = set()
+            for _ in range(fanout):
+                targets.add(rng.choice(hubs) if rng.random() < 0.6 and hubs[0] != name
+                            else names[rng.randrange(i)])
+            for target in sorted(targets):
+                col = f"{target}_id"
+                cols.append(f"    {col} INTEGER NOT NULL")
+                fks.append((col, target))
+        for c in range(rng.randint(2, 28)):
+            cols.append(f"    c{c}_{rng.choice(('name', 'code', 'amount', 'at', 'flag', 'note'))} "
+                        f"{rng.choice(_COLUMN_TYPES)}{' NOT NULL' if rng.random() < 0.3 else ''}")
+        cols.extend(f"    FOREIGN KEY ({col}) REFERENCES {target}(id)" for col, target in fks)
+        statements.append(f"CREATE TABLE {name} (\n" + ",\n".join(cols) + "\n);")
+        for col, _ in fks:
+            if rng.random() < 0.8:
+                statements.append(f"CREATE INDEX idx_{name}_{col} ON {name}({col});")
+    return "\n\n".join(statements) + "\n"
+
+
+def clear_caches():
+    with sdm._schema_models_lock:
+        sdm._schema_models.clear()
+    with sdm._mermaid_cache_lock:
+        sdm._mermaid_cache.clear()
+
+
+def cases(schema):
+    # name -> (fn, cold)
+    mermaid = sdm.sql_to_mermaid(schema)
+    return {
+        "parse_schema": (lambda: sdm.parse_schema(schema), True),
+        "sql_to_mermaid": (lambda: sdm.sql_to_mermaid(schema), False),
+        "fix_mermaid_relations": (lambda: sdm.fix_mermaid_relations(mermaid), False),
+        "_split_create_table_blocks": (lambda: sdm._split_create_table_blocks(schema), False),
+        "check_schema": (lambda: sdm.check_schema(schema), False),
+    }
+
+
+def measure(fn, repeat, cold, schema):
+    def prepare():
+        clear_caches()
+        if not cold:
+            sdm.parse_schema(schema)
+
+    times = []
+    for _ in range(repeat):
+        prepare()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    prepare()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"median_s": round(statistics.median(times), 6), "min_s": round(min(times), 6),
+            "peak_kib": round(peak / 1024, 1)}
+
+
+def run(sizes, repeat, only=None):
+    results = {}
+    for n in sizes:
+        schema = synthetic_schema(n)
+        for name, (fn, cold) in cases(schema).items():
+            if only and name not in only:
+                continue
+            row = measure(fn, repeat, cold, schema)
+            results[f"{name}/{n}"] = row
+            print(f"{name:<28} {n:>5} tables  median {row['median_s'] * 1000:>9.2f} ms"
+                  f"  min {row['min_s'] * 1000:>9.2f} ms  peak {row['peak_kib']:>10.1f} KiB", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, row in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        slower = row["median_s"] - base["median_s"]
+        if slower > MIN_REGRESSION_SECONDS and row["median_s"] > base["median_s"] * (1 + threshold):
+            regressions.append(f"{key}: {base['median_s'] * 1000:.2f} ms -> {row['median_s'] * 1000:.2f} ms")
+        if row["peak_kib"] > base["peak_kib"] * (1 + threshold) + 64:
+            regressions.append(f"{key}: peak {base['peak_kib']:.0f} KiB -> {row['peak_kib']:.0f} KiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma separated table counts")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case (median is compared)")
+    parser.add_argument("--only", default="", help="comma separated function names to run")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    only = {s.strip() for s in args.only.split(",") if s.strip()}
+    results = run(sizes, max(1, args.repeat), only)
+    report = {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against (run with --save-baseline)")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for line in regressions:
+        print("REGRESSION", line)
+    if not regressions:
+        print(f"no regressions against {os.path.basename(args.baseline)}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
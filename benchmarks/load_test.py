@@ -0,0 +1,225 @@
+"""
+Offline load test of the main request paths: simulated users drive the Flask
+app through its test client, with the LLM answered by the replay backend.
+
+    python benchmarks/load_test.py --users 16 --iterations 3
+    python benchmarks/load_test.py --latency-ms 1500 --jitter-ms 500 --json out.json
+    OPENAI_API_KEY=... python benchmarks/load_test.py --record --users 1 --iterations 1
+
+Each user registers, creates a project, then per iteration: creates a version
+from a prompt, asks for a schema modification, runs console queries and the
+test suite against the new version. Version jobs are polled through
+/jobs/<id> like the UI does. --record talks to the live model and appends every
+exchange to the fixtures file; later runs replay it. The default fixtures are
+seed responses for the app's prompts: unseen inputs fall back to a response
+recorded for the same system prompt (SDM_LLM_REPLAY_FALLBACK).
+
+Everything runs against a scratch data root and app DB (removed afterwards
+unless --keep), so the checked-in userdata/ and app.db are never touched.
+Reports throughput plus per-route count, error rate and latency percentiles.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FIXTURES = os.path.join(BENCH_DIR, "llm_fixtures.jsonl")
+PROMPTS = ("online bookstore", "veterinary clinic", "conference ticketing", "recipe sharing site",
+           "fleet maintenance tracker", "library lending system")
+INSTRUCTIONS = ("add product reviews with a 1-5 rating", "track audit history for every change",
+                "add tags that can be attached to any record")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # route -> [(seconds, ok)]
+        self._lock = threading.Lock()
+
+    def add(self, route, seconds, ok):
+        with self._lock:
+            self.samples.setdefault(route, []).append((seconds, ok))
+
+    def report(self, wall):
+        rows = {}
+        for route, samples in sorted(self.samples.items()):
+            times = [s for s, _ in samples]
+            errors = sum(1 for _, ok in samples if not ok)
+            rows[route] = {"count": len(samples), "errors": errors,
+                           "error_rate": round(errors / len(samples), 4),
+                           "per_s": round(len(samples) / wall, 2) if wall else 0.0,
+                           "mean_ms": round(sum(times) / len(times) * 1000, 1),
+                           "p50_ms": round(percentile(times, 50) * 1000, 1),
+                           "p95_ms": round(percentile(times, 95) * 1000, 1),
+                           "p99_ms": round(percentile(times, 99) * 1000, 1),
+                           "max_ms": round(max(times) * 1000, 1)}
+        return rows
+
+
+class SimulatedUser:
+    def __init__(self, flask_app, index, args, recorder):
+        self.client = flask_app.test_client()
+        self.index = index
+        self.args = args
+        self.recorder = recorder
+        self.llm_params = {} if args.llm_cache else {"no_cache": "1"}
+
+    def call(self, route, method, url, ok=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.client.open(url, method=method, **kwargs)
+        except Exception as e:
+            self.recorder.add(route, time.perf_counter() - started, False)
+            print(f"user {self.index}: {route} raised {e!r}", file=sys.stderr)
+            return None
+        elapsed = time.perf_counter() - started
+        good = response.status_code < 400 and (ok is None or ok(response))
+        self.recorder.add(route, elapsed, good)
+        return response if good else None
+
+    def wait_job(self, route, response):
+        # end-to-end job latency (submit -> done) is recorded as job:<route>
+        started = time.perf_counter()
+        status_url = response.get_json()["status_url"]
+        deadline = started + self.args.job_timeout
+        while time.perf_counter() < deadline:
+            poll = self.call("GET /jobs/<id>", "GET", status_url, headers={"Accept": "application/json"})
+            data = poll.get_json() if poll is not None else None
+            if data and data["status"] in ("done", "error"):
+                ok = data["status"] == "done"
+                self.recorder.add(f"job:{route}", time.perf_counter() - started, ok)
+                return data["result"] if ok else None
+            time.sleep(self.args.poll_interval)
+        self.recorder.add(f"job:{route}", time.perf_counter() - started, False)
+        return None
+
+    def run(self):
+        name = f"load{self.index}_{time.time_ns()}"
+        if not self.call("POST /register", "POST", "/register", data={"username": name, "password": "load-test"}):
+            return
+        created = self.call("POST /projects/create", "POST", "/projects/create",
+                            data={"project_name": f"load project {self.index}"})
+        if created is None:
+            return
+        project_id = int(created.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+        for i in range(self.args.iterations):
+            prompt = PROMPTS[(self.index + i) % len(PROMPTS)]
+            submitted = self.call("POST /project/<id>/versions/create", "POST",
+                                  f"/project/{project_id}/versions/create",
+                                  data=dict(self.llm_params, prompt=prompt), headers={"Accept": "application/json"})
+            result = submitted and self.wait_job("create_version", submitted)
+            if not result:
+                continue
+            version_id = result["version_id"]
+            submitted = self.call("POST /version/<id>/modify_schema", "POST", f"/version/{version_id}/modify_schema",
+                                  json=dict(self.llm_params, instruction=INSTRUCTIONS[(self.index + i) % len(INSTRUCTIONS)]))
+            result = submitted and self.wait_job("modify_schema", submitted)
+            if result:
+                version_id = result["version_id"]
+            self.console(version_id)
+            self.call("POST /version/<id>/run_tests", "POST", f"/version/{version_id}/run_tests")
+
+    def console(self, version_id):
+        url = f"/version/{version_id}/run_query"
+        not_error = lambda r: (r.get_json() or {}).get("type") != "error"
+        listing = self.call("POST /version/<id>/run_query", "POST", url, ok=not_error,
+                            json={"sql": "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"})
+        tables = [row[0] for row in listing.get_json()["rows"] if not row[0].startswith("sqlite_")] if listing else []
+        for q in range(self.args.queries):
+            if not tables:
+                break
+            table = tables[q % len(tables)]
+            self.call("POST /version/<id>/run_query", "POST", url, ok=not_error,
+                      json={"sql": f'SELECT * FROM "{table}" LIMIT 50'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test with a record/replay LLM backend.")
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=2, help="create/modify/query/test rounds per user")
+    parser.add_argument("--queries", type=int, default=5, help="console queries per round")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--record", action="store_true", help="use the live model and record its responses")
+    parser.add_argument("--latency-ms", type=float, default=None, help="replay latency (default: as recorded)")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform extra replay latency")
+    parser.add_argument("--llm-rpm", type=float, default=0, help="LLM rate limit during the run (0 = off)")
+    parser.add_argument("--llm-cache", action="store_true", help="let the LLM response cache answer repeat prompts")
+    parser.add_argument("--sql-processes", type=int, default=None, help="override SDM_SQL_PROCESSES")
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--job-timeout", type=float, default=300)
+    parser.add_argument("--data-root", help="scratch directory (default: a new temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    scratch = args.data_root or tempfile.mkdtemp(prefix="sdm-load-")
+    # app config is read at import time
+    os.environ["SDM_DATA_ROOT"] = os.path.join(scratch, "userdata")
+    os.environ["SDM_APP_DB"] = os.path.join(scratch, "app.db")
+    os.environ["SDM_LLM_BACKEND"] = "record" if args.record else "replay"
+    os.environ["SDM_LLM_FIXTURES"] = os.path.abspath(args.fixtures)
+    os.environ["SDM_LLM_REPLAY_LATENCY_MS"] = str(-1 if args.latency_ms is None else args.latency_ms)
+    os.environ["SDM_LLM_REPLAY_JITTER_MS"] = str(args.jitter_ms)
+    os.environ["SDM_LLM_RPM"] = str(args.llm_rpm)
+    os.environ["SDM_ARCHIVE_INTERVAL"] = "0"
+    if args.sql_processes is not None:
+        os.environ["SDM_SQL_PROCESSES"] = str(args.sql_processes)
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import app as sdm
+
+    try:
+        flask_app = sdm.create_app(warmup_imports=True)
+        sdm.get_llm()
+        recorder = Recorder()
+        users = [SimulatedUser(flask_app, i, args, recorder) for i in range(args.users)]
+        threads = [threading.Thread(target=u.run, name=f"load-user-{u.index}") for u in users]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+
+        routes = recorder.report(wall)
+        requests_done = sum(r["count"] for route, r in routes.items() if not route.startswith("job:"))
+        errors = sum(r["errors"] for route, r in routes.items() if not route.startswith("job:"))
+        report = {"users": args.users, "iterations": args.iterations, "wall_s": round(wall, 2),
+                  "requests": requests_done, "requests_per_s": round(requests_done / wall, 2) if wall else 0.0,
+                  "error_rate": round(errors / requests_done, 4) if requests_done else 0.0,
+                  "routes": routes, "llm_fixtures": sdm.llm_fixtures.stats() if sdm.llm_fixtures else None,
+                  "llm_limiter": sdm.llm_limiter.stats()}
+
+        print(f"{args.users} users x {args.iterations} rounds in {wall:.1f}s: {requests_done} requests, "
+              f"{report['requests_per_s']} req/s, error rate {report['error_rate']:.2%}")
+        print(f"{'route':<38} {'count':>6} {'err%':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for route, r in routes.items():
+            print(f"{route:<38} {r['count']:>6} {r['error_rate'] * 100:>6.1f} {r['p50_ms']:>9.1f} "
+                  f"{r['p95_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['max_ms']:>9.1f}")
+        if report["llm_fixtures"]:
+            print("llm fixtures:", report["llm_fixtures"])
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        return 1 if errors else 0
+    finally:
+        if sdm._sql_executor is not None:
+            sdm._sql_executor.shutdown()
+        if not args.keep and not args.data_root:
+            shutil.rmtree(scratch, ignore_errors=True)
+        elif args.keep:
+            print("scratch data kept in", scratch)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its paths at import time: point them at a scratch dir first
+_DATA_ROOT = tempfile.mkdtemp(prefix="sdm-tests-")
+os.environ.setdefault("SDM_DATA_ROOT", os.path.join(_DATA_ROOT, "userdata"))
+os.environ.setdefault("SDM_APP_DB", os.path.join(_DATA_ROOT, "app.db"))
+os.environ.setdefault("SDM_ARCHIVE_INTERVAL", "0")  # no archiver thread
+os.environ.setdefault("SDM_SQL_PROCESSES", "0")     # console queries run in-process
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as sdm  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    sdm.init_db(force=True)
+    return sdm
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config["TESTING"] = True
+    with app_module.app.test_client() as c:
+        yield c
+
+
+@pytest.fixture
+def user(app_module):
+    with app_module.app.app_context():
+        u = app_module.User(username=f"user-{os.urandom(4).hex()}",
+                            password_hash=app_module.generate_password_hash("pw"))
+        app_module.db.session.add(u)
+        app_module.db.session.commit()
+        yield u
+
+
+@pytest.fixture
+def project(app_module, user):
+    return app_module.create_project(user, "shop")
+
+
+@pytest.fixture
+def logged_in(client, user):
+    with client.session_transaction() as s:
+        s["user_id"] = user.id
+    return client
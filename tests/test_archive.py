@@ -0,0 +1,57 @@
+import os
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def version(app_module, user, project):
+    version = app_module.create_version_for_project(user, project, "CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT);",
+                                                    [], utility_sections=[])
+    # committed through the pool, so the rows may still sit in the WAL
+    with app_module.sqlite_connection(version.db_file) as conn:
+        conn.executemany("INSERT INTO notes (body) VALUES (?)", [(f"note {i}",) for i in range(50)])
+        conn.commit()
+    return version
+
+
+def _archive_path(version):
+    return os.path.join(os.path.dirname(version.db_file), "archive.zip")
+
+
+def test_archive_and_rehydrate_keep_every_row(app_module, version):
+    app_module.archive_version_db(version.db_file)
+    assert not os.path.exists(version.db_file)
+    assert os.path.exists(_archive_path(version))
+
+    elapsed = app_module.ensure_version_online(version)
+    assert elapsed is not None
+    assert not os.path.exists(_archive_path(version))
+    assert app_module.ensure_version_online(version) is None
+    result = app_module.run_single_query(version.db_file, "SELECT count(*) FROM notes")
+    assert result["rows"] == [[50]]
+
+
+def test_archive_retires_pools_by_generation(app_module, version):
+    before = app_module.db_generation(version.db_file)
+    app_module.archive_version_db(version.db_file)
+    assert app_module.db_generation(version.db_file) != before
+
+
+def test_archiver_skips_versions_in_use(app_module, version, monkeypatch):
+    monkeypatch.setattr(app_module, "ARCHIVE_AFTER_DAYS", 0)
+    with app_module.version_online(version):
+        stats = app_module.archive_idle_versions()
+        assert stats["busy"] >= 1
+        assert os.path.exists(version.db_file)
+    app_module.archive_idle_versions()
+    assert os.path.exists(_archive_path(version)) and not os.path.exists(version.db_file)
+
+
+def test_version_online_rehydrates_for_the_block(app_module, version):
+    app_module.archive_version_db(version.db_file)
+    with app_module.version_online(version) as rehydrated_ms:
+        assert rehydrated_ms is not None
+        conn = sqlite3.connect(version.db_file)
+        assert conn.execute("SELECT count(*) FROM notes").fetchone() == (50,)
+        conn.close()
@@ -0,0 +1,68 @@
+import io
+import time
+
+import pytest
+
+
+@pytest.fixture
+def fake_create(app_module, monkeypatch):
+    # batch items run create_version_job; skip the LLM and version files
+    def create(job, user_id, project_id, sql_text=None, prompt=None, use_cache=True, stream=False):
+        if sql_text and "FAIL" in sql_text:
+            raise RuntimeError("bad schema")
+        return {"version_id": 1, "version_name": "version1"}
+    monkeypatch.setattr(app_module, "create_version_job", create)
+
+
+def _post(client, project, **kwargs):
+    return client.post(f"/project/{project.id}/versions/batch", **kwargs)
+
+
+@pytest.mark.parametrize("payload, item", [
+    ([1], None),
+    ({"sql": "CREATE TABLE t (a);"}, None),
+    ({"sql": ["CREATE TABLE t (a);", 7]}, "sql[1]"),
+    ({"prompts": [None]}, "prompts[0]"),
+])
+def test_batch_rejects_malformed_json(logged_in, project, payload, item):
+    resp = _post(logged_in, project, json=payload)
+    assert resp.status_code == 400
+    assert resp.get_json().get("item") == item
+
+
+def test_batch_rejects_non_utf8_uploads(logged_in, project):
+    resp = _post(logged_in, project, data={"sql_file": (io.BytesIO(b"CREATE TABLE t (a \xff);"), "latin.sql")},
+                 content_type="multipart/form-data")
+    assert resp.status_code == 400
+    assert resp.get_json()["item"] == "latin.sql"
+
+
+def test_batch_needs_items_within_the_limit(app_module, logged_in, project, monkeypatch):
+    assert _post(logged_in, project, json={"sql": ["  "]}).status_code == 400
+    monkeypatch.setattr(app_module, "BATCH_MAX_ITEMS", 1)
+    assert _post(logged_in, project, json={"prompts": ["a", "b"]}).status_code == 400
+
+
+def test_batch_status_is_read_from_the_store(app_module, logged_in, project, fake_create):
+    resp = _post(logged_in, project, json={"sql": ["CREATE TABLE t (a);", "FAIL"]})
+    assert resp.status_code == 202
+    status_url = resp.get_json()["status_url"]
+    batch_id = resp.get_json()["id"]
+    assert app_module.job_store.load_batch(batch_id)["items"][1]["source"] == "sql[1]"
+
+    deadline = time.time() + 10
+    while True:
+        data = logged_in.get(status_url).get_json()
+        if data["status"] == "done" or time.time() > deadline:
+            break
+        time.sleep(0.02)
+    assert data["counts"] == {"done": 1, "error": 1}
+    assert [i["status"] for i in data["items"]] == ["done", "error"]
+    assert data["items"][1]["error"] == "bad schema"
+
+
+def test_batch_status_checks_the_owner(app_module, logged_in, user):
+    batch = {"id": "b" * 32, "user_id": user.id + 1000, "project_id": 1, "created_at": time.time(), "items": []}
+    app_module.job_store.save_batch(batch)
+    assert logged_in.get(f"/batches/{batch['id']}").status_code == 404
+    assert logged_in.get("/batches/unknown").status_code == 404
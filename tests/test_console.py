@@ -0,0 +1,116 @@
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def db_file(app_module, tmp_path):
+    path = str(tmp_path / "backend.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (a INTEGER, b TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?, ?)", [(i, f"row {i}") for i in range(1200)])
+    conn.commit()
+    conn.close()
+    # open the pool (WAL mode) up front, as a served version DB would be
+    app_module.run_single_query(path, "SELECT count(*) FROM sqlite_master")
+    return path
+
+
+@pytest.fixture(params=[0, 1], ids=["thread", "sandbox"])
+def sql_processes(request, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "SQL_PROCESSES", request.param)
+    yield request.param
+    if app_module._sql_executor is not None:
+        app_module._sql_executor.shutdown()
+        app_module._sql_executor = None
+
+
+def _ndjson(app_module, db_file, sql, **kwargs):
+    rows = app_module.stream_query_ndjson(db_file, sql, user_id=1, **kwargs)
+    assert next(rows) == b""
+    return [json.loads(line) for line in b"".join(rows).decode("utf-8").splitlines()]
+
+
+def test_stream_writes_header_rows_and_trailer(app_module, db_file, sql_processes):
+    lines = _ndjson(app_module, db_file, "SELECT a, b FROM t ORDER BY a")
+    assert lines[0] == {"type": "select", "columns": ["a", "b"]}
+    assert lines[1] == [0, "row 0"] and lines[-2] == [1199, "row 1199"]
+    assert lines[-1] == {"done": True, "row_count": 1200, "truncated": False}
+    assert app_module._query_slots == {}
+
+
+def test_stream_truncates_at_max_rows(app_module, db_file, sql_processes):
+    lines = _ndjson(app_module, db_file, "SELECT a FROM t", max_rows=10)
+    assert lines[-1] == {"done": True, "row_count": 10, "truncated": True}
+
+
+def test_stream_reports_sql_errors(app_module, db_file, sql_processes):
+    assert _ndjson(app_module, db_file, "SELECT * FROM missing") == [
+        {"type": "error", "error": "no such table: missing"}]
+
+
+def test_closing_a_stream_releases_its_slot(app_module, db_file):
+    rows = app_module.stream_query_ndjson(db_file, "SELECT * FROM t a, t b", user_id=1)
+    next(rows)
+    next(rows)
+    assert app_module._query_slots
+    rows.close()
+    assert app_module._query_slots == {}
+
+
+def test_result_cache_is_keyed_on_the_exact_sql(app_module, db_file):
+    first = app_module.run_single_query(db_file, "SELECT a+1 FROM t ORDER BY a LIMIT 2")
+    spaced = app_module.run_single_query(db_file, "SELECT a + 1 FROM t ORDER BY a LIMIT 2")
+    assert not first.get("cached") and not spaced.get("cached")
+    assert (first["columns"], spaced["columns"]) == (["a+1"], ["a + 1"])
+
+    again = app_module.run_single_query(db_file, "  SELECT a+1 FROM t ORDER BY a LIMIT 2\n")
+    assert again["cached"] and again["columns"] == ["a+1"]
+
+
+def test_result_cache_is_dropped_on_commit(app_module, db_file):
+    sql = "SELECT count(*) FROM t"
+    assert app_module.run_single_query(db_file, sql)["rows"] == [[1200]]
+    assert app_module.run_single_query(db_file, sql)["cached"]
+    app_module.run_single_query(db_file, "INSERT INTO t VALUES (-1, 'new')", commit=True)
+    result = app_module.run_single_query(db_file, sql)
+    assert not result.get("cached") and result["rows"] == [[1201]]
+
+
+def test_uncommitted_writes_are_rolled_back(app_module, db_file):
+    result = app_module.run_single_query(db_file, "DELETE FROM t")
+    assert result["affected"] == 1200 and result["note"].startswith("rolled back")
+    assert app_module.run_single_query(db_file, "SELECT count(*) FROM t LIMIT 5")["rows"] == [[1200]]
+
+
+def test_pages_follow_the_cursor(app_module, db_file):
+    page = app_module.run_single_query(db_file, "SELECT a FROM t ORDER BY a", limit=500)
+    assert page["row_count"] == 500 and page["next_cursor"]
+    last = app_module.run_single_query(db_file, "SELECT a FROM t ORDER BY a", limit=500, cursor=page["next_cursor"])
+    last = app_module.run_single_query(db_file, "SELECT a FROM t ORDER BY a", limit=500, cursor=last["next_cursor"])
+    assert last["rows"][0] == [1000] and last["next_cursor"] is None
+
+
+def test_step_budget_stops_a_runaway_query(app_module, db_file, monkeypatch):
+    monkeypatch.setattr(app_module, "QUERY_MAX_STEPS", 100000)
+    result = app_module.run_single_query(db_file, "SELECT count(*) FROM t a, t b")
+    assert (result["error"], result["budget"]) == ("budget exceeded", "steps")
+
+
+def test_query_slots_refuse_past_the_cap(app_module, db_file, monkeypatch):
+    monkeypatch.setattr(app_module, "QUERY_MAX_PER_USER", 1)
+    with app_module.query_slot(7, db_file):
+        with pytest.raises(app_module.QueryBudgetExceeded) as exc:
+            app_module.run_single_query(db_file, "SELECT 1", user_id=7)
+        assert exc.value.budget == "concurrency:user"
+        assert app_module.run_single_query(db_file, "SELECT 2", user_id=8)["rows"] == [[2]]
+    assert app_module.run_single_query(db_file, "SELECT 3", user_id=7)["rows"] == [[3]]
+
+
+@pytest.mark.parametrize("sql", ["PRAGMA journal_mode = DELETE", "pragma main.foreign_keys=off",
+                                 "/* x */ PRAGMA query_only(1)"])
+def test_console_rejects_pragma_assignments(app_module, sql):
+    with pytest.raises(ValueError):
+        app_module.check_console_sql(sql)
+    app_module.check_console_sql("PRAGMA table_info(t)")
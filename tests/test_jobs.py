@@ -0,0 +1,151 @@
+import threading
+import time
+
+
+def _wait(app_module, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = app_module.get_job(job_id)
+        if job.finished_at:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def _stored(app_module, job_id):
+    return app_module.Job.from_row(app_module.job_store.load(job_id))
+
+
+def test_finished_job_is_served_from_the_store(app_module):
+    def work(job, value):
+        with job.stage("schema"):
+            pass
+        job.skip("persist")
+        return {"version_id": value, "version_name": "version1"}
+
+    job = app_module.submit_job("create_version", 1, 1, work, 42, stages=("schema", "persist"))
+    _wait(app_module, job.id)
+
+    stored = app_module.get_job(job.id)
+    assert stored.remote
+    assert stored.status == "done"
+    assert stored.result == {"version_id": 42, "version_name": "version1"}
+    assert [(s["name"], s["status"]) for s in stored.to_dict()["stages"]] == [("schema", "done"), ("persist", "skipped")]
+    assert stored.events_after(0, timeout=0)[-1] == ("done", {"result": stored.result, "error": None})
+
+
+def test_failed_job_records_the_error_and_failed_stage(app_module):
+    def work(job):
+        with job.stage("schema"):
+            raise RuntimeError("boom")
+
+    job = app_module.submit_job("create_version", 1, 1, work, stages=("schema",))
+    _wait(app_module, job.id)
+
+    stored = _stored(app_module, job.id)
+    assert (stored.status, stored.error) == ("error", "boom")
+    assert stored.stages[0]["status"] == "error"
+    assert stored.events_after(0, timeout=0)[-1] == ("error", {"result": None, "error": "boom"})
+
+
+def test_token_events_are_merged_in_the_store(app_module):
+    def work(job):
+        for text in ("CREATE ", "TABLE ", "t (a);"):
+            job.emit("token", {"text": text})
+        return {}
+
+    job = app_module.submit_job("create_version", 1, 1, work)
+    _wait(app_module, job.id)
+
+    events = _stored(app_module, job.id).events_after(0, timeout=0)
+    assert events[:3] == [("token", {"text": "CREATE TABLE t (a);"}), None, None]
+    assert events[-1][0] == "done"
+
+
+def test_remote_view_follows_a_running_job(app_module):
+    release = threading.Event()
+
+    def work(job):
+        job.emit("token", {"text": "x"})
+        release.wait(10)
+        return {}
+
+    job = app_module.submit_job("create_version", 1, 1, work)
+    view = None
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        view = _stored(app_module, job.id)
+        if view.status == "running" and view.events_after(0, timeout=0):
+            break
+        time.sleep(0.02)
+    assert view.events_after(0, timeout=0) == [("token", {"text": "x"})]
+
+    release.set()
+    events = view.events_after(1, timeout=10)
+    assert events and events[-1][0] == "done"
+    _wait(app_module, job.id)
+
+
+def test_orphaned_job_is_marked_failed(app_module):
+    job = app_module.Job("create_version", 1, 1, stages=("schema",))
+    job.status = "running"
+    job.save()
+    job.emit("stage", {"name": "schema", "status": "running"})
+    conn = app_module.job_store._db()
+    conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time() - app_module.JOB_ORPHAN_SECONDS - 1, job.id))
+    conn.commit()
+
+    stored = app_module.get_job(job.id)
+    assert (stored.status, stored.error) == ("error", app_module.JOB_ORPHANED_ERROR)
+    assert stored.finished_at
+    assert stored.events_after(0, timeout=0)[-1] == ("error", {"result": None, "error": app_module.JOB_ORPHANED_ERROR})
+
+
+def test_job_routes_check_the_owner(app_module, logged_in, user):
+    job = app_module.submit_job("create_version", user.id, 1, lambda job: {})
+    other = app_module.submit_job("create_version", user.id + 1000, 1, lambda job: {})
+    _wait(app_module, job.id)
+    _wait(app_module, other.id)
+
+    resp = logged_in.get(f"/jobs/{job.id}", headers={"Accept": "application/json"})
+    assert resp.status_code == 200 and resp.get_json()["status"] == "done"
+    assert logged_in.get(f"/jobs/{other.id}", headers={"Accept": "application/json"}).status_code == 404
+
+    body = logged_in.get(f"/jobs/{job.id}/events").get_data(as_text=True)
+    assert body.rstrip().splitlines()[-2] == "event: done"
+
+
+def test_stream_routes_start_jobs_only_on_post(app_module, logged_in, project, monkeypatch):
+    calls = []
+
+    def create(job, user_id, project_id, sql_text=None, prompt=None, use_cache=True, stream=False):
+        calls.append(stream)
+        return {}
+    monkeypatch.setattr(app_module, "create_version_job", create)
+
+    url = f"/project/{project.id}/versions/stream"
+    assert logged_in.get(url, query_string={"prompt": "a shop"}).status_code == 405
+    resp = logged_in.post(url, json={"prompt": "a shop"})
+    assert resp.status_code == 202
+    data = resp.get_json()
+    assert data["events_url"] == f"/jobs/{data['job_id']}/events"
+    _wait(app_module, data["job_id"])
+    assert calls == [True]
+
+
+def test_plain_modify_schema_does_not_stream(app_module, logged_in, user, project, monkeypatch):
+    calls = []
+
+    def modify(job, user_id, base_version_id, instruction, use_cache=True, stream=False):
+        calls.append(stream)
+        return {}
+    monkeypatch.setattr(app_module, "modify_schema_job", modify)
+    version = app_module.create_version_for_project(user, project, "CREATE TABLE t (a INTEGER);", [],
+                                                    utility_sections=[])
+
+    resp = logged_in.post(f"/version/{version.id}/modify_schema", json={"instruction": "add b"})
+    _wait(app_module, resp.get_json()["job_id"])
+    resp = logged_in.post(f"/version/{version.id}/modify_schema/stream", json={"instruction": "add b"})
+    _wait(app_module, resp.get_json()["job_id"])
+    assert logged_in.get(f"/version/{version.id}/modify_schema/stream").status_code == 405
+    assert calls == [False, True]
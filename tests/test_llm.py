@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    class response:
+        headers = {"retry-after": "0.01"}
+
+
+class FlakyChain:
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def invoke(self, inputs):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return type("Message", (), {"content": "ok", "usage_metadata": {"total_tokens": 10}})()
+
+
+@pytest.fixture
+def limiter(app_module, monkeypatch):
+    limiter = app_module.LLMRateLimiter(requests_per_min=6000, tokens_per_min=0)
+    monkeypatch.setattr(app_module, "llm_limiter", limiter)
+    return limiter
+
+
+def test_retry_recovers_from_transient_errors(app_module, limiter):
+    chain = FlakyChain([RuntimeError("connection reset"), RuntimeError("timeout")])
+    assert app_module.invoke_with_retry(chain, {"input": "x"}, retries=3, backoff=0).content == "ok"
+    assert chain.calls == 3
+    assert limiter.stats()["calls"] == 3
+
+
+def test_retry_gives_up_after_the_last_attempt(app_module, limiter):
+    chain = FlakyChain([RuntimeError("down")] * 3)
+    with pytest.raises(RuntimeError, match="down"):
+        app_module.invoke_with_retry(chain, {"input": "x"}, retries=2, backoff=0)
+    assert chain.calls == 3
+
+
+def test_rate_limit_slows_every_caller(app_module, limiter):
+    chain = FlakyChain([RateLimited("429 Too Many Requests")])
+    assert app_module.invoke_with_retry(chain, {"input": "x"}, retries=1, backoff=0).content == "ok"
+    stats = limiter.stats()
+    assert stats["rate_limited"] == 1
+    assert stats["rate_factor"] == 0.55  # halved, then one success won a little back
+
+
+def test_replay_miss_is_not_retried(app_module, limiter):
+    chain = FlakyChain([app_module.LLMReplayMiss("no fixture")])
+    with pytest.raises(app_module.LLMReplayMiss):
+        app_module.invoke_with_retry(chain, {"input": "x"}, retries=3, backoff=0)
+    assert chain.calls == 1
+
+
+def test_limiter_waits_for_the_request_bucket(app_module):
+    limiter = app_module.LLMRateLimiter(requests_per_min=120, tokens_per_min=0)
+    for _ in range(120):
+        limiter.acquire(0)
+    started = time.monotonic()
+    limiter.acquire(0)
+    assert time.monotonic() - started >= 0.3  # one request refills every 0.5s
+
+
+def test_limiter_settles_reserved_tokens(app_module):
+    limiter = app_module.LLMRateLimiter(requests_per_min=0, tokens_per_min=1000)
+    reserved = limiter.acquire(800)
+    limiter.settle(reserved, 100)
+    started = time.monotonic()
+    limiter.acquire(800)  # the unused 700 came back: no wait
+    assert time.monotonic() - started < 0.2
@@ -0,0 +1,40 @@
+import os
+import threading
+
+
+def test_metrics_are_loopback_only_without_a_token(client):
+    assert client.get("/metrics").status_code == 200
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"}).status_code == 403
+
+
+def test_metrics_token_is_required_when_set(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer nope"}).status_code == 401
+    resp = client.get("/metrics", headers={"Authorization": "Bearer s3cret"},
+                      environ_base={"REMOTE_ADDR": "10.1.2.3"})
+    assert resp.status_code == 200
+
+
+def test_db_label_hides_user_and_project_ids(app_module):
+    db_file = os.path.join(app_module.DATA_ROOT, "7", "project_9", "version3", "backend.db")
+    label = app_module.db_label(db_file)
+    assert label == app_module.db_label(db_file)
+    assert "project" not in label and "/" not in label
+    assert label != app_module.db_label(db_file.replace("version3", "version4"))
+
+
+def test_db_labels_stay_capped_under_concurrency(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "_db_labels", set())
+    monkeypatch.setattr(app_module, "METRICS_MAX_DB_LABELS", 50)
+
+    def label_many(start):
+        for i in range(start, start + 200):
+            app_module.db_label(os.path.join(app_module.DATA_ROOT, "u", f"version{i}", "backend.db"))
+
+    threads = [threading.Thread(target=label_many, args=(n * 200,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(app_module._db_labels) == 50
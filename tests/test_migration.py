@@ -0,0 +1,131 @@
+import os
+import sqlite3
+
+import pytest
+
+BASE_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE audit (id INTEGER PRIMARY KEY, user_id INTEGER, note TEXT);
+CREATE TRIGGER trg_users_audit AFTER INSERT ON users BEGIN
+  INSERT INTO audit (user_id, note) VALUES (NEW.id, CASE WHEN NEW.name = '' THEN 'blank; name' ELSE 'ok' END);
+END;
+CREATE VIEW user_names AS SELECT name FROM users;
+"""
+
+
+def _make_db(path, schema, rows=("ann", "bob")):
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    conn.executemany("INSERT INTO users (name) VALUES (?)", [(r,) for r in rows])
+    conn.commit()
+    conn.close()
+
+
+def _query(path, sql):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_split_keeps_trigger_bodies_whole(app_module):
+    spans = app_module._split_statements(BASE_SCHEMA)
+    statements = [BASE_SCHEMA[a:b] for a, b in spans]
+    assert len(statements) == 4
+    assert statements[2].startswith("CREATE TRIGGER") and statements[2].endswith("END;")
+
+
+def test_split_ignores_semicolons_in_strings_and_comments(app_module):
+    sql = "CREATE TABLE t (a TEXT DEFAULT 'x;y'); -- done; really\nCREATE TABLE u (b /* ; */ INT);"
+    statements = [sql[a:b] for a, b in app_module._split_statements(sql)]
+    assert len(statements) == 2
+    assert statements[0] == "CREATE TABLE t (a TEXT DEFAULT 'x;y');"
+
+
+def test_schema_model_records_triggers_without_errors(app_module):
+    model = app_module._build_schema_model(BASE_SCHEMA)
+    assert [s["kind"] for s in model["statements"]] == ["TABLE", "TABLE", "TRIGGER", "VIEW"]
+    assert model["errors"] == []
+
+
+def test_migration_keeps_rows_triggers_and_views(app_module, tmp_path):
+    base = str(tmp_path / "base.db")
+    target = str(tmp_path / "new.db")
+    _make_db(base, BASE_SCHEMA)
+    new_schema = BASE_SCHEMA.replace("name TEXT NOT NULL)", "name TEXT NOT NULL, email TEXT)") + \
+        "CREATE VIEW user_emails AS SELECT name, email FROM users;\n"
+
+    summary = app_module.migrate_version_db(base, target, new_schema)
+
+    assert summary["rebuilt"] == ["users"]
+    assert summary["rows_copied"] == {"users": 2}
+    assert _query(target, "SELECT name, email FROM users ORDER BY id") == [("ann", None), ("bob", None)]
+    # the trigger and both views exist and work on the migrated data
+    conn = sqlite3.connect(target)
+    conn.execute("INSERT INTO users (name) VALUES ('')")
+    conn.commit()
+    conn.close()
+    assert _query(target, "SELECT note FROM audit ORDER BY id")[-1] == ("blank; name",)
+    assert _query(target, "SELECT count(*) FROM user_names") == [(3,)]
+    assert _query(target, "SELECT count(*) FROM user_emails") == [(3,)]
+
+
+def test_migration_drops_views_and_triggers_missing_from_new_schema(app_module, tmp_path):
+    base = str(tmp_path / "base.db")
+    target = str(tmp_path / "new.db")
+    _make_db(base, BASE_SCHEMA)
+    new_schema = "CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT NOT NULL);\n" \
+                 "CREATE TABLE audit (id INTEGER PRIMARY KEY, user_id INTEGER, note TEXT);\n"
+
+    app_module.migrate_version_db(base, target, new_schema)
+
+    objects = _query(target, "SELECT type, name FROM sqlite_master WHERE type IN ('view', 'trigger')")
+    assert objects == []
+    assert _query(target, "SELECT count(*) FROM users") == [(2,)]
+
+
+def test_migration_failure_leaves_copy_untouched(app_module, tmp_path):
+    base = str(tmp_path / "base.db")
+    target = str(tmp_path / "new.db")
+    _make_db(base, BASE_SCHEMA)
+    # existing rows can't satisfy the new NOT NULL column
+    new_schema = BASE_SCHEMA.replace("name TEXT NOT NULL)", "name TEXT NOT NULL, email TEXT NOT NULL)")
+
+    with pytest.raises(sqlite3.IntegrityError):
+        app_module.migrate_version_db(base, target, new_schema)
+    assert _query(target, "SELECT count(*) FROM users") == [(2,)]
+
+
+def _base_version(app_module, user, project, schema):
+    version = app_module.create_version_for_project(user, project, schema, [], utility_sections=[])
+    conn = sqlite3.connect(version.db_file)
+    conn.executemany("INSERT INTO users (name) VALUES (?)", [("ann",), ("bob",)])
+    conn.commit()
+    conn.close()
+    app_module.close_sqlite_pool(version.db_file)
+    return version
+
+
+def test_create_version_migrates_base_data(app_module, user, project):
+    base = _base_version(app_module, user, project, BASE_SCHEMA)
+    new_schema = BASE_SCHEMA.replace("name TEXT NOT NULL)", "name TEXT NOT NULL, email TEXT)")
+
+    version = app_module.create_version_for_project(user, project, new_schema, [], base_version_obj=base,
+                                                    utility_sections=[])
+
+    assert _query(version.db_file, "SELECT name FROM users ORDER BY id") == [("ann",), ("bob",)]
+    assert _query(version.db_file, "SELECT name FROM sqlite_master WHERE type = 'trigger'") == [("trg_users_audit",)]
+
+
+def test_create_version_fails_instead_of_starting_empty(app_module, user, project):
+    base = _base_version(app_module, user, project, BASE_SCHEMA)
+    new_schema = BASE_SCHEMA.replace("name TEXT NOT NULL)", "name TEXT NOT NULL, email TEXT NOT NULL)")
+    before = sorted(os.listdir(app_module.project_dir(user.id, project.id)))
+
+    with pytest.raises(RuntimeError, match="Migrating the data of"):
+        app_module.create_version_for_project(user, project, new_schema, [], base_version_obj=base,
+                                              utility_sections=[])
+
+    assert [v.name for v in project.versions] == [base.name]
+    assert sorted(os.listdir(app_module.project_dir(user.id, project.id))) == before